@@ -0,0 +1,70 @@
+"""
+Throughput of the full attitude/rate cascade, scalar loop vs BatchNonlinearController
+
+Each state runs lateral_position_control, altitude_control, roll_pitch_controller,
+yaw_control and body_rate_control.
+
+usage: python -m benchmarks.batch_controller [--sizes 1 10 100 ...]
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from controller import NonlinearController, BatchNonlinearController
+
+
+def random_states(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return dict(position_cmd=rng.normal(size=(n, 3)) * 5.0,
+                velocity_cmd=rng.normal(size=(n, 3)),
+                position=rng.normal(size=(n, 3)) * 5.0,
+                velocity=rng.normal(size=(n, 3)),
+                attitude=rng.uniform([-0.3, -0.3, -np.pi], [0.3, 0.3, np.pi], size=(n, 3)),
+                yaw_cmd=rng.uniform(-np.pi, np.pi, size=n),
+                body_rate=rng.normal(size=(n, 3)))
+
+
+def cascade(controller, s):
+    acceleration_cmd = controller.lateral_position_control(s['position_cmd'][..., 0:2], s['velocity_cmd'][..., 0:2],
+                                                           s['position'][..., 0:2], s['velocity'][..., 0:2])
+    thrust_cmd = controller.altitude_control(-s['position_cmd'][..., 2], -s['velocity_cmd'][..., 2],
+                                             -s['position'][..., 2], -s['velocity'][..., 2], s['attitude'], 9.81)
+    pq_cmd = controller.roll_pitch_controller(acceleration_cmd, s['attitude'], thrust_cmd)
+    r_cmd = controller.yaw_control(s['yaw_cmd'], s['attitude'][..., 2])
+    body_rate_cmd = np.concatenate((pq_cmd, np.expand_dims(r_cmd, -1)), axis=-1)
+    return controller.body_rate_control(body_rate_cmd, s['body_rate']), thrust_cmd
+
+
+def scalar_cascade(controller, s):
+    n = len(s['yaw_cmd'])
+    for i in range(n):
+        cascade(controller, {k: v[i] for k, v in s.items()})
+
+
+def states_per_second(fn, n, repeat=3):
+    number = max(1, 20000 // n)
+    return n * number / min(timeit.repeat(fn, number=number, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000, 100000])
+    parser.add_argument('--max-scalar', type=int, default=10000, help='largest N also run through the scalar loop')
+    args = parser.parse_args()
+
+    scalar = NonlinearController()
+    batch = BatchNonlinearController()
+    print('{:>8s} {:>16s} {:>16s} {:>9s}'.format('N', 'scalar states/s', 'batch states/s', 'speedup'))
+    for n in args.sizes:
+        s = random_states(n)
+        batch_rate = states_per_second(lambda: cascade(batch, s), n)
+        if n <= args.max_scalar:
+            scalar_rate = states_per_second(lambda: scalar_cascade(scalar, s), n)
+            print('{:8d} {:16.0f} {:16.0f} {:8.1f}x'.format(n, scalar_rate, batch_rate, batch_rate / scalar_rate))
+        else:
+            print('{:8d} {:>16s} {:16.0f}'.format(n, '-', batch_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Accuracy and cost of an attitude cache with a tolerance (fast-math)
+
+For each tolerance, replays the controller inputs of an offline flight of
+test_trajectory.txt (see benchmarks.suite.flight_states) through a NonlinearController
+whose attitude cache is AttitudeCache(tolerance) and reports:
+    the largest deviation of the cached rotation matrix from the exact euler2RM, and the
+    error_bound it must stay within
+    the largest deviation of the thrust and roll/pitch rate commands from the exact controller
+    the fraction of attitude samples for which the matrix was recomputed
+    the time of the two attitude cache lookups of a tick, the only part fast-math changes
+    the time of one altitude_control plus roll_pitch_controller tick
+    the mission errors of a closed-loop offline flight with that tolerance
+
+usage: python -m benchmarks.fast_math [--tolerances 0 1e-4 1e-3 1e-2] [--no-flight]
+"""
+import argparse
+
+import numpy as np
+
+from benchmarks.suite import flight_states, measure
+from controller import NonlinearController
+from frame_utils import AttitudeCache, euler2RM
+from simulator import Simulation
+from trajectory import load_trajectory
+
+DEFAULT_TOLERANCES = (0.0, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2)
+
+
+def cached_controller(tolerance):
+    """NonlinearController whose rotation matrices come from AttitudeCache(tolerance)"""
+    controller = NonlinearController()
+    controller.attitude_cache = AttitudeCache(tolerance)
+    return controller
+
+
+def attitude_ticks(controller, states):
+    """Per-sample altitude_control and roll_pitch_controller calls, as ControlsFlyer makes them
+
+    Returns: function of the sample index returning (thrust command, roll/pitch rate command)
+    """
+    position_cmd = list(states['position_cmd'])
+    velocity_cmd = list(states['velocity_cmd'])
+    acceleration_cmd = list(states['acceleration_cmd'])
+    position = list(states['position'])
+    velocity = list(states['velocity'])
+    attitude = list(states['attitude'])
+
+    def tick(i):
+        thrust_cmd = controller.altitude_control(-position_cmd[i][2], -velocity_cmd[i][2], -position[i][2],
+                                                 -velocity[i][2], attitude[i], 9.81)
+        return thrust_cmd, controller.roll_pitch_controller(acceleration_cmd[i][0:2], attitude[i], thrust_cmd)
+    return tick
+
+
+def cache_lookups(cache, states):
+    """Per-sample rotation matrix lookups of one attitude tick (altitude, then roll/pitch)
+
+    Returns: function of the sample index
+    """
+    attitude = list(states['attitude'])
+    rotation_matrix = cache.rotation_matrix
+
+    def lookups(i):
+        rotation_matrix(attitude[i])
+        rotation_matrix(attitude[i])
+    return lookups
+
+
+def accuracy(tolerance, states):
+    """Deviations of the fast-math matrix and commands from the exact ones over the flight
+
+    Returns: dict of the largest matrix, thrust and rate deviations and the recomputed fraction
+    """
+    controller = cached_controller(tolerance)
+    cache = controller.attitude_cache
+    exact_tick = attitude_ticks(NonlinearController(), states)
+    fast_tick = attitude_ticks(controller, states)
+    matrix_error = thrust_error = rate_error = 0.0
+    for i, attitude in enumerate(states['attitude']):
+        exact_thrust, exact_rates = exact_tick(i)
+        thrust, rates = fast_tick(i)
+        matrix_error = max(matrix_error, float(np.max(np.abs(cache.matrix - euler2RM(*attitude)))))
+        thrust_error = max(thrust_error, abs(float(thrust - exact_thrust)))
+        rate_error = max(rate_error, float(np.max(np.abs(rates - exact_rates))))
+    return dict(matrix_error=matrix_error, error_bound=cache.error_bound, thrust_error=thrust_error,
+                rate_error=rate_error, recomputed=cache.updates / len(states['attitude']))
+
+
+def flight(tolerance, time_mult=0.5):
+    trajectory = load_trajectory('test_trajectory.txt', time_mult=time_mult)
+    return Simulation(trajectory, controller=cached_controller(tolerance)).run().mission_score()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tolerances', type=float, nargs='+', default=list(DEFAULT_TOLERANCES),
+                        help='attitude cache tolerances in radians')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent timing each tolerance')
+    parser.add_argument('--no-flight', action='store_true', help='skip the closed-loop flights')
+    args = parser.parse_args()
+
+    states = flight_states()
+    samples = len(states['attitude'])
+    print('{} attitude samples'.format(samples))
+    print('{:>9s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>9s} {:>9s} {:>8s} {:>8s}'.format(
+        'tolerance', 'R error', 'bound', 'thrust', 'pq rate', 'recompute', 'cache ns', 'tick ns', 'maxH', 'maxV'))
+    exceeded = []
+    for tolerance in args.tolerances:
+        result = accuracy(tolerance, states)
+        if result['matrix_error'] > result['error_bound'] + 1e-12:
+            exceeded.append(tolerance)
+        cache_timing = measure(cache_lookups(AttitudeCache(tolerance), states), samples, args.min_time)
+        timing = measure(attitude_ticks(cached_controller(tolerance), states),
+                         samples, args.min_time)
+        line = '{:9.1e} {:10.2e} {:10.2e} {:10.2e} {:10.2e} {:9.1%} {:9.0f} {:9.0f}'.format(
+            tolerance, result['matrix_error'], result['error_bound'], result['thrust_error'], result['rate_error'],
+            result['recomputed'], cache_timing['mean_ns'], timing['mean_ns'])
+        if not args.no_flight:
+            score = flight(tolerance)
+            line += ' {:8.4f} {:8.4f}'.format(score['maximum_horizontal_error'], score['maximum_vertical_error'])
+        print(line)
+    if exceeded:
+        print('error bound exceeded for tolerance(s): {}'.format(', '.join(str(t) for t in exceeded)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of the rotation matrix path used by the attitude stages
+
+Compares, per attitude tick, the previous path (two freshly allocated and transposed
+matrices, one for altitude_control and one for roll_pitch_controller) against the
+shared per-sample matrix from NonlinearController.rotation_matrix.
+
+usage: python -m benchmarks.rotation [--ticks N]
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from controller import NonlinearController
+from frame_utils import euler2RM, euler2RM_batch
+
+
+def legacy_euler2RM(roll, pitch, yaw):
+    R = np.array([[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]])
+    cr = np.cos(roll)
+    sr = np.sin(roll)
+    cp = np.cos(pitch)
+    sp = np.sin(pitch)
+    cy = np.cos(yaw)
+    sy = np.sin(yaw)
+    R[0, 0] = cp * cy
+    R[1, 0] = -cr * sy + sr * sp * cy
+    R[2, 0] = sr * sy + cr * sp * cy
+    R[0, 1] = cp * sy
+    R[1, 1] = cr * cy + sr * sp * sy
+    R[2, 1] = -sr * cy + cr * sp * sy
+    R[0, 2] = -sp
+    R[1, 2] = sr * cp
+    R[2, 2] = cr * cp
+    return R.transpose()
+
+
+def attitude_samples(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform([-0.3, -0.3, -np.pi], [0.3, 0.3, np.pi], size=(n, 3))
+
+
+def per_tick_seconds(fn, attitudes, repeat=5):
+    def run():
+        for attitude in attitudes:
+            fn(attitude)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(attitudes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', type=int, default=20000)
+    args = parser.parse_args()
+
+    attitudes = attitude_samples(args.ticks)
+    controller = NonlinearController()
+
+    def legacy_tick(attitude):
+        legacy_euler2RM(*attitude)[2, 2]
+        legacy_euler2RM(*attitude)[0:2, 2]
+
+    def uncached_tick(attitude):
+        euler2RM(*attitude)[2, 2]
+        euler2RM(*attitude)[0:2, 2]
+
+    def shared_tick(attitude):
+        controller.rotation_matrix(attitude)[2, 2]
+        controller.rotation_matrix(attitude)[0:2, 2]
+
+    results = [('legacy (2 allocating calls)', per_tick_seconds(legacy_tick, attitudes)),
+               ('euler2RM (2 calls)', per_tick_seconds(uncached_tick, attitudes)),
+               ('shared per-sample matrix', per_tick_seconds(shared_tick, attitudes))]
+    baseline = results[0][1]
+    for name, seconds in results:
+        print('{:<30s} {:8.3f} us/tick  ({:.2f}x)'.format(name, seconds * 1e6, baseline / seconds))
+
+    batch_seconds = min(timeit.repeat(lambda: euler2RM_batch(attitudes), number=1, repeat=5))
+    print('{:<30s} {:8.3f} us/matrix'.format('euler2RM_batch', batch_seconds / len(attitudes) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Startup benchmark of ControlsFlyer, from interpreter start to the arm command
+
+Each run is a fresh interpreter, so imports are cold (apart from the OS file cache).
+The flyer gets a NullConnection, and the first state callback issues the arm command
+without waiting for a simulator.
+
+usage: python -m benchmarks.startup [--runs N] [--modules]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = r'''
+import json, sys, time
+start = time.perf_counter()
+import controls_flyer
+imported = time.perf_counter()
+from benchmarks.startup import NullConnection
+drone = controls_flyer.ControlsFlyer(NullConnection())
+constructed = time.perf_counter()
+drone.preload_trajectory()
+drone.state_callback()
+armed = time.perf_counter()
+print(json.dumps(dict(import_s=imported - start, construct_s=constructed - imported, arm_s=armed - constructed,
+                      import_to_armed_s=armed - start, modules=len(sys.modules))))
+'''
+
+
+class NullConnection(object):
+    """Stands in for a MavlinkConnection: accepts every call and never delivers a message"""
+
+    def __getattr__(self, name):
+        def ignore(*args, **kwargs):
+            pass
+        return ignore
+
+
+def run_once():
+    """Time one cold start in a fresh interpreter
+
+    Returns: dict of durations in seconds, including the whole process
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', _CHILD], cwd=ROOT, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_s'] = time.perf_counter() - start
+    return result
+
+
+def slowest_imports(top=15):
+    """Modules with the largest cumulative import time, from python -X importtime"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import controls_flyer'], cwd=ROOT,
+                            check=True, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modules', action='store_true', help='list the slowest imports')
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    print('{:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s}'.format(
+        'import', 'construct', 'arm', 'to armed', 'process', 'modules'))
+    for r in results:
+        print('{:9.1f}ms {:9.1f}ms {:9.1f}ms {:9.1f}ms {:9.1f}ms {:8d}'.format(
+            r['import_s'] * 1e3, r['construct_s'] * 1e3, r['arm_s'] * 1e3, r['import_to_armed_s'] * 1e3,
+            r['process_s'] * 1e3, r['modules']))
+    best = min(results, key=lambda r: r['import_to_armed_s'])
+    print('best import to armed: {:.1f} ms'.format(best['import_to_armed_s'] * 1e3))
+
+    if args.modules:
+        print('\n{:>12s}  {}'.format('cumulative', 'module'))
+        for cumulative, name in slowest_imports():
+            print('{:10.1f}ms  {}'.format(cumulative / 1e3, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Benchmark suite of the controller stages, the full cascade and trajectory lookups
+
+The controller stages are fed the states of an offline flight of test_trajectory.txt,
+so branches and magnitudes are those seen in flight. Trajectory lookups run on
+synthetic trajectories of increasing size. Every case reports throughput and per-call
+latency percentiles. Results can be saved as JSON and compared against a saved run.
+
+usage: python -m benchmarks.suite [--output results.json] [--compare baseline.json] [--threshold 0.1]
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+from controller import NonlinearController
+from fast_controller import FastNonlinearController
+from frame_utils import euler2RM, euler2quaternion, quaternion2RM
+from instrumentation import LatencyHistogram
+from simulator import Simulation
+from trajectory import Trajectory, load_trajectory
+
+DEFAULT_SIZES = (400, 10000, 100000, 1000000)
+
+
+class _RecordingSimulation(Simulation):
+
+    def attitude_controller(self):
+        super().attitude_controller()
+        self.samples.append((self.local_position_target, self.local_velocity_target, self.local_acceleration_target,
+                             self.acceleration_ff, self.attitude_target, self.model.position.copy(),
+                             self.model.velocity.copy(), self.model.attitude.copy(), self.model.body_rate.copy(),
+                             self.thrust_cmd, self.body_rate_target))
+
+
+def flight_states(time_mult=0.5):
+    """Controller inputs at every attitude tick of an offline flight of test_trajectory.txt
+
+    Returns: dict of numpy arrays with a leading sample dimension
+    """
+    sim = _RecordingSimulation(load_trajectory('test_trajectory.txt', time_mult=time_mult))
+    sim.samples = []
+    sim.run()
+    names = ('position_cmd', 'velocity_cmd', 'acceleration_cmd', 'acceleration_ff', 'attitude_cmd', 'position',
+             'velocity', 'attitude', 'body_rate', 'thrust_cmd', 'body_rate_cmd')
+    return {name: np.array(column) for name, column in zip(names, zip(*sim.samples))}
+
+
+def synthetic_trajectory(n):
+    """Helix of n samples, 20 Hz"""
+    times = np.arange(n) * 0.05
+    positions = np.stack((10.0 * np.cos(times / 20.0), 10.0 * np.sin(times / 20.0), -3.0 - times / 1000.0), axis=1)
+    yaws = np.zeros(n)
+    return times, positions, yaws
+
+
+def measure(fn, samples, min_time=0.2, max_calls=200000):
+    """Time fn(i) for i cycling over range(samples)
+
+    Throughput comes from an untimed-per-call loop, the latency percentiles from timing
+    every call (which adds the clock overhead, tens of ns, to each value).
+
+    Returns: dict of calls per second and latency statistics in ns
+    """
+    fn(0)
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time and calls < max_calls:
+        for i in range(min(samples, max_calls - calls)):
+            fn(i)
+        calls += min(samples, max_calls - calls)
+        elapsed = time.perf_counter() - start
+
+    histogram = LatencyHistogram()
+    clock = time.perf_counter_ns
+    for i in range(min(calls, 20000)):
+        t0 = clock()
+        fn(i % samples)
+        histogram.record(clock() - t0)
+    return dict(calls=calls, calls_per_s=calls / elapsed, mean_ns=elapsed / calls * 1e9,
+                p50_ns=histogram.percentile(50), p99_ns=histogram.percentile(99), max_ns=histogram.max)
+
+
+def controller_cases(states):
+    controller = NonlinearController()
+    s = {name: list(values) for name, values in states.items()}
+    attitude_lists = [a.tolist() for a in states['attitude']]
+    quaternion_lists = [euler2quaternion(*a).tolist() for a in attitude_lists]
+    n = len(s['attitude'])
+
+    def cascade(i):
+        acceleration_cmd = controller.lateral_position_control(
+                s['position_cmd'][i][0:2], s['velocity_cmd'][i][0:2], s['position'][i][0:2],
+                s['velocity'][i][0:2], s['acceleration_ff'][i][0:2])
+        thrust_cmd = controller.altitude_control(
+                -s['position_cmd'][i][2], -s['velocity_cmd'][i][2], -s['position'][i][2], -s['velocity'][i][2],
+                s['attitude'][i], 9.81 - s['acceleration_ff'][i][2])
+        pq_cmd = controller.roll_pitch_controller(acceleration_cmd, s['attitude'][i], thrust_cmd)
+        r_cmd = controller.yaw_control(s['attitude_cmd'][i][2], s['attitude'][i][2])
+        controller.body_rate_control(np.array([pq_cmd[0], pq_cmd[1], r_cmd]), s['body_rate'][i])
+
+    fast = FastNonlinearController()
+
+    def fast_cascade(i):
+        fast.cascade(s['position_cmd'][i], s['velocity_cmd'][i], s['acceleration_ff'][i], s['attitude_cmd'][i][2],
+                     s['position'][i], s['velocity'][i], s['attitude'][i], s['body_rate'][i])
+
+    return n, {
+        'euler2RM': lambda i: euler2RM(*attitude_lists[i]),
+        'quaternion2RM': lambda i: quaternion2RM(quaternion_lists[i]),
+        'lateral_position_control': lambda i: controller.lateral_position_control(
+                s['position_cmd'][i][0:2], s['velocity_cmd'][i][0:2], s['position'][i][0:2],
+                s['velocity'][i][0:2], s['acceleration_ff'][i][0:2]),
+        'altitude_control': lambda i: controller.altitude_control(
+                -s['position_cmd'][i][2], -s['velocity_cmd'][i][2], -s['position'][i][2], -s['velocity'][i][2],
+                s['attitude'][i], 9.81),
+        'roll_pitch_controller': lambda i: controller.roll_pitch_controller(
+                s['acceleration_cmd'][i][0:2], s['attitude'][i], s['thrust_cmd'][i]),
+        'yaw_control': lambda i: controller.yaw_control(s['attitude_cmd'][i][2], s['attitude'][i][2]),
+        'body_rate_control': lambda i: controller.body_rate_control(s['body_rate_cmd'][i], s['body_rate'][i]),
+        'cascade': cascade,
+        'fast_cascade': fast_cascade,
+    }
+
+
+def trajectory_cases(n, seed=0):
+    """trajectory_control and Trajectory lookups on an n sample trajectory"""
+    controller = NonlinearController()
+    times, positions, yaws = synthetic_trajectory(n)
+    trajectory = Trajectory(positions, times, yaws)
+    position_list = list(positions)
+    time_list = times.tolist()
+    yaw_list = yaws.tolist()
+    rng = np.random.default_rng(seed)
+    queries = 1000
+    random_times = rng.uniform(times[0], times[-1], queries).tolist()
+    # a flight queries consecutive times, a few per trajectory sample
+    flight_times = np.linspace(times[0], times[-1], max(queries, 4 * n)).tolist()
+    return {
+        'trajectory_control[{}]'.format(n): (queries, lambda i: controller.trajectory_control(
+                position_list, yaw_list, time_list, random_times[i])),
+        'Trajectory.sample.random[{}]'.format(n): (queries, lambda i: trajectory.sample(random_times[i])),
+        'Trajectory.sample.flight[{}]'.format(n): (len(flight_times), lambda i: trajectory.sample(flight_times[i])),
+    }
+
+
+def simulation_case():
+    trajectory = load_trajectory('test_trajectory.txt', time_mult=0.5)
+
+    def run(i):
+        Simulation(trajectory.shifted(0.0)).run()
+    return run
+
+
+def run_suite(sizes=DEFAULT_SIZES, min_time=0.2, pattern=None):
+    """Run every case whose name contains pattern
+
+    Returns: dict of results keyed by case name
+    """
+    results = {}
+
+    def record(name, samples, fn, **kwargs):
+        if pattern is not None and pattern not in name:
+            return
+        result = measure(fn, samples, min_time, **kwargs)
+        results[name] = result
+        print('{:<40s} {:12.0f}/s {:10.0f} ns {:10d} ns {:10d} ns'.format(
+            name, result['calls_per_s'], result['mean_ns'], result['p50_ns'], result['p99_ns']))
+        sys.stdout.flush()
+
+    print('{:<40s} {:>14s} {:>13s} {:>13s} {:>13s}'.format('case', 'throughput', 'mean', 'p50', 'p99'))
+    samples, cases = controller_cases(flight_states())
+    for name, fn in cases.items():
+        record(name, samples, fn)
+    for n in sizes:
+        # trajectory_control copies the whole list on every call
+        max_calls = max(10, int(2e7 // n))
+        for name, (samples, fn) in trajectory_cases(n).items():
+            record(name, samples, fn, max_calls=max_calls if name.startswith('trajectory_control') else 200000)
+    record('simulation', 1, simulation_case(), max_calls=3)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the mean time change of every case also in baseline
+
+    Returns: list of the names of cases slower than baseline by more than threshold (a fraction)
+    """
+    regressions = []
+    print('{:<40s} {:>13s} {:>13s} {:>9s}'.format('case', 'baseline', 'current', 'change'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['mean_ns']
+        change = result['mean_ns'] / old - 1.0
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = 'faster'
+        print('{:<40s} {:10.0f} ns {:10.0f} ns {:+8.1%} {}'.format(name, old, result['mean_ns'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='trajectory sizes')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent per case')
+    parser.add_argument('--filter', type=str, default=None, help='only run cases containing this string')
+    parser.add_argument('--output', type=str, default=None, help='save the results as JSON')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, args.min_time, args.filter)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(meta=dict(date=datetime.datetime.now().isoformat(), python=platform.python_version(),
+                                     numpy=np.__version__, machine=platform.machine(),
+                                     processor=platform.processor()),
+                           results=results), f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} regression(s) over {:.0%}: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
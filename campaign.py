@@ -0,0 +1,298 @@
+"""
+Monte Carlo robustness campaigns of the control cascade
+
+components:
+    randomized scenarios: wind gusts, position and gyro noise, mass and inertia errors, trajectory speed
+    offline flights of every scenario on all CPU cores
+    per-run metrics streamed to a resumable JSON lines file
+    percentile error envelopes and failure rate against the mission thresholds
+"""
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from controller import NonlinearController, DRONE_MASS_KG, MOI
+from mission_metrics import (DEFAULT_THRESHOLD_HORIZONTAL_ERROR, DEFAULT_THRESHOLD_VERTICAL_ERROR,
+                             DEFAULT_THRESHOLD_TIME)
+from simulator import QuadrotorModel, Simulation
+from trajectory import Trajectory, read_trajectory_file
+
+# (low, high) of the uniformly drawn scenario parameters
+DEFAULT_SCENARIO_SPACE = {
+    # slower than the nominal 0.5 would fail the mission time threshold by construction
+    'time_mult': (0.4, 0.5),
+    'mass_scale': (0.9, 1.1),
+    'moi_scale': (0.8, 1.2),
+    'wind_force': (0.0, 0.3),
+    'gust_amplitude': (0.0, 0.4),
+    'gust_period': (1.0, 6.0),
+    'position_noise': (0.0, 0.05),
+    'gyro_noise': (0.0, 0.05),
+}
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 95.0, 99.0)
+# mission progress bins of the per-run error envelopes
+ENVELOPE_BINS = 20
+
+
+def sample_scenarios(runs, space=DEFAULT_SCENARIO_SPACE, seed=0):
+    """Draw the scenarios of a campaign, the same ones for the same seed
+
+    Each scenario holds one value per parameter of space (moi_scale per body axis), wind
+    and gust directions, and the seed of its sensor noise.
+
+    Returns: list of dicts, scenario i has run index i
+    """
+    rng = np.random.default_rng(seed)
+    scenarios = []
+    for run in range(runs):
+        scenario = dict(run=run, seed=int(rng.integers(2 ** 31)))
+        for name in sorted(space):
+            low, high = space[name]
+            size = 3 if name == 'moi_scale' else None
+            value = rng.uniform(low, high, size)
+            scenario[name] = value.tolist() if size else float(value)
+        scenario['wind_direction'] = float(rng.uniform(-math.pi, math.pi))
+        scenario['gust_direction'] = float(rng.uniform(-math.pi, math.pi))
+        scenarios.append(scenario)
+    return scenarios
+
+
+class ScenarioSimulation(Simulation):
+
+    def __init__(self, trajectory, scenario, controller=None, **kwargs):
+        """Simulation of one campaign scenario
+
+        The vehicle model has the perturbed mass and moments of inertia while the
+        controller keeps assuming the nominal ones. A steady wind force plus a periodic
+        (1 - cos) gust pushes the vehicle horizontally. Position and gyro readings get
+        white Gaussian noise, drawn from the scenario seed.
+
+        Args:
+            trajectory: Trajectory, already scaled by the scenario time_mult
+            scenario: dict from sample_scenarios
+            controller, kwargs: as for Simulation
+        """
+        self.scenario = scenario
+        model = QuadrotorModel(trajectory.positions[0], mass=DRONE_MASS_KG * scenario['mass_scale'],
+                               moi=MOI * np.array(scenario['moi_scale']))
+        super().__init__(trajectory, controller=controller, model=model, **kwargs)
+        self._rng = np.random.default_rng(scenario['seed'])
+        self._wind = scenario['wind_force'] * np.array([math.cos(scenario['wind_direction']),
+                                                        math.sin(scenario['wind_direction']), 0.0])
+        self._gust = scenario['gust_amplitude'] * np.array([math.cos(scenario['gust_direction']),
+                                                            math.sin(scenario['gust_direction']), 0.0])
+        self._gust_frequency = 2 * math.pi / scenario['gust_period']
+        self._position_noise = scenario['position_noise']
+        self._gyro_noise = scenario['gyro_noise']
+
+    def local_position(self):
+        return self.model.position + self._rng.normal(0.0, self._position_noise, 3)
+
+    def gyro_raw(self):
+        return self.model.body_rate + self._rng.normal(0.0, self._gyro_noise, 3)
+
+    def external_force(self, t):
+        phase = self._gust_frequency * (t - self.trajectory.start_time)
+        return self._wind + self._gust * (0.5 - 0.5 * math.cos(phase))
+
+
+def error_envelope(times, errors, duration, bins=ENVELOPE_BINS):
+    """Largest error within each of bins equal fractions of the mission
+
+    Samples after duration (the trajectory is over, the vehicle still settling) count in
+    the last bin.
+
+    Returns: list of bins floats, NaN for bins without samples
+    """
+    index = np.minimum((np.asarray(times) / duration * bins).astype(np.int64), bins - 1)
+    envelope = np.full(bins, -np.inf)
+    np.maximum.at(envelope, index, errors)
+    envelope[np.isinf(envelope)] = np.nan
+    return envelope.tolist()
+
+
+_worker_trajectories = {}
+
+
+def run_scenario(scenario, config):
+    """Fly one scenario offline
+
+    Returns: dict with the campaign config, the scenario, its Simulation.mission_score
+        metrics and its horizontal and vertical error envelopes
+    """
+    key = config['trajectory']
+    if key not in _worker_trajectories:
+        _worker_trajectories[key] = read_trajectory_file(key)
+    times, positions, yaws = _worker_trajectories[key]
+    trajectory = Trajectory(positions, times * scenario['time_mult'], yaws)
+
+    controller = NonlinearController()
+    controller.set_gains(**config['gains'])
+    result = dict(config=config, scenario=scenario)
+    try:
+        with np.errstate(all='ignore'):
+            sim = ScenarioSimulation(trajectory, scenario, controller=controller, **config['thresholds']).run()
+    except Exception as e:
+        # a diverging flight is a failed run, not a failed campaign
+        result['error'] = repr(e)
+        return result
+    result['metrics'] = sim.mission_score()
+    duration = trajectory.end_time - trajectory.start_time
+    recorder = sim.recorder
+    result['horizontal_envelope'] = error_envelope(recorder.times, recorder.horizontal_errors, duration)
+    result['vertical_envelope'] = error_envelope(recorder.times, recorder.vertical_errors, duration)
+    return result
+
+
+def load_results(filename, config):
+    """Results of the campaign config already in filename, keyed by run index"""
+    results = {}
+    if filename is None or not os.path.exists(filename):
+        return results
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                result = json.loads(line)
+                if result['config'] == config:
+                    results[result['scenario']['run']] = result
+    return results
+
+
+def run_campaign(scenarios, config, output=None, workers=None):
+    """Fly every scenario not already in output, in parallel
+
+    Each result is appended to output as soon as its run finishes, so an interrupted
+    campaign keeps its finished runs and resumes from them.
+
+    Args:
+        scenarios: list of sample_scenarios dicts
+        config: dict of trajectory (file name), gains (dict) and thresholds (Simulation
+            threshold keyword arguments), stored with every result
+        output: JSON lines file, None to keep the results in memory only
+        workers: number of processes, all CPU cores when None
+
+    Returns: list of results for all scenarios, in run order
+    """
+    results = load_results(output, config)
+    pending = [scenario for scenario in scenarios if scenario['run'] not in results]
+    if pending:
+        f = open(output, 'a') if output is not None else None
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run_scenario, scenario, config) for scenario in pending]
+                for done, future in enumerate(as_completed(futures), 1):
+                    result = future.result()
+                    results[result['scenario']['run']] = result
+                    if f is not None:
+                        f.write(json.dumps(result) + '\n')
+                        f.flush()
+                    if done % 100 == 0:
+                        print('{} of {} runs done'.format(done, len(pending)))
+        finally:
+            if f is not None:
+                f.close()
+    return [results[scenario['run']] for scenario in scenarios]
+
+
+def wilson_interval(failures, runs, z=1.96):
+    """95% confidence interval of a failure rate (Wilson score interval)"""
+    if runs == 0:
+        return 0.0, 1.0
+    rate = failures / runs
+    denominator = 1 + z * z / runs
+    center = (rate + z * z / (2 * runs)) / denominator
+    half_width = z * math.sqrt(rate * (1 - rate) / runs + z * z / (4 * runs * runs)) / denominator
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+
+def summarize(results, percentiles=DEFAULT_PERCENTILES, threshold_horizontal_error=DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+              threshold_vertical_error=DEFAULT_THRESHOLD_VERTICAL_ERROR, threshold_time=DEFAULT_THRESHOLD_TIME):
+    """Failure rate and percentiles over the runs of a campaign
+
+    Returns: dict of run and failure counts, failure rate with its 95% interval, the
+        number of runs over each threshold (a run may exceed several), metric
+        percentiles and per-bin percentile error envelopes
+    """
+    flown = [r for r in results if 'metrics' in r]
+    metrics = {name: np.array([r['metrics'][name] for r in flown], dtype=np.float64)
+               for name in ('maximum_horizontal_error', 'average_horizontal_error', 'maximum_vertical_error',
+                            'average_vertical_error', 'mission_time')}
+    success = np.array([r['metrics']['mission_success'] for r in flown], dtype=bool)
+    failures = len(results) - int(success.sum())
+    summary = dict(runs=len(results), failures=failures,
+                   failure_rate=failures / len(results) if results else 0.0,
+                   failure_rate_interval=wilson_interval(failures, len(results)),
+                   errors=len(results) - len(flown),
+                   over_horizontal_threshold=int(np.sum(
+                           metrics['maximum_horizontal_error'] > threshold_horizontal_error)),
+                   over_vertical_threshold=int(np.sum(metrics['maximum_vertical_error'] > threshold_vertical_error)),
+                   over_time_threshold=int(np.sum(metrics['mission_time'] > threshold_time)))
+    if flown:
+        summary['percentiles'] = {name: dict(zip(map(str, percentiles), np.percentile(values, percentiles).tolist()))
+                                  for name, values in metrics.items()}
+        for name in ('horizontal_envelope', 'vertical_envelope'):
+            envelopes = np.array([r[name] for r in flown], dtype=np.float64)
+            with np.errstate(all='ignore'):
+                summary[name] = {str(p): np.nanpercentile(envelopes, p, axis=0).tolist() for p in percentiles}
+    return summary
+
+
+def print_summary(summary):
+    low, high = summary['failure_rate_interval']
+    print('{} runs, {} failed ({:.1%}, 95% interval {:.1%} - {:.1%}), {} raised an error'.format(
+        summary['runs'], summary['failures'], summary['failure_rate'], low, high, summary['errors']))
+    print('over threshold: horizontal {}, vertical {}, time {}'.format(
+        summary['over_horizontal_threshold'], summary['over_vertical_threshold'], summary['over_time_threshold']))
+    if 'percentiles' not in summary:
+        return
+    names = list(summary['percentiles'])
+    percentiles = list(summary['percentiles'][names[0]])
+    print('{:<26s} '.format('metric') + ' '.join('{:>8s}'.format('p' + p.rstrip('0').rstrip('.'))
+                                                for p in percentiles))
+    for name in names:
+        print('{:<26s} '.format(name) + ' '.join('{:8.3f}'.format(v) for v in summary['percentiles'][name].values()))
+    for name in ('horizontal_envelope', 'vertical_envelope'):
+        print('{} by mission progress:'.format(name))
+        bins = len(next(iter(summary[name].values())))
+        print('{:>10s} '.format('progress') + ' '.join('{:>8s}'.format('p' + p.rstrip('0').rstrip('.'))
+                                                      for p in percentiles))
+        for i in range(bins):
+            print('{:9.0%}  '.format((i + 1) / bins) + ' '.join('{:8.3f}'.format(summary[name][p][i])
+                                                               for p in percentiles))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fly randomized scenarios offline and report robustness statistics')
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trajectory', type=str, default='test_trajectory.txt')
+    parser.add_argument('--gains', type=str, default=None, help='JSON gains, e.g. the best_gains.json of tuning.py')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', type=str, default='campaign.jsonl', help='per-run results, appended')
+    parser.add_argument('--summary', type=str, default=None, help='write the summary as JSON')
+    parser.add_argument('--threshold-horizontal', type=float, default=DEFAULT_THRESHOLD_HORIZONTAL_ERROR)
+    parser.add_argument('--threshold-vertical', type=float, default=DEFAULT_THRESHOLD_VERTICAL_ERROR)
+    parser.add_argument('--threshold-time', type=float, default=DEFAULT_THRESHOLD_TIME)
+    args = parser.parse_args()
+
+    campaign_gains = NonlinearController().gains()
+    if args.gains is not None:
+        with open(args.gains) as gains_file:
+            loaded = json.load(gains_file)
+        campaign_gains.update(loaded.get('gains', loaded))
+    thresholds = dict(threshold_horizontal_error=args.threshold_horizontal,
+                      threshold_vertical_error=args.threshold_vertical, threshold_time=args.threshold_time)
+    campaign_config = dict(trajectory=args.trajectory, seed=args.seed, gains=campaign_gains, thresholds=thresholds)
+    all_results = run_campaign(sample_scenarios(args.runs, seed=args.seed), campaign_config, args.output,
+                               args.workers)
+    campaign_summary = summarize(all_results, **thresholds)
+    print_summary(campaign_summary)
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(campaign_summary, f, indent=2)
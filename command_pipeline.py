@@ -0,0 +1,168 @@
+"""
+Outbound command path to the vehicle
+
+components:
+    latest-wins command slots, one per connection method
+    writer thread sending all pending commands in one batch
+    one writer thread shared by the pipelines of many connections
+    sent, superseded and failure counters
+"""
+import collections
+import threading
+
+# sent first within a batch: the moment command drives the vehicle, targets are only reported
+COMMAND_PRIORITY = ('cmd_moment', 'local_position_target', 'local_velocity_target', 'local_acceleration_target',
+                    'attitude_target', 'body_rate_target')
+
+
+class CommandPipeline(object):
+
+    def __init__(self, connection, priority=COMMAND_PRIORITY, wakeup=None):
+        """Send connection commands from a background thread, latest command wins
+
+        submit stores the arguments in the slot of the connection method and wakes the
+        writer, it never touches the socket. The writer takes every pending slot at once and
+        calls the connection for each (highest priority first), so a command superseded
+        before the writer got to it is never sent. Exceptions raised by the connection are
+        counted per command instead of propagating to the caller.
+
+        Args:
+            connection: udacidrone connection
+            priority: command names sent first within a batch, others follow in submit order
+            wakeup: threading.Event set on submit, that of a SharedCommandWriter flushing
+                this pipeline instead of a thread of its own
+        """
+        self.connection = connection
+        self._rank = {name: rank for rank, name in enumerate(priority)}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = wakeup if wakeup is not None else threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.submitted = collections.Counter()
+        self.sent = collections.Counter()
+        self.superseded = collections.Counter()
+        self.failures = collections.Counter()
+        self.last_error = None
+        self.batches = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='command-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, name, *args):
+        """Queue connection.<name>(*args), replacing a pending command of the same name"""
+        with self._lock:
+            if name in self._pending:
+                self.superseded[name] += 1
+            self._pending[name] = args
+        self.submitted[name] += 1
+        self._wakeup.set()
+
+    def send(self, name, *args):
+        """Call connection.<name>(*args) now, counting a failure instead of raising
+
+        Returns: True if the call succeeded
+        """
+        try:
+            getattr(self.connection, name)(*args)
+        except Exception as e:
+            self.failures[name] += 1
+            self.last_error = e
+            return False
+        self.sent[name] += 1
+        return True
+
+    def flush(self):
+        """Send every pending command on the calling thread
+
+        Returns: number of commands sent or failed
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        order = sorted(pending, key=lambda name: self._rank.get(name, len(self._rank)))
+        for name in order:
+            self.send(name, *pending[name])
+        self.batches += 1
+        return len(order)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the writer after sending the pending commands"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def summary(self):
+        names = sorted(set(self.submitted) | set(self.sent) | set(self.failures))
+        lines = ['{:<28s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('command', 'submitted', 'sent', 'superseded',
+                                                                  'failed')]
+        for name in names:
+            lines.append('{:<28s} {:10d} {:10d} {:10d} {:10d}'.format(
+                name, self.submitted[name], self.sent[name], self.superseded[name], self.failures[name]))
+        if self.last_error is not None:
+            lines.append('last error: {!r}'.format(self.last_error))
+        return '\n'.join(lines)
+
+
+class SharedCommandWriter(object):
+
+    def __init__(self, priority=COMMAND_PRIORITY):
+        """One writer thread sending the commands of many connections
+
+        Each pipeline made by pipeline() keeps its own latest-wins slots and counters, but
+        wakes this writer on submit, which then flushes every pipeline. However many
+        vehicles are flown, their commands cost a single thread.
+
+        Args:
+            priority: as for CommandPipeline
+        """
+        self.priority = priority
+        self.pipelines = []
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pipeline(self, connection):
+        """CommandPipeline of connection flushed by this writer (do not start it)"""
+        pipeline = CommandPipeline(connection, self.priority, wakeup=self._wakeup)
+        self.pipelines.append(pipeline)
+        return pipeline
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='shared-command-writer', daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        """Send the pending commands of every pipeline on the calling thread
+
+        Returns: number of commands sent or failed
+        """
+        return sum(pipeline.flush() for pipeline in self.pipelines)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the writer after sending the pending commands"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
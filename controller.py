@@ -6,14 +6,19 @@ components:
     gps commands and yaw
     waypoint following
 """
+import math
+
 import numpy as np
-from frame_utils import euler2RM
+from frame_utils import AttitudeCache, euler2RM_batch, quaternion_xy_block, quaternion_yaw, quaternion_z_column
 
 DRONE_MASS_KG = 0.5
 GRAVITY = -9.81
 MOI = np.array([0.005, 0.005, 0.01])
 MAX_THRUST = 10.0
 MAX_TORQUE = 1.0
+# scalar control gains, in the order used for gain vectors
+GAIN_NAMES = ('k_p_p', 'k_p_q', 'k_p_r', 'k_p_z', 'k_d_z', 'k_p_yaw', 'k_p_pitch', 'k_p_roll',
+              'k_p_x', 'k_d_x', 'k_p_y', 'k_d_y')
 
 
 class NonlinearController(object):
@@ -37,11 +42,62 @@ class NonlinearController(object):
         self.k_d_x = 3.0
         self.k_p_y = 4.2
         self.k_d_y = 3.0
+        self._update_gain_arrays()
+        # rotation matrix of the last attitude sample, shared by the attitude stages
+        self.attitude_cache = AttitudeCache()
+
+    def _update_gain_arrays(self):
         # gains arranged in numpy array form
-        self.k_p_body_rate = np.array([self.k_p_p, self.k_p_q, self.k_p_r], dtype=np.float)
-        self.k_p_pr = np.array([self.k_p_pitch, self.k_p_roll], dtype=np.float)
-        self.k_p_xy = np.array([self.k_p_x, self.k_p_y], dtype=np.float)
-        self.k_d_xy = np.array([self.k_d_x, self.k_d_y], dtype=np.float)
+        self.k_p_body_rate = np.array([self.k_p_p, self.k_p_q, self.k_p_r], dtype=np.float64)
+        self.k_p_pr = np.array([self.k_p_pitch, self.k_p_roll], dtype=np.float64)
+        self.k_p_xy = np.array([self.k_p_x, self.k_p_y], dtype=np.float64)
+        self.k_d_xy = np.array([self.k_d_x, self.k_d_y], dtype=np.float64)
+
+    def gains(self):
+        """Current scalar control gains
+
+        Returns: dict mapping each name in GAIN_NAMES to its value
+        """
+        return {name: getattr(self, name) for name in GAIN_NAMES}
+
+    def set_gains(self, **gains):
+        """Replace scalar control gains and rebuild the gain arrays
+
+        Args:
+            gains: keyword arguments named after GAIN_NAMES
+        """
+        for name, value in gains.items():
+            if name not in GAIN_NAMES:
+                raise ValueError('unknown gain: {}'.format(name))
+            setattr(self, name, value)
+        self._update_gain_arrays()
+
+    def rotation_matrix(self, attitude):
+        """Body-to-local rotation matrix for the attitude, from the attitude cache
+
+        The matrix is computed once per attitude sample. A quaternion attitude gives the
+        matrix without any trigonometry (frame_utils.quaternion2RM).
+
+        Args:
+            attitude: 3-element numpy array (roll,pitch,yaw) in radians, or a 4-element
+                quaternion (w,x,y,z)
+
+        Returns: 3x3 numpy array, reused by later calls (do not modify)
+        """
+        return self.attitude_cache.rotation_matrix(attitude)
+
+    def attitude_yaw(self, attitude):
+        """Yaw of the attitude in radians, the input yaw_control expects
+
+        Args:
+            attitude: 3-element numpy array (roll,pitch,yaw), or a 4-element quaternion
+                (w,x,y,z) whose yaw comes from frame_utils.quaternion_yaw
+
+        Returns: yaw in radians
+        """
+        if len(attitude) == 4:
+            return quaternion_yaw(attitude.tolist())
+        return attitude[2]
 
     def trajectory_control(self, position_trajectory, yaw_trajectory, time_trajectory, current_time):
         """Generate a commanded position, velocity and yaw based on the trajectory
@@ -115,12 +171,17 @@ class NonlinearController(object):
             vertical_velocity_cmd: desired vertical velocity (+up)
             altitude: vehicle vertical position (+up)
             vertical_velocity: vehicle vertical velocity (+up)
+            attitude: 3-element numpy array (roll,pitch,yaw) in radians, or a 4-element
+                quaternion (w,x,y,z), see rotation_matrix
             acceleration_ff: feedforward acceleration command (+up)
             
         Returns: thrust command for the vehicle (+up)
         """
-        rot_mat = euler2RM(*attitude)
-        b_z = rot_mat[2, 2]
+        if len(attitude) == 4:
+            # only R22 is needed, no need for the whole quaternion2RM
+            b_z = quaternion_z_column(attitude.tolist())[2]
+        else:
+            b_z = self.rotation_matrix(attitude)[2, 2]
 
         e_z = altitude_cmd - altitude
         e_z_dot = vertical_velocity_cmd - vertical_velocity
@@ -141,13 +202,20 @@ class NonlinearController(object):
         
         Args:
             target_acceleration: 2-element numpy array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
-            attitude: 3-element numpy array (roll,pitch,yaw) in radians
+            attitude: 3-element numpy array (roll,pitch,yaw) in radians, or a 4-element
+                quaternion (w,x,y,z)
             thrust_cmd: vehicle thruts command in Newton
             
         Returns: 2-element numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
         """
-        rot_mat = euler2RM(*attitude)
-        b = rot_mat[0:2, 2]
+        if len(attitude) == 4:
+            # the z column and the upper-left block, the bottom row of quaternion2RM is unused
+            q = attitude.tolist()
+            r02, r12, r22 = quaternion_z_column(q)
+            r00, r01, r10, r11 = quaternion_xy_block(q)
+        else:
+            r00, r01, r02, r10, r11, r12, _, _, r22 = self.rotation_matrix(attitude).ravel().tolist()
+        b = np.array([r02, r12])
         c_c = -thrust_cmd / DRONE_MASS_KG
 
         b_c = acceleration_cmd / c_c
@@ -157,11 +225,10 @@ class NonlinearController(object):
         # is b_x_c, which need pitching. b_y_c on the other hand, need rolling
         b_c_dot = self.k_p_pr * e_b
 
-        r = np.array([[rot_mat[1, 0], -rot_mat[0, 0]],
-                      [rot_mat[1, 1], -rot_mat[0, 1]]],
-                     dtype=np.float)
-
-        pq_c = np.dot(r, b_c_dot) / rot_mat[2, 2]
+        # pq_c = [[R10, -R00], [R11, -R01]] . b_c_dot / R22, written out so the
+        # result does not depend on the BLAS used for np.dot
+        pq_c = np.array([r10 * b_c_dot[0] - r00 * b_c_dot[1],
+                         r11 * b_c_dot[0] - r01 * b_c_dot[1]]) / r22
         # print(acceleration_cmd, b_c_dot)
         return pq_c
 
@@ -190,11 +257,109 @@ class NonlinearController(object):
         
         Returns: target yawrate in radians/sec
         """
-        # note: yaw must be within [-pi, pi)
-        yaw_cmd = np.fmod(yaw_cmd + np.pi, 2 * np.pi) - np.pi
+        # note: yaw must be within [-pi, pi), as given by attitude_yaw
+        yaw_cmd = math.fmod(yaw_cmd + math.pi, 2 * math.pi) - math.pi
         e_yaw = yaw_cmd - yaw
-        if np.abs(e_yaw) > np.pi:
+        if abs(e_yaw) > math.pi:
             direction = -1 if e_yaw > 0 else 1
             e_yaw = e_yaw + direction * 2 * np.pi
         # print("yaw_cmd: {}, yaw: {}, E_yaw: {}".format(yaw_cmd, yaw, e_yaw))
         return self.k_p_yaw * e_yaw
+
+
+class BatchNonlinearController(NonlinearController):
+    """NonlinearController evaluated for N states at once
+
+    Every method takes the arguments of the NonlinearController method of the same name
+    with a leading dimension N added, and returns the N results stacked, identical to
+    calling the scalar controller N times. lateral_position_control and body_rate_control
+    are inherited unchanged since they already broadcast over the leading dimension.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._rot_mats = np.empty((0, 3, 3))
+        self._rot_mats_attitude = None
+
+    def rotation_matrix(self, attitude):
+        """(N,3,3) body-to-local rotation matrices, computed once per attitude sample
+
+        Args:
+            attitude: (N,3) numpy array (roll,pitch,yaw) in radians
+
+        Returns: (N,3,3) numpy array, reused by later calls (do not modify)
+        """
+        attitude = np.asarray(attitude, dtype=np.float64)
+        if self._rot_mats_attitude is None or not np.array_equal(attitude, self._rot_mats_attitude):
+            if self._rot_mats.shape[0] != attitude.shape[0]:
+                self._rot_mats = np.empty((attitude.shape[0], 3, 3))
+            euler2RM_batch(attitude, out=self._rot_mats)
+            self._rot_mats_attitude = attitude.copy()
+        return self._rot_mats
+
+    def attitude_yaw(self, attitude):
+        """(N,) yaws of (N,3) Euler attitudes"""
+        return attitude[..., 2]
+
+    def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                         acceleration_ff=0.0):
+        """Generate vertical acceleration (thrust) commands
+
+        Args:
+            altitude_cmd: (N,) desired vertical positions (+up)
+            vertical_velocity_cmd: (N,) desired vertical velocities (+up)
+            altitude: (N,) vehicle vertical positions (+up)
+            vertical_velocity: (N,) vehicle vertical velocities (+up)
+            attitude: (N,3) vehicle attitudes (roll,pitch,yaw) in radians
+            acceleration_ff: scalar or (N,) feedforward acceleration command (+up)
+
+        Returns: (N,) thrust commands (+up)
+        """
+        b_z = self.rotation_matrix(attitude)[:, 2, 2]
+
+        e_z = altitude_cmd - altitude
+        e_z_dot = vertical_velocity_cmd - vertical_velocity
+        z_dot_dot_c = self.k_p_z * e_z + self.k_d_z * e_z_dot + acceleration_ff
+        c_c = z_dot_dot_c / b_z
+        thrust = c_c * DRONE_MASS_KG
+        return np.clip(thrust, 0.1, MAX_THRUST)
+
+    def roll_pitch_controller(self, acceleration_cmd, attitude, thrust_cmd):
+        """Generate the rollrate and pitchrate commands in the body frame
+
+        Args:
+            acceleration_cmd: (N,2) numpy array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
+            attitude: (N,3) numpy array (roll,pitch,yaw) in radians
+            thrust_cmd: (N,) vehicle thrust commands in Newton
+
+        Returns: (N,2) numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
+        """
+        rot_mat = self.rotation_matrix(attitude)
+        b = rot_mat[:, 0:2, 2]
+        c_c = -np.asarray(thrust_cmd) / DRONE_MASS_KG
+
+        b_c = acceleration_cmd / c_c[:, np.newaxis]
+
+        e_b = b_c - b
+        b_c_dot = self.k_p_pr * e_b
+
+        pq_c = np.empty((rot_mat.shape[0], 2))
+        pq_c[:, 0] = rot_mat[:, 1, 0] * b_c_dot[:, 0] - rot_mat[:, 0, 0] * b_c_dot[:, 1]
+        pq_c[:, 1] = rot_mat[:, 1, 1] * b_c_dot[:, 0] - rot_mat[:, 0, 1] * b_c_dot[:, 1]
+        pq_c /= rot_mat[:, 2, 2, np.newaxis]
+        return pq_c
+
+    def yaw_control(self, yaw_cmd, yaw):
+        """Generate the target yawrates
+
+        Args:
+            yaw_cmd: (N,) desired vehicle yaws in radians
+            yaw: (N,) vehicle yaws in radians
+
+        Returns: (N,) target yawrates in radians/sec
+        """
+        yaw_cmd = np.fmod(yaw_cmd + np.pi, 2 * np.pi) - np.pi
+        e_yaw = yaw_cmd - yaw
+        direction = np.where(e_yaw > 0, -1, 1)
+        e_yaw = np.where(np.abs(e_yaw) > np.pi, e_yaw + direction * 2 * np.pi, e_yaw)
+        return self.k_p_yaw * e_yaw
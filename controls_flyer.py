@@ -5,6 +5,7 @@ This is the solution of the backyard flyer script,
 modified for all the changes required to get it working for controls.
 """
 
+import argparse
 import time
 from enum import Enum
 
@@ -12,10 +13,14 @@ import numpy as np
 
 from udacidrone import Drone
 from unity_drone import UnityDrone
-from controller import NonlinearController
+from controller import NonlinearController, DRONE_MASS_KG, GRAVITY
+from frame_utils import euler2quaternion
+from flight_log import DEFAULT_FLIGHT_LOG_DIR, BackgroundFlightLogWriter
+from instrumentation import Instrumentation
+from scheduler import ControlScheduler
+from trajectory import load_trajectory
 from udacidrone.connection import MavlinkConnection  # noqa: F401
 from udacidrone.messaging import MsgID
-from visualize_utils import visualize_planned_trajectory
 
 class States(Enum):
     MANUAL = 0
@@ -26,13 +31,42 @@ class States(Enum):
     DISARMING = 5
 
 
+# NonlinearController methods timed when instrumentation is enabled
+INSTRUMENTED_STAGES = ('lateral_position_control', 'altitude_control', 'roll_pitch_controller',
+                       'yaw_control', 'body_rate_control')
+
+
 class ControlsFlyer(UnityDrone):
 
-    def __init__(self, connection):
-        super().__init__(connection)
-        self.controller = NonlinearController()
+    def __init__(self, connection, instrument=False, use_visdom=False, scheduled=False, position_rate=50.0,
+                 attitude_rate=100.0, body_rate_rate=500.0, flight_log_dir=DEFAULT_FLIGHT_LOG_DIR, controller=None,
+                 flight_log=None, quaternion_attitude=False, **kwargs):
+        """
+        Args:
+            connection: udacidrone connection to the simulator
+            instrument: record latency histograms of the callbacks and controller stages
+            use_visdom: plot the errors live on a local visdom server
+            scheduled: run the controllers from a ControlScheduler at the given rates instead
+                of from the LOCAL_VELOCITY, ATTITUDE and RAW_GYROSCOPE callbacks
+            position_rate, attitude_rate, body_rate_rate: scheduled loop rates in Hz
+            flight_log_dir: directory of the binary flight log
+            flight_log: flight log to write instead of a BackgroundFlightLogWriter of
+                flight_log_dir, e.g. a SharedFlightLog (flight_log_dir is then unused)
+            controller: NonlinearController (or FastNonlinearController), a default one when None
+            quaternion_attitude: hand the controller the attitude as a unit quaternion (w,x,y,z),
+                converted from the Euler angles the simulator reports once per attitude tick
+            kwargs: passed to UnityDrone
+        """
+        super().__init__(connection, use_visdom=use_visdom, **kwargs)
+        self.controller = controller if controller is not None else NonlinearController()
+        self.quaternion_attitude = quaternion_attitude
+        # opt-in latency histograms; when disabled nothing is wrapped
+        self.instrumentation = Instrumentation() if instrument else None
+        if self.instrumentation is not None:
+            self.instrumentation.instrument_methods(self.controller, INSTRUMENTED_STAGES, 'controller.')
         self.target_position = np.array([0.0, 0.0, 0.0])
-        self.all_waypoints = []
+        # hover thrust until the first attitude_controller run
+        self.thrust_cmd = DRONE_MASS_KG * -GRAVITY
         self.in_mission = True
         self.check_state = {}
 
@@ -41,90 +75,150 @@ class ControlsFlyer(UnityDrone):
 
         # register all your callbacks here
         self.register_callback(MsgID.LOCAL_POSITION,
-                               self.local_position_callback)
-        self.register_callback(MsgID.LOCAL_VELOCITY, self.velocity_callback)
+                               self._callback('local_position_callback'))
+        self.register_callback(MsgID.LOCAL_VELOCITY, self._callback('velocity_callback'))
         self.register_callback(MsgID.STATE, self.state_callback)
         
-        self.register_callback(MsgID.ATTITUDE, self.attitude_callback)
-        self.register_callback(MsgID.RAW_GYROSCOPE, self.gyro_callback)
+        self.register_callback(MsgID.ATTITUDE, self._callback('attitude_callback'))
+        self.register_callback(MsgID.RAW_GYROSCOPE, self._callback('gyro_callback'))
+
+        # fixed-rate control loops on a monotonic clock; the callbacks only update state then
+        self.scheduler = None
+        # clock of the trajectory, the scheduler and the mission score (see UnityDrone)
+        self.clock = time.time
+        # run the controllers from the telemetry callbacks (False when a scheduler or a Fleet runs them)
+        self.callback_control = not scheduled
+        if scheduled:
+            self.scheduler = ControlScheduler(base_rate=body_rate_rate)
+            self.clock = self.scheduler.clock
+            self.scheduler.add_stage('position_controller', self._stage('position_controller'), position_rate)
+            self.scheduler.add_stage('attitude_controller', self._stage('attitude_controller'), attitude_rate)
+            self.scheduler.add_stage('bodyrate_controller', self._stage('bodyrate_controller'), body_rate_rate)
+
+        # trajectory parsed ahead of time (times relative to its start), see preload_trajectory
+        self.planned_trajectory = None
 
         # flight history
-        self.target_traj = []
-        self.actual_traj = []
-        self.traj_t = []
-        self.target_v = []
-        self.actual_v = []
-        self.v_t = []
-
-    def position_controller(self):  
+        self.flight_log = flight_log if flight_log is not None else BackgroundFlightLogWriter(flight_log_dir)
+        # the scored samples, so scoring.py re-computes the live mission score
+        self.error_log = self.flight_log.error
+
+    def _callback(self, name):
+        callback = getattr(self, name)
+        if self.instrumentation is not None:
+            callback = self.instrumentation.wrap(name, callback)
+        return callback
+
+    def _stage(self, name):
+        controller = getattr(self, name)
+        if self.instrumentation is not None:
+            controller = self.instrumentation.wrap('scheduled.' + name, controller)
+
+        def stage(t):
+            if self.flight_state == States.WAYPOINT:
+                controller(t)
+        return stage
+
+    def print_mission_score(self):
+        super().print_mission_score()
+        if self.instrumentation is not None:
+            print('Control loop latency (us):')
+            print(self.instrumentation.summary())
+        if self.scheduler is not None:
+            print('Control scheduler:')
+            print(self.scheduler.summary())
+        print('Commands:')
+        print(self.commands.summary())
+
+    @property
+    def acceleration_ff(self):
+        """Feedforward acceleration of the current trajectory sample (a view of self.state)"""
+        return self.state.acceleration_ff
+
+    @acceleration_ff.setter
+    def acceleration_ff(self, acceleration):
+        self.state.acceleration_ff[:] = acceleration
+
+    # the stages capture the sensor values they use into self.state once and then only read
+    # self.state, so every controller call within a stage sees the same vehicle state
+    def position_controller(self, current_time=None):
+        if current_time is None:
+            current_time = self.clock()
+        state = self.state
+        state.local_position[:] = self.local_position
+        state.local_velocity[:] = self.local_velocity
         (self.local_position_target,
          self.local_velocity_target,
-         yaw_cmd) = self.controller.trajectory_control(
-                 self.position_trajectory,
-                 self.yaw_trajectory,
-                 self.time_trajectory, time.time())
-        self.attitude_target = np.array((0.0, 0.0, yaw_cmd))
+         state.acceleration_ff[:],
+         yaw_cmd) = self.trajectory.evaluate(current_time)
+        self.attitude_target = (0.0, 0.0, yaw_cmd)
         acceleration_cmd = self.controller.lateral_position_control(
-                self.local_position_target[0:2],
-                self.local_velocity_target[0:2],
-                self.local_position[0:2],
-                self.local_velocity[0:2])
-        self.local_acceleration_target = np.array([acceleration_cmd[0],
-                                                   acceleration_cmd[1],
-                                                   0.0])
-
-    def attitude_controller(self):
+                state.local_position_target[0:2],
+                state.local_velocity_target[0:2],
+                state.local_position[0:2],
+                state.local_velocity[0:2],
+                state.acceleration_ff[0:2])
+        self.local_acceleration_target = (acceleration_cmd[0], acceleration_cmd[1], 0.0)
+
+    def attitude_controller(self, current_time=None):
+        state = self.state
+        state.local_position[:] = self.local_position
+        state.local_velocity[:] = self.local_velocity
+        state.attitude[:] = self.attitude
+        attitude = state.attitude
+        if self.quaternion_attitude:
+            attitude = euler2quaternion(*attitude.tolist(), out=state.attitude_quaternion)
         self.thrust_cmd = self.controller.altitude_control(
-                -self.local_position_target[2],
-                -self.local_velocity_target[2],
-                -self.local_position[2],
-                -self.local_velocity[2],
-                self.attitude,
-                9.81)
+                -state.local_position_target[2],
+                -state.local_velocity_target[2],
+                -state.local_position[2],
+                -state.local_velocity[2],
+                attitude,
+                9.81 - state.acceleration_ff[2])
         roll_pitch_rate_cmd = self.controller.roll_pitch_controller(
-                self.local_acceleration_target[0:2],
-                self.attitude,
+                state.local_acceleration_target[0:2],
+                attitude,
                 self.thrust_cmd)
         yawrate_cmd = self.controller.yaw_control(
-                self.attitude_target[2],
-                self.attitude[2])
-        self.body_rate_target = np.array(
-                [roll_pitch_rate_cmd[0], roll_pitch_rate_cmd[1], yawrate_cmd])
+                state.attitude_target[2],
+                self.controller.attitude_yaw(attitude))
+        self.body_rate_target = (roll_pitch_rate_cmd[0], roll_pitch_rate_cmd[1], yawrate_cmd)
 
-    def bodyrate_controller(self):
+    def bodyrate_controller(self, current_time=None):
+        state = self.state
+        state.body_rate[:] = self.gyro_raw
         moment_cmd = self.controller.body_rate_control(
-                self.body_rate_target,
-                self.gyro_raw)
+                state.body_rate_target,
+                state.body_rate)
         self.cmd_moment(moment_cmd[0],
                         moment_cmd[1],
                         moment_cmd[2],
                         self.thrust_cmd)
 
     def attitude_callback(self):
-        if self.flight_state == States.WAYPOINT:
+        if self.flight_state == States.WAYPOINT and self.callback_control:
             self.attitude_controller()
 
     def gyro_callback(self):
-        if self.flight_state == States.WAYPOINT:
+        if self.flight_state == States.WAYPOINT and self.callback_control:
             self.bodyrate_controller()
 
     def local_position_callback(self):
         if self.flight_state == States.TAKEOFF:
             if -1.0 * self.local_position[2] > 0.95 * self.target_position[2]:
                 #self.all_waypoints = self.calculate_box()
-                (self.position_trajectory,
-                 self.time_trajectory,
-                 self.yaw_trajectory) = self.load_test_trajectory(time_mult=0.5)
-                self.all_waypoints = self.position_trajectory.copy()
+                if self.planned_trajectory is None:
+                    self.preload_trajectory()
+                self.trajectory = self.planned_trajectory.shifted(self.clock())
+                # waypoint_number is a cursor into the trajectory, waypoints are never copied
                 self.waypoint_number = -1
                 self.waypoint_transition()
         elif self.flight_state == States.WAYPOINT:
-            t = time.time()
-            self.traj_t.append(t)
-            self.target_traj.append(self.local_position_target)
-            self.actual_traj.append(self.local_position)
-            if time.time() > self.time_trajectory[self.waypoint_number]:
-                if len(self.all_waypoints) > 0:
+            t = self.clock()
+            # the log is written on another thread, it gets a copy of the live target view
+            self.flight_log.position.append(t, self.local_position_target.copy(), self.local_position)
+            if t > self.trajectory.waypoint(self.waypoint_number)[0]:
+                if self.trajectory.has_waypoint(self.waypoint_number + 1):
                     self.waypoint_transition()
                 else:
                     if np.linalg.norm(self.local_velocity[0:2]) < 1.0:
@@ -137,11 +231,10 @@ class ControlsFlyer(UnityDrone):
                     self.disarming_transition()
         if self.flight_state == States.WAYPOINT:
             # print("target v: {}, actual v: {}".format(np.linalg.norm(self.local_velocity_target), np.linalg.norm(self.local_velocity)))
-            t = time.time()
-            self.v_t.append(t)
-            self.target_v.append(self.local_velocity_target)
-            self.actual_v.append(self.local_velocity)
-            self.position_controller()
+            t = self.clock()
+            self.flight_log.velocity.append(t, self.local_velocity_target.copy(), self.local_velocity)
+            if self.callback_control:
+                self.position_controller(t)
 
     def state_callback(self):
         if self.in_mission:
@@ -154,6 +247,16 @@ class ControlsFlyer(UnityDrone):
                 if ~self.armed & ~self.guided:
                     self.manual_transition()
 
+    def preload_trajectory(self, filename='test_trajectory.txt', time_mult=0.5, spline=False, stream=False):
+        """Parse the mission trajectory before flight, so the TAKEOFF to WAYPOINT
+        transition only has to shift its times to the current time
+
+        With spline set, the trajectory is a SplineTrajectory whose acceleration is fed
+        forward to the position and altitude loops. With stream set, it is a
+        StreamingTrajectory reading the file in chunks during the flight, for missions too
+        long to hold in memory; the file is opened and its first chunk read here."""
+        self.planned_trajectory = load_trajectory(filename, time_mult=time_mult, spline=spline, stream=stream)
+
     def calculate_box(self):
         print("Setting Home")
         local_waypoints = [[10.0, 0.0, -3.0],
@@ -183,7 +286,7 @@ class ControlsFlyer(UnityDrone):
     def waypoint_transition(self):
         #print("waypoint transition")
         self.waypoint_number = self.waypoint_number + 1
-        self.target_position = self.all_waypoints.pop(0)
+        self.target_position = self.trajectory.waypoint(self.waypoint_number)[1]
         self.flight_state = States.WAYPOINT
 
     def landing_transition(self):
@@ -204,11 +307,9 @@ class ControlsFlyer(UnityDrone):
         self.flight_state = States.MANUAL
 
     def write_flight_log(self):
-        import pickle
-        logs = [self.traj_t, self.target_traj, self.actual_traj,
-                self.v_t, self.target_v, self.actual_v]
-        with open('flight_log', 'wb') as f:
-            pickle.dump(logs, f)
+        self.flight_log.close()
+        print('Flight log: {} records written, {} dropped, max queue depth {}'.format(
+            self.flight_log.written, self.flight_log.dropped, self.flight_log.queue.max_depth))
 
     def start(self):
         self.start_log("Logs", "NavLog.txt")
@@ -216,6 +317,11 @@ class ControlsFlyer(UnityDrone):
 
         print("starting connection")
         # self.connection.start()
+        if self.planned_trajectory is None:
+            self.preload_trajectory()
+        self.flight_log.start()
+        if self.scheduler is not None:
+            self.scheduler.start()
 
         super().start()
 
@@ -223,14 +329,45 @@ class ControlsFlyer(UnityDrone):
         # while self.in_mission:
         #    pass
 
+        if self.scheduler is not None:
+            self.scheduler.stop()
         self.stop_log()
         self.write_flight_log()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instrument', action='store_true', help='record control loop latency histograms')
+    parser.add_argument('--trajectory', type=str, default='test_trajectory.txt')
+    parser.add_argument('--time-mult', type=float, default=0.5)
+    parser.add_argument('--spline', action='store_true', help='spline trajectory with acceleration feedforward')
+    parser.add_argument('--stream', action='store_true', help='read the trajectory file in chunks while flying')
+    parser.add_argument('--visdom', action='store_true', help='plot the errors live on a local visdom server')
+    parser.add_argument('--telemetry-file', type=str, default=None,
+                        help='write the live errors as JSON lines (the fallback of --visdom)')
+    parser.add_argument('--scheduled', action='store_true', help='run the control loops at fixed rates')
+    parser.add_argument('--fast', action='store_true', help='use the fused scalar FastNonlinearController')
+    parser.add_argument('--quaternion', action='store_true', help='control with quaternion attitudes')
+    parser.add_argument('--position-rate', type=float, default=50.0)
+    parser.add_argument('--attitude-rate', type=float, default=100.0)
+    parser.add_argument('--body-rate-rate', type=float, default=500.0)
+    args = parser.parse_args()
+    if args.fast:
+        # only imported when asked for: it compiles its kernels with numba if installed
+        from fast_controller import FastNonlinearController
+        main_controller = FastNonlinearController()
+    else:
+        main_controller = None
+
     conn = MavlinkConnection('tcp:127.0.0.1:5760', threaded=False, PX4=False)
     #conn = WebSocketConnection('ws://127.0.0.1:5760')
-    drone = ControlsFlyer(conn)
+    drone = ControlsFlyer(conn, instrument=args.instrument, use_visdom=args.visdom,
+                          telemetry_file=args.telemetry_file, scheduled=args.scheduled,
+                          position_rate=args.position_rate, attitude_rate=args.attitude_rate,
+                          body_rate_rate=args.body_rate_rate,
+                          controller=main_controller, quaternion_attitude=args.quaternion)
+    drone.preload_trajectory(args.trajectory, time_mult=args.time_mult, spline=args.spline,
+                            stream=args.stream)
     time.sleep(2)
     drone.start()
     drone.print_mission_score()
@@ -0,0 +1,243 @@
+"""
+Fused scalar control cascade
+
+components:
+    float-only kernels of the NonlinearController stages
+    one-call cascade from trajectory targets to moment commands
+    optional numba compilation of the kernels, on first use
+
+The kernels do the same IEEE operations in the same order as the numpy methods of
+NonlinearController, so their results are bit-identical to them, without the numpy
+dispatch cost of 2- and 3-element arrays.
+"""
+import math
+
+import numpy as np
+
+from controller import NonlinearController, DRONE_MASS_KG, MAX_THRUST, MAX_TORQUE, MOI
+
+# 'numba' or 'python', set by compile_kernels when the first FastNonlinearController is made
+BACKEND = None
+
+_MOI_X, _MOI_Y, _MOI_Z = MOI.tolist()
+
+
+def _clip(value, low, high):
+    # np.clip for a scalar
+    return min(max(value, low), high)
+
+
+# C fmod; numba has no math.fmod, so compile_kernels replaces it with _compiled_fmod
+_fmod = math.fmod
+
+
+def _compiled_fmod(x, y):
+    return np.fmod(x, y)
+
+
+def _lateral_kernel(k_p_x, k_d_x, k_p_y, k_d_y, north_cmd, east_cmd, north_velocity_cmd, east_velocity_cmd,
+                    north, east, north_velocity, east_velocity, north_ff, east_ff):
+    acceleration_north = k_p_x * (north_cmd - north) + k_d_x * (north_velocity_cmd - north_velocity) + north_ff
+    acceleration_east = k_p_y * (east_cmd - east) + k_d_y * (east_velocity_cmd - east_velocity) + east_ff
+    return acceleration_north, acceleration_east
+
+
+def _altitude_kernel(k_p_z, k_d_z, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, r22,
+                     acceleration_ff):
+    z_dot_dot_c = k_p_z * (altitude_cmd - altitude) + k_d_z * (vertical_velocity_cmd - vertical_velocity) + \
+        acceleration_ff
+    return _clip(z_dot_dot_c / r22 * DRONE_MASS_KG, 0.1, MAX_THRUST)
+
+
+def _roll_pitch_kernel(k_p_pitch, k_p_roll, acceleration_north, acceleration_east, roll, pitch, yaw, thrust_cmd):
+    # the entries of frame_utils.euler2RM used by the controller
+    cr = math.cos(roll)
+    sr = math.sin(roll)
+    cp = math.cos(pitch)
+    sp = math.sin(pitch)
+    cy = math.cos(yaw)
+    sy = math.sin(yaw)
+    r00 = cp * cy
+    r01 = -cr * sy + sr * sp * cy
+    r02 = sr * sy + cr * sp * cy
+    r10 = cp * sy
+    r11 = cr * cy + sr * sp * sy
+    r12 = -sr * cy + cr * sp * sy
+    r22 = cr * cp
+
+    c_c = -thrust_cmd / DRONE_MASS_KG
+    b_x_c_dot = k_p_pitch * (acceleration_north / c_c - r02)
+    b_y_c_dot = k_p_roll * (acceleration_east / c_c - r12)
+    return (r10 * b_x_c_dot - r00 * b_y_c_dot) / r22, (r11 * b_x_c_dot - r01 * b_y_c_dot) / r22
+
+
+def _yaw_kernel(k_p_yaw, yaw_cmd, yaw):
+    yaw_cmd = _fmod(yaw_cmd + math.pi, 2 * math.pi) - math.pi
+    e_yaw = yaw_cmd - yaw
+    if abs(e_yaw) > math.pi:
+        direction = -1 if e_yaw > 0 else 1
+        e_yaw = e_yaw + direction * 2 * math.pi
+    return k_p_yaw * e_yaw
+
+
+def _body_rate_kernel(k_p_p, k_p_q, k_p_r, p_cmd, q_cmd, r_cmd, p, q, r):
+    return (_clip(_MOI_X * (k_p_p * (p_cmd - p)), -MAX_TORQUE, MAX_TORQUE),
+            _clip(_MOI_Y * (k_p_q * (q_cmd - q)), -MAX_TORQUE, MAX_TORQUE),
+            _clip(_MOI_Z * (k_p_r * (r_cmd - r)), -MAX_TORQUE, MAX_TORQUE))
+
+
+def _attitude_kernel(k_p_z, k_d_z, k_p_pitch, k_p_roll, k_p_yaw, altitude_cmd, vertical_velocity_cmd, altitude,
+                     vertical_velocity, acceleration_ff, acceleration_north, acceleration_east, yaw_cmd, roll,
+                     pitch, yaw):
+    r22 = math.cos(roll) * math.cos(pitch)
+    thrust = _altitude_kernel(k_p_z, k_d_z, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, r22,
+                              acceleration_ff)
+    p_cmd, q_cmd = _roll_pitch_kernel(k_p_pitch, k_p_roll, acceleration_north, acceleration_east, roll, pitch, yaw,
+                                      thrust)
+    return thrust, p_cmd, q_cmd, _yaw_kernel(k_p_yaw, yaw_cmd, yaw)
+
+
+def _cascade_kernel(k_p_p, k_p_q, k_p_r, k_p_z, k_d_z, k_p_yaw, k_p_pitch, k_p_roll, k_p_x, k_d_x, k_p_y, k_d_y,
+                    north_cmd, east_cmd, down_cmd, north_velocity_cmd, east_velocity_cmd, down_velocity_cmd,
+                    north_ff, east_ff, down_ff, yaw_cmd, north, east, down, north_velocity, east_velocity,
+                    down_velocity, roll, pitch, yaw, p, q, r):
+    acceleration_north, acceleration_east = _lateral_kernel(
+            k_p_x, k_d_x, k_p_y, k_d_y, north_cmd, east_cmd, north_velocity_cmd, east_velocity_cmd, north, east,
+            north_velocity, east_velocity, north_ff, east_ff)
+    thrust, p_cmd, q_cmd, r_cmd = _attitude_kernel(
+            k_p_z, k_d_z, k_p_pitch, k_p_roll, k_p_yaw, -down_cmd, -down_velocity_cmd, -down, -down_velocity,
+            9.81 - down_ff, acceleration_north, acceleration_east, yaw_cmd, roll, pitch, yaw)
+    tau_x, tau_y, tau_z = _body_rate_kernel(k_p_p, k_p_q, k_p_r, p_cmd, q_cmd, r_cmd, p, q, r)
+    return tau_x, tau_y, tau_z, thrust, acceleration_north, acceleration_east, p_cmd, q_cmd, r_cmd
+
+
+def compile_kernels(use_numba=True):
+    """Replace the kernels with numba compiled ones, once per process
+
+    numba is only imported here, so importing this module stays cheap. The kernels are
+    compiled without fastmath, which keeps the results bit-identical to the Python ones.
+
+    Args:
+        use_numba: False to keep the Python kernels even if numba is installed
+
+    Returns: BACKEND, the kernels in use
+    """
+    global BACKEND, _clip, _fmod, _lateral_kernel, _altitude_kernel, _roll_pitch_kernel, _yaw_kernel, \
+        _body_rate_kernel, _attitude_kernel, _cascade_kernel
+    if BACKEND is not None:
+        return BACKEND
+    BACKEND = 'python'
+    if not use_numba:
+        return BACKEND
+    try:
+        from numba import njit
+    except ImportError:
+        return BACKEND
+    # kernels calling each other resolve these globals when first compiled, so all are replaced first
+    _clip = njit(cache=True)(_clip)
+    _fmod = njit(cache=True)(_compiled_fmod)
+    _lateral_kernel = njit(cache=True)(_lateral_kernel)
+    _altitude_kernel = njit(cache=True)(_altitude_kernel)
+    _roll_pitch_kernel = njit(cache=True)(_roll_pitch_kernel)
+    _yaw_kernel = njit(cache=True)(_yaw_kernel)
+    _body_rate_kernel = njit(cache=True)(_body_rate_kernel)
+    _attitude_kernel = njit(cache=True)(_attitude_kernel)
+    _cascade_kernel = njit(cache=True)(_cascade_kernel)
+    BACKEND = 'numba'
+    return BACKEND
+
+
+class FastNonlinearController(NonlinearController):
+    """NonlinearController computed with the float-only kernels
+
+    The stage methods keep the NonlinearController signatures and return the same values.
+    cascade runs a whole control tick, position targets to moments, in one call. The
+    kernels are compiled with numba when it is installed and the first instance is made
+    (see compile_kernels), and run as plain Python otherwise.
+
+    The kernels compute their sines and cosines inline, the attitude cache is not used.
+    Quaternion attitudes are handed to the NonlinearController
+    stages, cascade takes Euler angles only.
+    """
+
+    def __init__(self, use_numba=True):
+        """
+        Args:
+            use_numba: passed to compile_kernels, it only matters for the first instance
+        """
+        compile_kernels(use_numba)
+        super().__init__()
+
+    def _update_gain_arrays(self):
+        super()._update_gain_arrays()
+        self._gains = tuple(float(getattr(self, name)) for name in (
+            'k_p_p', 'k_p_q', 'k_p_r', 'k_p_z', 'k_d_z', 'k_p_yaw', 'k_p_pitch', 'k_p_roll', 'k_p_x', 'k_d_x',
+            'k_p_y', 'k_d_y'))
+
+    def lateral_position_control(self, local_position_cmd, local_velocity_cmd, local_position, local_velocity,
+                                 acceleration_ff=np.array([0.0, 0.0])):
+        """As NonlinearController.lateral_position_control"""
+        g = self._gains
+        north_cmd, east_cmd = local_position_cmd[0:2].tolist()
+        north_velocity_cmd, east_velocity_cmd = local_velocity_cmd[0:2].tolist()
+        north, east = local_position[0:2].tolist()
+        north_velocity, east_velocity = local_velocity[0:2].tolist()
+        north_ff, east_ff = acceleration_ff[0:2].tolist()
+        return np.array(_lateral_kernel(g[8], g[9], g[10], g[11], north_cmd, east_cmd, north_velocity_cmd,
+                                        east_velocity_cmd, north, east, north_velocity, east_velocity, north_ff,
+                                        east_ff))
+
+    def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                         acceleration_ff=0.0):
+        """As NonlinearController.altitude_control"""
+        if len(attitude) == 4:
+            return super().altitude_control(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity,
+                                            attitude, acceleration_ff)
+        roll, pitch, _ = attitude.tolist()
+        return _altitude_kernel(self._gains[3], self._gains[4], float(altitude_cmd), float(vertical_velocity_cmd),
+                                float(altitude), float(vertical_velocity), math.cos(roll) * math.cos(pitch),
+                                float(acceleration_ff))
+
+    def roll_pitch_controller(self, acceleration_cmd, attitude, thrust_cmd):
+        """As NonlinearController.roll_pitch_controller"""
+        if len(attitude) == 4:
+            return super().roll_pitch_controller(acceleration_cmd, attitude, thrust_cmd)
+        acceleration_north, acceleration_east = acceleration_cmd[0:2].tolist()
+        roll, pitch, yaw = attitude.tolist()
+        return np.array(_roll_pitch_kernel(self._gains[6], self._gains[7], acceleration_north, acceleration_east,
+                                           roll, pitch, yaw, float(thrust_cmd)))
+
+    def yaw_control(self, yaw_cmd, yaw):
+        """As NonlinearController.yaw_control"""
+        return _yaw_kernel(self._gains[5], float(yaw_cmd), float(yaw))
+
+    def body_rate_control(self, body_rate_cmd, body_rate):
+        """As NonlinearController.body_rate_control"""
+        p_cmd, q_cmd, r_cmd = body_rate_cmd.tolist()
+        p, q, r = body_rate.tolist()
+        return np.array(_body_rate_kernel(self._gains[0], self._gains[1], self._gains[2], p_cmd, q_cmd, r_cmd,
+                                          p, q, r))
+
+    def cascade(self, local_position_cmd, local_velocity_cmd, acceleration_ff, yaw_cmd, local_position,
+                local_velocity, attitude, body_rate):
+        """One full control tick, as ControlsFlyer runs the stages
+
+        lateral_position_control, altitude_control (with 9.81 - the down feedforward),
+        roll_pitch_controller, yaw_control and body_rate_control in one call.
+
+        Args:
+            local_position_cmd, local_velocity_cmd, acceleration_ff: 3-element NED targets
+            yaw_cmd: desired yaw in radians
+            local_position, local_velocity: 3-element NED vehicle state
+            attitude: 3-element numpy array (roll,pitch,yaw) in radians
+            body_rate: 3-element numpy array (p,q,r) in radians/second
+
+        Returns: tuple (3-element moment command, thrust command, 2-element acceleration
+            command, 3-element body rate command)
+        """
+        tau_x, tau_y, tau_z, thrust, acceleration_north, acceleration_east, p_cmd, q_cmd, r_cmd = _cascade_kernel(
+                *self._gains, *local_position_cmd.tolist(), *local_velocity_cmd.tolist(), *acceleration_ff.tolist(),
+                float(yaw_cmd), *local_position.tolist(), *local_velocity.tolist(), *attitude.tolist(),
+                *body_rate.tolist())
+        return (np.array([tau_x, tau_y, tau_z]), thrust, np.array([acceleration_north, acceleration_east]),
+                np.array([p_cmd, q_cmd, r_cmd]))
@@ -0,0 +1,315 @@
+"""
+Many vehicles flown from one process
+
+components:
+    per-vehicle mission state machines (ControlsFlyer without its own control loops)
+    one fixed-rate scheduler running BatchNonlinearController over every flying vehicle
+    a fixed pool of reader threads multiplexing the MAVLink sockets of all vehicles
+    one command writer and one flight log writer thread shared by all vehicles
+    aggregated mission scores
+"""
+import argparse
+import collections
+import os
+import selectors
+import threading
+import time
+
+import numpy as np
+
+from command_pipeline import SharedCommandWriter
+from controller import BatchNonlinearController
+from controls_flyer import ControlsFlyer, States
+from flight_log import DEFAULT_FLIGHT_LOG_DIR, BackgroundFlightLogWriter
+from scheduler import ControlScheduler
+from udacidrone.connection import MavlinkConnection
+
+
+def vehicle_score(vehicle):
+    """Autograder metrics of one vehicle, as in Simulation.mission_score"""
+    recorder = vehicle._error_recorder
+    return dict(maximum_horizontal_error=float(recorder.maximum_horizontal_error),
+                average_horizontal_error=float(recorder.average_horizontal_error),
+                maximum_vertical_error=float(recorder.maximum_vertical_error),
+                average_vertical_error=float(recorder.average_vertical_error),
+                mission_time=float(recorder.mission_time),
+                mission_success=bool(vehicle._mission_success))
+
+
+def aggregate_scores(scores):
+    """Fleet-wide summary of vehicle_score results
+
+    Returns: dict with the vehicle count, successes, worst maximum errors and mission
+        time, and the mean of the average errors
+    """
+    if not scores:
+        return dict(vehicles=0, successes=0)
+    return dict(vehicles=len(scores),
+                successes=sum(s['mission_success'] for s in scores),
+                maximum_horizontal_error=max(s['maximum_horizontal_error'] for s in scores),
+                maximum_vertical_error=max(s['maximum_vertical_error'] for s in scores),
+                average_horizontal_error=float(np.mean([s['average_horizontal_error'] for s in scores])),
+                average_vertical_error=float(np.mean([s['average_vertical_error'] for s in scores])),
+                maximum_mission_time=max(s['mission_time'] for s in scores))
+
+
+class MavlinkReaderPool(object):
+
+    def __init__(self, workers=1, poll_interval=0.05):
+        """Read many MAVLink connections from a fixed number of threads
+
+        The connections are udacidrone MavlinkConnections created with threaded=False and
+        never started, so none has a reader thread of its own. They are spread over the
+        workers; each worker waits on the sockets of its connections with a selector,
+        parses the bytes available with the pymavlink recv_msg and hands every message to
+        the connection's dispatch_message, which calls the vehicle callbacks. Connections
+        without a file descriptor (e.g. some serial ports) are polled every poll_interval.
+
+        A callback raising is counted in errors instead of stopping the worker, which
+        serves other vehicles too.
+
+        Args:
+            workers: number of reader threads, whatever the number of connections
+            poll_interval: seconds a worker waits for data before checking for stop
+        """
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.connections = []
+        self.messages = 0
+        self.errors = collections.Counter()
+        self.last_error = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add(self, connection):
+        self.connections.append(connection)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for worker in range(min(self.workers, len(self.connections))):
+            thread = threading.Thread(target=self._run, args=(self.connections[worker::self.workers],),
+                                      name='mavlink-reader-{}'.format(worker), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _read(self, connection):
+        # every complete message buffered on the socket, without blocking
+        master = connection._master
+        while True:
+            msg = master.recv_msg()
+            if msg is None:
+                return
+            if msg.get_type() == 'BAD_DATA':
+                continue
+            self.messages += 1
+            try:
+                connection.dispatch_message(msg)
+            except Exception as e:
+                self.errors[msg.get_type()] += 1
+                self.last_error = e
+
+    def _run(self, connections):
+        selector = selectors.DefaultSelector()
+        polled = []
+        for connection in connections:
+            fd = getattr(connection._master, 'fd', None)
+            if fd is None:
+                polled.append(connection)
+            else:
+                selector.register(fd, selectors.EVENT_READ, connection)
+        try:
+            while not self._stop.is_set():
+                if selector.get_map():
+                    ready = [key.data for key, _ in selector.select(self.poll_interval)]
+                else:
+                    time.sleep(self.poll_interval)
+                    ready = []
+                for connection in ready + polled:
+                    self._read(connection)
+        finally:
+            selector.close()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+
+
+class Fleet(object):
+
+    def __init__(self, vehicles, position_rate=50.0, attitude_rate=100.0, body_rate_rate=500.0, readers=None,
+                 command_writer=None, flight_log_writer=None):
+        """Fly ControlsFlyer vehicles with one batched controller
+
+        Each vehicle keeps its own connection, mission state machine, error recorder and
+        flight log, but none runs controllers from its callbacks. Instead, every tick of a
+        single ControlScheduler stacks the state of all vehicles in the WAYPOINT state and
+        evaluates each cascade stage for all of them with one BatchNonlinearController
+        call. All vehicles share the NonlinearController default gains.
+
+        With readers, command_writer and flight_log_writer given (see make_fleet), the I/O
+        threads are shared too, so an extra vehicle adds sockets and files but no thread.
+
+        Args:
+            vehicles: list of ControlsFlyer, their connections not started yet
+            position_rate, attitude_rate, body_rate_rate: loop rates in Hz
+            readers: MavlinkReaderPool reading the vehicle connections, None to start each
+                (threaded) connection instead
+            command_writer: SharedCommandWriter the vehicles were created with
+            flight_log_writer: BackgroundFlightLogWriter holding the vehicle flight logs
+        """
+        self.vehicles = list(vehicles)
+        if any(vehicle.quaternion_attitude for vehicle in self.vehicles):
+            raise ValueError('the batched controller takes Euler attitudes, not quaternion_attitude vehicles')
+        self.readers = readers
+        self.command_writer = command_writer
+        self.flight_log_writer = flight_log_writer
+        self.controller = BatchNonlinearController()
+        self.scheduler = ControlScheduler(base_rate=body_rate_rate)
+        for vehicle in self.vehicles:
+            vehicle.callback_control = False
+            # trajectory times and scheduled tick times on the same clock
+            vehicle.clock = self.scheduler.clock
+        self.scheduler.add_stage('position_controller', self.position_controller, position_rate)
+        self.scheduler.add_stage('attitude_controller', self.attitude_controller, attitude_rate)
+        self.scheduler.add_stage('bodyrate_controller', self.bodyrate_controller, body_rate_rate)
+        self.scheduler.add_stage('supervisor', self.supervisor, 10.0)
+
+    def flying(self):
+        return [vehicle for vehicle in self.vehicles if vehicle.flight_state == States.WAYPOINT]
+
+    def position_controller(self, t):
+        vehicles = self.flying()
+        if not vehicles:
+            return
+        samples = [vehicle.trajectory.evaluate(t) for vehicle in vehicles]
+        position_cmd = np.array([s[0] for s in samples])
+        velocity_cmd = np.array([s[1] for s in samples])
+        acceleration_ff = np.array([s[2] for s in samples])
+        position = np.array([vehicle.local_position for vehicle in vehicles])
+        velocity = np.array([vehicle.local_velocity for vehicle in vehicles])
+        acceleration_cmd = self.controller.lateral_position_control(
+                position_cmd[:, 0:2], velocity_cmd[:, 0:2], position[:, 0:2], velocity[:, 0:2],
+                acceleration_ff[:, 0:2])
+        for i, vehicle in enumerate(vehicles):
+            vehicle.local_position_target = position_cmd[i]
+            vehicle.local_velocity_target = velocity_cmd[i]
+            vehicle.acceleration_ff = acceleration_ff[i]
+            vehicle.attitude_target = np.array((0.0, 0.0, samples[i][3]))
+            vehicle.local_acceleration_target = np.array([acceleration_cmd[i, 0], acceleration_cmd[i, 1], 0.0])
+
+    def attitude_controller(self, t):
+        vehicles = self.flying()
+        if not vehicles:
+            return
+        position_target = np.array([vehicle.local_position_target for vehicle in vehicles])
+        velocity_target = np.array([vehicle.local_velocity_target for vehicle in vehicles])
+        acceleration_target = np.array([vehicle.local_acceleration_target for vehicle in vehicles])
+        acceleration_ff = np.array([vehicle.acceleration_ff for vehicle in vehicles])
+        yaw_target = np.array([vehicle.attitude_target[2] for vehicle in vehicles])
+        position = np.array([vehicle.local_position for vehicle in vehicles])
+        velocity = np.array([vehicle.local_velocity for vehicle in vehicles])
+        attitude = np.array([vehicle.attitude for vehicle in vehicles])
+        thrust_cmd = self.controller.altitude_control(
+                -position_target[:, 2], -velocity_target[:, 2], -position[:, 2], -velocity[:, 2], attitude,
+                9.81 - acceleration_ff[:, 2])
+        roll_pitch_rate_cmd = self.controller.roll_pitch_controller(acceleration_target[:, 0:2], attitude, thrust_cmd)
+        yawrate_cmd = self.controller.yaw_control(yaw_target, attitude[:, 2])
+        for i, vehicle in enumerate(vehicles):
+            vehicle.thrust_cmd = thrust_cmd[i]
+            vehicle.body_rate_target = np.array([roll_pitch_rate_cmd[i, 0], roll_pitch_rate_cmd[i, 1], yawrate_cmd[i]])
+
+    def bodyrate_controller(self, t):
+        vehicles = self.flying()
+        if not vehicles:
+            return
+        body_rate_target = np.array([vehicle.body_rate_target for vehicle in vehicles])
+        gyro = np.array([vehicle.gyro_raw for vehicle in vehicles])
+        moment_cmd = self.controller.body_rate_control(body_rate_target, gyro)
+        for i, vehicle in enumerate(vehicles):
+            vehicle.cmd_moment(moment_cmd[i, 0], moment_cmd[i, 1], moment_cmd[i, 2], vehicle.thrust_cmd)
+
+    def supervisor(self, t):
+        if not any(vehicle.in_mission for vehicle in self.vehicles):
+            self.scheduler.stop()
+
+    def fly(self):
+        """Start every connection, run the control loops until all missions ended
+
+        Returns: list of vehicle_score results, in vehicle order
+        """
+        for vehicle in self.vehicles:
+            if vehicle.planned_trajectory is None:
+                vehicle.preload_trajectory()
+            vehicle.flight_log.start()
+        if self.command_writer is not None:
+            self.command_writer.start()
+        if self.readers is not None:
+            self.readers.start()
+        else:
+            for vehicle in self.vehicles:
+                # threaded connections: each reads its socket on its own thread and returns here
+                vehicle.connection.start()
+        try:
+            self.scheduler.run()
+        finally:
+            if self.readers is not None:
+                self.readers.stop()
+            for vehicle in self.vehicles:
+                vehicle.stop()
+                vehicle.flight_log.close()
+            if self.command_writer is not None:
+                self.command_writer.close()
+            if self.flight_log_writer is not None:
+                self.flight_log_writer.close()
+        return [vehicle_score(vehicle) for vehicle in self.vehicles]
+
+    def summary(self, scores):
+        lines = ['{:>4s} {:>7s} {:>7s} {:>7s} {:>7s}'.format('#', 'maxH', 'maxV', 'time', 'ok')]
+        for i, s in enumerate(scores):
+            lines.append('{:4d} {:7.3f} {:7.3f} {:7.2f} {:>7s}'.format(
+                i, s['maximum_horizontal_error'], s['maximum_vertical_error'], s['mission_time'],
+                str(s['mission_success'])))
+        fleet = aggregate_scores(scores)
+        lines.append('{} of {} missions successful'.format(fleet['successes'], fleet['vehicles']))
+        lines.append(self.scheduler.summary())
+        if self.readers is not None:
+            threads = min(self.readers.workers, len(self.readers.connections))
+            lines.append('{} messages read by {} threads, {} callback errors'.format(
+                self.readers.messages, threads, sum(self.readers.errors.values())))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fly one trajectory per vehicle from a single process')
+    parser.add_argument('endpoints', type=str, nargs='+', help='connection endpoints, e.g. tcp:127.0.0.1:5760')
+    parser.add_argument('--trajectories', type=str, nargs='+', default=['test_trajectory.txt'],
+                        help='one trajectory file for all vehicles, or one per vehicle')
+    parser.add_argument('--time-mult', type=float, default=0.5)
+    parser.add_argument('--spline', action='store_true', help='spline trajectories with acceleration feedforward')
+    parser.add_argument('--reader-threads', type=int, default=1, help='threads reading the MAVLink connections')
+    args = parser.parse_args()
+    if len(args.trajectories) not in (1, len(args.endpoints)):
+        parser.error('give one trajectory, or one per endpoint')
+
+    reader_pool = MavlinkReaderPool(workers=args.reader_threads)
+    shared_commands = SharedCommandWriter()
+    shared_log = BackgroundFlightLogWriter(None)
+    fleet_vehicles = []
+    for index, endpoint in enumerate(args.endpoints):
+        # not threaded and never started: the reader pool reads it
+        conn = MavlinkConnection(endpoint, threaded=False, PX4=False)
+        reader_pool.add(conn)
+        vehicle = ControlsFlyer(conn, tlog_name='TLog-{}.txt'.format(index), command_writer=shared_commands,
+                                flight_log=shared_log.add_log(os.path.join(DEFAULT_FLIGHT_LOG_DIR, str(index))))
+        vehicle.preload_trajectory(args.trajectories[index % len(args.trajectories)], time_mult=args.time_mult,
+                                   spline=args.spline)
+        fleet_vehicles.append(vehicle)
+    time.sleep(2)
+    fleet = Fleet(fleet_vehicles, readers=reader_pool, command_writer=shared_commands, flight_log_writer=shared_log)
+    fleet_scores = fleet.fly()
+    print(fleet.summary(fleet_scores))
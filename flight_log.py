@@ -0,0 +1,423 @@
+"""
+Binary flight log
+
+components:
+    fixed-dtype record streams with a small self-describing header
+    chunked appends during flight
+    zero-copy reading with np.memmap
+    background writer fed by a bounded record queue, shareable by many flight logs
+    conversion from the legacy pickled flight_log
+
+A flight log is a directory with one file per stream. Each file starts with the
+8-byte magic, a little-endian uint32 format version and uint32 header length,
+followed by a JSON schema, padded to HEADER_ALIGNMENT bytes. Packed float64
+records follow. Every record holds one sample of all columns, so an append is a
+single write, and each column is a strided view of the memory map.
+"""
+import argparse
+import collections
+import json
+import os
+import pickle
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b'FCNDLOG\x00'
+VERSION = 1
+HEADER_ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sII')
+
+DEFAULT_FLIGHT_LOG_DIR = 'flight_logs'
+
+# back-pressure policies of RecordQueue
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+
+# column name and per-sample shape of each stream ControlsFlyer records
+FLIGHT_LOG_STREAMS = {
+    'position': (('t', ()), ('target', (3,)), ('actual', (3,))),
+    'velocity': (('t', ()), ('target', (3,)), ('actual', (3,))),
+    # autograder samples, taken where UnityDrone scores them; t is the mission time
+    'error': (('t', ()), ('horizontal', ()), ('vertical', ())),
+}
+
+
+def _record_dtype(columns):
+    return np.dtype([(name, '<f8', tuple(shape)) for name, shape in columns])
+
+
+def _header(name, columns):
+    schema = json.dumps(dict(stream=name, columns=[[c, '<f8', list(shape)] for c, shape in columns]))
+    schema = schema.encode('utf-8')
+    length = _PREAMBLE.size + len(schema)
+    length += -length % HEADER_ALIGNMENT
+    return _PREAMBLE.pack(MAGIC, VERSION, length) + schema.ljust(length - _PREAMBLE.size, b' ')
+
+
+def read_header(filename):
+    """Read the schema of a stream file
+
+    Returns: tuple (stream name, columns, header length in bytes)
+    """
+    with open(filename, 'rb') as f:
+        magic, version, length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not a flight log stream'.format(filename))
+        if version > VERSION:
+            raise ValueError('{} uses unsupported format version {}'.format(filename, version))
+        schema = json.loads(f.read(length - _PREAMBLE.size).decode('utf-8'))
+    columns = tuple((name, tuple(shape)) for name, dtype, shape in schema['columns'])
+    return schema['stream'], columns, length
+
+
+class StreamWriter(object):
+
+    def __init__(self, filename, name, columns, chunk_size=4096):
+        """Append fixed-size records to a stream file
+
+        Records are collected in a preallocated chunk and written once it is full, so an
+        append never touches the disk. The file is created on the first write.
+
+        Args:
+            filename: stream file to create (an existing file is replaced)
+            name: stream name stored in the header
+            columns: sequence of (column name, per-sample shape)
+            chunk_size: number of records written at once
+        """
+        self.filename = filename
+        self.name = name
+        self.columns = tuple((c, tuple(shape)) for c, shape in columns)
+        self.dtype = _record_dtype(self.columns)
+        self.count = 0
+        self._file = None
+        self._closed = False
+        # all columns are float64, so a record is a flat row of this many values
+        widths = [int(np.prod(shape)) for _, shape in self.columns]
+        offsets = np.concatenate(([0], np.cumsum(widths)))
+        self._slices = [slice(int(start), int(stop)) for start, stop in zip(offsets[:-1], offsets[1:])]
+        self._chunk = np.empty((chunk_size, int(offsets[-1])), dtype='<f8')
+        self._size = 0
+
+    def append(self, *values):
+        """Append one record, one value per column in schema order"""
+        row = self._chunk[self._size]
+        for s, value in zip(self._slices, values):
+            row[s] = value
+        self._size += 1
+        self.count += 1
+        if self._size == len(self._chunk):
+            self.flush()
+
+    def append_many(self, *columns):
+        """Append len(columns[0]) records given column by column"""
+        n = len(columns[0])
+        block = np.empty((n, self._chunk.shape[1]), dtype='<f8')
+        for s, values in zip(self._slices, columns):
+            block[:, s] = np.asarray(values, dtype='<f8').reshape(n, -1)
+        self.flush()
+        self._open().write(block.tobytes())
+        self.count += n
+
+    def _open(self):
+        if self._closed:
+            raise ValueError('stream {} is closed'.format(self.name))
+        if self._file is None:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.filename, 'wb')
+            self._file.write(_header(self.name, self.columns))
+        return self._file
+
+    def flush(self):
+        """Write buffered records to the file"""
+        f = self._open()
+        if self._size:
+            f.write(self._chunk[:self._size].tobytes())
+            self._size = 0
+        f.flush()
+
+    def close(self):
+        if not self._closed:
+            self.flush()
+            self._file.close()
+            self._closed = True
+
+
+def open_stream(filename):
+    """Memory map a stream file without reading it
+
+    Returns: structured numpy array (np.memmap unless empty), one field per column
+    """
+    name, columns, header_length = read_header(filename)
+    dtype = _record_dtype(columns)
+    count = (os.path.getsize(filename) - header_length) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    # a partially written trailing record (e.g. after a crash) is ignored
+    return np.memmap(filename, dtype=dtype, mode='r', offset=header_length, shape=(count,))
+
+
+class FlightLogWriter(object):
+
+    def __init__(self, directory=DEFAULT_FLIGHT_LOG_DIR, streams=FLIGHT_LOG_STREAMS, chunk_size=4096):
+        """One StreamWriter per stream, available as attributes (e.g. log.position)"""
+        self.directory = directory
+        self.streams = {}
+        for name, columns in streams.items():
+            writer = StreamWriter(os.path.join(directory, name + '.bin'), name, columns, chunk_size)
+            self.streams[name] = writer
+            setattr(self, name, writer)
+
+    def flush(self):
+        for writer in self.streams.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.streams.values():
+            writer.close()
+
+
+class RecordQueue(object):
+
+    def __init__(self, capacity=65536, policy=DROP_OLDEST, block_timeout=None):
+        """Bounded single-consumer queue of records
+
+        push and pop_batch rely on collections.deque appends and pops being atomic, so with
+        DROP_OLDEST neither side ever takes a lock. A full queue either discards its oldest
+        record (DROP_OLDEST) or makes push wait for the consumer (BLOCK).
+
+        Args:
+            capacity: maximum number of queued records
+            policy: DROP_OLDEST or BLOCK
+            block_timeout: with BLOCK, seconds to wait for space before dropping the new
+                record instead, None to wait indefinitely
+        """
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError('unknown back-pressure policy: {}'.format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._deque = collections.deque(maxlen=capacity if policy == DROP_OLDEST else None)
+        self._not_full = threading.Condition()
+        # set when the queue fills up, so a sleeping consumer can drain it early
+        self.full = threading.Event()
+        self.pushed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        """Number of records waiting for the consumer"""
+        return len(self._deque)
+
+    def push(self, record):
+        depth = len(self._deque)
+        if depth >= self.capacity:
+            self.full.set()
+            if self.policy == DROP_OLDEST:
+                # the bounded deque discards the oldest record itself; the count can be one
+                # too high if the consumer pops between the check and the append
+                self.dropped += 1
+            else:
+                with self._not_full:
+                    if not self._not_full.wait_for(lambda: len(self._deque) < self.capacity, self.block_timeout):
+                        self.dropped += 1
+                        return
+        self._deque.append(record)
+        self.pushed += 1
+        if depth >= self.max_depth:
+            self.max_depth = depth + 1
+
+    def pop_batch(self, max_records=1024):
+        """Remove and return up to max_records records, oldest first"""
+        batch = []
+        popleft = self._deque.popleft
+        try:
+            while len(batch) < max_records:
+                batch.append(popleft())
+        except IndexError:
+            pass
+        if batch and self.policy == BLOCK:
+            with self._not_full:
+                self._not_full.notify_all()
+        return batch
+
+
+class _QueuedStream(object):
+
+    def __init__(self, queue, writer):
+        self._push = queue.push
+        self._writer = writer
+
+    def append(self, *values):
+        """Queue one record, one value per column in schema order"""
+        self._push((self._writer, values))
+
+
+class BackgroundFlightLogWriter(object):
+
+    def __init__(self, directory=DEFAULT_FLIGHT_LOG_DIR, streams=FLIGHT_LOG_STREAMS, chunk_size=4096,
+                 capacity=65536, policy=DROP_OLDEST, block_timeout=None, batch_size=1024, interval=0.05):
+        """FlightLogWriter whose disk writes happen on a background thread
+
+        Appends only push the record onto a RecordQueue, so their cost does not depend on
+        the disk or on how long the mission has been running. Once started, the writer
+        thread drains the queue in batches, sleeping interval seconds whenever it is empty.
+
+        The same queue and thread can write further logs, see add_log.
+
+        Args:
+            directory: directory of the log whose streams are attributes of the writer,
+                None for a writer only serving add_log
+            streams, chunk_size: as for FlightLogWriter
+            capacity, policy, block_timeout: as for RecordQueue
+            batch_size: maximum number of records written per queue drain
+            interval: seconds the writer thread sleeps when the queue is empty
+        """
+        self.directory = directory
+        self.queue = RecordQueue(capacity, policy, block_timeout)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self._stream_columns = streams
+        self._chunk_size = chunk_size
+        self._logs = []
+        self.streams = {}
+        if directory is not None:
+            self.streams = self._queued_streams(directory)
+            for name, stream in self.streams.items():
+                setattr(self, name, stream)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _queued_streams(self, directory):
+        log = FlightLogWriter(directory, self._stream_columns, self._chunk_size)
+        self._logs.append(log)
+        return {name: _QueuedStream(self.queue, writer) for name, writer in log.streams.items()}
+
+    def add_log(self, directory):
+        """Another flight log written through this writer's queue and thread
+
+        Add the logs before start(); close() writes and closes all of them.
+
+        Returns: SharedFlightLog
+        """
+        return SharedFlightLog(self, directory)
+
+    def start(self):
+        """Start the writer thread, records appended before are kept in the queue"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='flight-log-writer', daemon=True)
+            self._thread.start()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    @property
+    def depth(self):
+        return self.queue.depth
+
+    def _drain(self):
+        batch = self.queue.pop_batch(self.batch_size)
+        rows = collections.defaultdict(list)
+        for writer, values in batch:
+            rows[writer].append(values)
+        for writer, values in rows.items():
+            writer.append_many(*zip(*values))
+        self.written += len(batch)
+        return len(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._drain():
+                self.queue.full.wait(self.interval)
+                self.queue.full.clear()
+        while self._drain():
+            pass
+
+    def close(self):
+        """Write every queued record and close the log"""
+        self._stop.set()
+        self.queue.full.set()
+        if self._thread is not None:
+            self._thread.join()
+        while self._drain():
+            pass
+        for log in self._logs:
+            log.close()
+
+
+class SharedFlightLog(object):
+
+    def __init__(self, writer, directory):
+        """Queued streams of one flight log of a shared BackgroundFlightLogWriter
+
+        Used like a BackgroundFlightLogWriter (e.g. log.position.append). The shared writer
+        belongs to the code that created it: start only starts it if needed, close leaves
+        the log open until the shared writer is closed.
+        """
+        self.writer = writer
+        self.directory = directory
+        self.streams = writer._queued_streams(directory)
+        for name, stream in self.streams.items():
+            setattr(self, name, stream)
+
+    def start(self):
+        self.writer.start()
+
+    def close(self):
+        pass
+
+    @property
+    def queue(self):
+        return self.writer.queue
+
+    @property
+    def written(self):
+        return self.writer.written
+
+    @property
+    def dropped(self):
+        return self.writer.dropped
+
+
+def open_flight_log(directory=DEFAULT_FLIGHT_LOG_DIR):
+    """Memory map every stream of a flight log
+
+    Returns: dict mapping stream name to its structured array
+    """
+    streams = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.bin'):
+            streams[filename[:-len('.bin')]] = open_stream(os.path.join(directory, filename))
+    return streams
+
+
+def convert_legacy_log(pickle_filename='flight_log', directory=DEFAULT_FLIGHT_LOG_DIR):
+    """Convert a pickled flight_log written by the old ControlsFlyer.write_flight_log
+
+    Returns: FlightLogWriter that wrote the converted log (closed)
+    """
+    with open(pickle_filename, 'rb') as f:
+        traj_t, target_traj, actual_traj, v_t, target_v, actual_v = pickle.load(f)
+    log = FlightLogWriter(directory)
+    if len(traj_t):
+        log.position.append_many(traj_t, np.array(target_traj), np.array(actual_traj))
+    if len(v_t):
+        log.velocity.append_many(v_t, np.array(target_v), np.array(actual_v))
+    log.close()
+    return log
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a legacy pickled flight_log to the binary format')
+    parser.add_argument('legacy', type=str, nargs='?', default='flight_log')
+    parser.add_argument('directory', type=str, nargs='?', default=DEFAULT_FLIGHT_LOG_DIR)
+    args = parser.parse_args()
+    convert_legacy_log(args.legacy, args.directory)
+    for stream_name, stream in open_flight_log(args.directory).items():
+        print('{}: {} records'.format(stream_name, len(stream)))
@@ -1,27 +1,248 @@
 # -*- coding: utf-8 -*-
+import math
+
 import numpy as np
 
-def euler2RM(roll,pitch,yaw):
-    R = np.array([[0.0,0.0,0.0],[0.0,0.0,0.0],[0.0,0.0,0.0]])
-    cr = np.cos(roll)
-    sr = np.sin(roll)
-    
-    cp = np.cos(pitch)
-    sp = np.sin(pitch)
-    
-    cy = np.cos(yaw)
-    sy = np.sin(yaw)
-    
-    R[0,0] = cp*cy
-    R[1,0] = -cr*sy+sr*sp*cy
-    R[2,0] = sr*sy+cr*sp*cy
-    
-    R[0,1] = cp*sy
-    R[1,1] = cr*cy+sr*sp*sy
-    R[2,1] = -sr*cy+cr*sp*sy
-    
-    R[0,2] = -sp
-    R[1,2] = sr*cp
-    R[2,2] = cr*cp
-    
-    return R.transpose()
\ No newline at end of file
+def euler2RM(roll,pitch,yaw,out=None):
+    """Rotation matrix from body frame to local (NED) frame
+
+    Args:
+        roll, pitch, yaw: Euler angles in radians
+        out: optional 3x3 float64 array the matrix is written into
+
+    Returns: 3x3 numpy array (out when given)
+    """
+    if out is None:
+        out = np.empty((3,3))
+    cr = math.cos(roll)
+    sr = math.sin(roll)
+
+    cp = math.cos(pitch)
+    sp = math.sin(pitch)
+
+    cy = math.cos(yaw)
+    sy = math.sin(yaw)
+
+    out[0,0] = cp*cy
+    out[0,1] = -cr*sy+sr*sp*cy
+    out[0,2] = sr*sy+cr*sp*cy
+
+    out[1,0] = cp*sy
+    out[1,1] = cr*cy+sr*sp*sy
+    out[1,2] = -sr*cy+cr*sp*sy
+
+    out[2,0] = -sp
+    out[2,1] = sr*cp
+    out[2,2] = cr*cp
+
+    return out
+
+
+def euler2RM_batch(angles, out=None):
+    """Vectorized euler2RM
+
+    Args:
+        angles: (N,3) array of (roll, pitch, yaw) in radians
+        out: optional (N,3,3) float64 array the matrices are written into
+
+    Returns: (N,3,3) numpy array, out[i] == euler2RM(*angles[i])
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    if out is None:
+        out = np.empty((angles.shape[0],3,3))
+    cr = np.cos(angles[:,0])
+    sr = np.sin(angles[:,0])
+
+    cp = np.cos(angles[:,1])
+    sp = np.sin(angles[:,1])
+
+    cy = np.cos(angles[:,2])
+    sy = np.sin(angles[:,2])
+
+    out[:,0,0] = cp*cy
+    out[:,0,1] = -cr*sy+sr*sp*cy
+    out[:,0,2] = sr*sy+cr*sp*cy
+
+    out[:,1,0] = cp*sy
+    out[:,1,1] = cr*cy+sr*sp*sy
+    out[:,1,2] = -sr*cy+cr*sp*sy
+
+    out[:,2,0] = -sp
+    out[:,2,1] = sr*cp
+    out[:,2,2] = cr*cp
+
+    return out
+
+
+
+def euler2quaternion(roll,pitch,yaw,out=None):
+    """Unit quaternion of the euler2RM rotation (yaw, then pitch, then roll)
+
+    Args:
+        roll, pitch, yaw: Euler angles in radians
+        out: optional 4-element float64 array the quaternion is written into
+
+    Returns: 4-element numpy array (w,x,y,z) (out when given)
+    """
+    if out is None:
+        out = np.empty(4)
+    cr = math.cos(roll*0.5)
+    sr = math.sin(roll*0.5)
+    cp = math.cos(pitch*0.5)
+    sp = math.sin(pitch*0.5)
+    cy = math.cos(yaw*0.5)
+    sy = math.sin(yaw*0.5)
+
+    out[0] = cr*cp*cy+sr*sp*sy
+    out[1] = sr*cp*cy-cr*sp*sy
+    out[2] = cr*sp*cy+sr*cp*sy
+    out[3] = cr*cp*sy-sr*sp*cy
+    return out
+
+
+def quaternion2euler(q):
+    """Euler angles of a unit quaternion, inverse of euler2quaternion
+
+    Args:
+        q: 4-element sequence (w,x,y,z)
+
+    Returns: tuple (roll, pitch, yaw) in radians, yaw within [-pi, pi]
+    """
+    w,x,y,z = q
+    roll = math.atan2(2*(w*x+y*z),1-2*(x*x+y*y))
+    pitch = math.asin(min(max(2*(w*y-z*x),-1.0),1.0))
+    return roll,pitch,quaternion_yaw(q)
+
+
+def quaternion_yaw(q):
+    """Yaw angle of a unit quaternion (w,x,y,z), within [-pi, pi]"""
+    w,x,y,z = q
+    return math.atan2(2*(w*z+x*y),1-2*(y*y+z*z))
+
+
+def quaternion2RM(q,out=None):
+    """Rotation matrix from body frame to local (NED) frame of a unit quaternion
+
+    Only products of the components: no trigonometry and no singular attitude.
+    quaternion2RM(euler2quaternion(roll,pitch,yaw)) equals euler2RM(roll,pitch,yaw) up
+    to rounding.
+
+    Args:
+        q: 4-element sequence (w,x,y,z)
+        out: optional 3x3 float64 array the matrix is written into
+
+    Returns: 3x3 numpy array (out when given)
+    """
+    if out is None:
+        out = np.empty((3,3))
+    w,x,y,z = q
+    x2 = 2*x
+    y2 = 2*y
+    z2 = 2*z
+    wx = w*x2
+    wy = w*y2
+    wz = w*z2
+    xx = x*x2
+    xy = x*y2
+    xz = x*z2
+    yy = y*y2
+    yz = y*z2
+    zz = z*z2
+
+    out[0,0] = 1-(yy+zz)
+    out[0,1] = xy-wz
+    out[0,2] = xz+wy
+
+    out[1,0] = xy+wz
+    out[1,1] = 1-(xx+zz)
+    out[1,2] = yz-wx
+
+    out[2,0] = xz-wy
+    out[2,1] = yz+wx
+    out[2,2] = 1-(xx+yy)
+
+    return out
+
+
+def quaternion_z_column(q):
+    """Third column of quaternion2RM, the body z axis in the local frame
+
+    The only column the altitude controller and the thrust direction need, in 9 products.
+
+    Returns: tuple (R02, R12, R22)
+    """
+    w,x,y,z = q
+    return 2*(x*z+w*y),2*(y*z-w*x),1-2*(x*x+y*y)
+
+
+def quaternion_xy_block(q):
+    """Upper-left 2x2 block of quaternion2RM
+
+    With quaternion_z_column, the entries the roll-pitch controller needs; the bottom row
+    is never computed.
+
+    Returns: tuple (R00, R01, R10, R11)
+    """
+    w,x,y,z = q
+    xy = x*y
+    wz = w*z
+    zz = z*z
+    return 1-2*(y*y+zz),2*(xy-wz),2*(xy+wz),1-2*(x*x+zz)
+
+
+class AttitudeCache(object):
+
+    def __init__(self, tolerance=0.0):
+        """Rotation matrix of the latest attitude sample, shared by the stages using it
+
+        With tolerance 0 the matrix is recomputed whenever the attitude changes. A positive
+        tolerance keeps the matrix until an angle is more than tolerance radians away from
+        the attitude it was computed for. The derivative of every entry of euler2RM with
+        respect to each angle is bounded by 1, so a kept matrix deviates from the exact one
+        by at most the sum of the three angle differences, 3 * tolerance (see error_bound).
+        Only the euler2RM calls are saved, a small part of a controller tick, so the flight
+        code uses tolerance 0; benchmarks/fast_math.py measures the accuracy and cost of
+        the others.
+
+        Attitudes may also be 4-element unit quaternions (w,x,y,z). Their matrix comes from
+        quaternion2RM, which has no trigonometry to save, so it is recomputed whenever the
+        quaternion changes, whatever the tolerance.
+
+        Args:
+            tolerance: largest angle change, in radians, for which the matrix is reused
+        """
+        self.tolerance = tolerance
+        self.matrix = np.empty((3,3))
+        self._anchor = None
+        self.updates = 0
+
+    @property
+    def error_bound(self):
+        """Largest deviation of any matrix entry from euler2RM of the current attitude"""
+        return 3*self.tolerance
+
+    def rotation_matrix(self, attitude):
+        """Body-to-local rotation matrix for the attitude
+
+        Args:
+            attitude: 3-element numpy array (roll,pitch,yaw) in radians, or a 4-element
+                quaternion (w,x,y,z)
+
+        Returns: 3x3 numpy array, reused by later calls (do not modify)
+        """
+        # python floats compare and multiply much faster than numpy scalars; the attitude
+        # is nearly always an ndarray, whose tolist() is the cheapest way to get them
+        key = attitude.tolist() if type(attitude) is np.ndarray else [float(a) for a in attitude]
+        anchor = self._anchor
+        if key != anchor:
+            tolerance = self.tolerance
+            if len(key) == 4:
+                quaternion2RM(key, out=self.matrix)
+            elif not tolerance or anchor is None or len(anchor) == 4 or abs(key[0]-anchor[0]) > tolerance \
+                    or abs(key[1]-anchor[1]) > tolerance or abs(key[2]-anchor[2]) > tolerance:
+                euler2RM(*key, out=self.matrix)
+            else:
+                return self.matrix
+            self._anchor = key
+            self.updates += 1
+        return self.matrix
@@ -0,0 +1,122 @@
+"""
+Mission scoring used by the autograder
+
+components:
+    default mission thresholds
+    mission success criterion
+    growable error recorder with running statistics
+"""
+import numpy as np
+
+DEFAULT_THRESHOLD_HORIZONTAL_ERROR = 2.0
+DEFAULT_THRESHOLD_VERTICAL_ERROR = 1.0
+DEFAULT_THRESHOLD_TIME = 20.0
+
+# rows of the ErrorRecorder storage
+_TIME = 0
+_HORIZONTAL = 1
+_VERTICAL = 2
+
+
+def mission_success(maximum_horizontal_error, maximum_vertical_error, mission_time,
+                    threshold_horizontal_error=DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+                    threshold_vertical_error=DEFAULT_THRESHOLD_VERTICAL_ERROR,
+                    threshold_time=DEFAULT_THRESHOLD_TIME):
+    """Check the mission success criterion (xtrack, vertical error and time)
+
+    Returns: True if no threshold is exceeded
+    """
+    return (maximum_horizontal_error <= threshold_horizontal_error and
+            maximum_vertical_error <= threshold_vertical_error and
+            mission_time <= threshold_time)
+
+
+class ErrorRecorder(object):
+
+    def __init__(self, initial_capacity=1024, max_samples=None):
+        """Record (time, horizontal error, vertical error) samples
+
+        Storage doubles when full, so appends are amortized O(1). With max_samples set
+        the storage stops growing at that size and the oldest samples are overwritten.
+        The running statistics always cover every sample ever appended.
+
+        Args:
+            initial_capacity: number of samples allocated up front
+            max_samples: maximum number of samples kept in memory, None for unbounded
+        """
+        if max_samples is not None:
+            if max_samples < 1:
+                raise ValueError('max_samples must be at least 1')
+            initial_capacity = min(initial_capacity, max_samples)
+        self.max_samples = max_samples
+        self._data = np.empty((3, max(initial_capacity, 1)), dtype=np.float64)
+        self._size = 0
+        self._head = 0
+        self.count = 0
+        self.mission_time = 0.0
+        self.maximum_horizontal_error = 0.0
+        self.maximum_vertical_error = 0.0
+        self._sum_horizontal_error = 0.0
+        self._sum_vertical_error = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, t, horizontal_error, vertical_error):
+        """Record one sample and update the running statistics"""
+        capacity = self._data.shape[1]
+        if self._size == capacity:
+            if self.max_samples is None or capacity < self.max_samples:
+                self._grow(capacity * 2 if self.max_samples is None else min(capacity * 2, self.max_samples))
+            else:
+                # full ring: overwrite the oldest sample
+                self._data[:, self._head] = (t, horizontal_error, vertical_error)
+                self._head = (self._head + 1) % capacity
+                self._update_statistics(t, horizontal_error, vertical_error)
+                return
+        self._data[:, self._size] = (t, horizontal_error, vertical_error)
+        self._size += 1
+        self._update_statistics(t, horizontal_error, vertical_error)
+
+    def _grow(self, capacity):
+        data = np.empty((3, capacity), dtype=np.float64)
+        data[:, :self._size] = self._data[:, :self._size]
+        self._data = data
+
+    def _update_statistics(self, t, horizontal_error, vertical_error):
+        self.count += 1
+        self.mission_time = t
+        if horizontal_error > self.maximum_horizontal_error:
+            self.maximum_horizontal_error = horizontal_error
+        if vertical_error > self.maximum_vertical_error:
+            self.maximum_vertical_error = vertical_error
+        self._sum_horizontal_error += horizontal_error
+        self._sum_vertical_error += vertical_error
+
+    def _column(self, column):
+        if self._head == 0:
+            return self._data[column, :self._size]
+        return np.concatenate((self._data[column, self._head:], self._data[column, :self._head]))
+
+    @property
+    def times(self):
+        """Recorded sample times, oldest first"""
+        return self._column(_TIME)
+
+    @property
+    def horizontal_errors(self):
+        """Recorded horizontal errors, oldest first"""
+        return self._column(_HORIZONTAL)
+
+    @property
+    def vertical_errors(self):
+        """Recorded vertical errors, oldest first"""
+        return self._column(_VERTICAL)
+
+    @property
+    def average_horizontal_error(self):
+        return self._sum_horizontal_error / self.count if self.count else 0.0
+
+    @property
+    def average_vertical_error(self):
+        return self._sum_vertical_error / self.count if self.count else 0.0
@@ -0,0 +1,138 @@
+"""
+Fixed-rate scheduling of the control cascade
+
+components:
+    stages due every divisor-th tick of a base rate
+    deadlines from a monotonic clock, independent of message arrival
+    overdue stages caught up once per stage, with per-stage skipped run counters
+"""
+import threading
+import time
+
+
+class Stage(object):
+
+    def __init__(self, name, fn, divisor, period):
+        """A callable due every divisor-th scheduler tick, with its run time statistics"""
+        self.name = name
+        self.fn = fn
+        self.divisor = divisor
+        self.period = period
+        # first tick the stage is due on; runs it missed are counted in skipped
+        self.next_tick = 0
+        self.calls = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_duration = 0.0
+
+    @property
+    def rate(self):
+        return 1.0 / self.period
+
+
+class ControlScheduler(object):
+
+    def __init__(self, base_rate=500.0, clock=time.monotonic, sleep=time.sleep):
+        """Run control stages at fixed rates on a monotonic clock
+
+        Tick k is due at start + k / base_rate and every stage is due on the ticks that are
+        a multiple of its divisor, so the inner loops run at exact multiples of the outer loop
+        rate. The stages due on a tick run in the order they were added. Stages get the
+        scheduled tick time, not the time they actually start, so their inputs do not depend
+        on jitter.
+
+        A tick finishing after the next one was due is an overrun. The ticks that are
+        already late are skipped rather than run back to back. A stage whose due tick was
+        skipped runs once on the next tick that executes; the other runs it missed meanwhile
+        are dropped and counted in its skipped counter. Every stage thus keeps its configured
+        rate as long as the ticks that do execute are frequent enough.
+
+        Args:
+            base_rate: tick rate in Hz, the rate of the fastest stage
+            clock: monotonic clock in seconds
+            sleep: function waiting the given number of seconds
+        """
+        self.base_rate = base_rate
+        self.period = 1.0 / base_rate
+        self.clock = clock
+        self._sleep = sleep
+        self.stages = []
+        self.ticks = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_stage(self, name, fn, rate):
+        """Run fn(t) at rate Hz, rounded to a whole divisor of the base rate
+
+        Returns: Stage
+        """
+        divisor = max(1, int(round(self.base_rate / rate)))
+        stage = Stage(name, fn, divisor, divisor * self.period)
+        self.stages.append(stage)
+        return stage
+
+    def run_tick(self, tick, t):
+        """Run the stages due on the given tick or overdue, t is its scheduled time"""
+        clock = self.clock
+        for stage in self.stages:
+            if tick >= stage.next_tick:
+                divisor = stage.divisor
+                # an overdue stage runs once, on the tick grid it is due on next
+                stage.skipped += (tick - stage.next_tick) // divisor
+                stage.next_tick = (tick // divisor + 1) * divisor
+                start = clock()
+                stage.fn(t)
+                duration = clock() - start
+                stage.calls += 1
+                if duration > stage.max_duration:
+                    stage.max_duration = duration
+                if duration > stage.period:
+                    stage.overruns += 1
+        self.ticks += 1
+
+    def run(self, duration=None):
+        """Run ticks until stop() is called, or for duration seconds"""
+        self._stop.clear()
+        period = self.period
+        start = self.clock()
+        tick = 0
+        while not self._stop.is_set():
+            deadline = start + tick * period
+            if duration is not None and deadline - start >= duration:
+                break
+            now = self.clock()
+            if now < deadline:
+                self._sleep(deadline - now)
+            self.run_tick(tick, deadline)
+            tick += 1
+            lateness = self.clock() - (start + tick * period)
+            if lateness > 0:
+                self.overruns += 1
+                if lateness > self.max_lateness:
+                    self.max_lateness = lateness
+                tick += int(lateness / period)
+
+    def start(self):
+        """Run the scheduler on a background thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='control-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def summary(self):
+        """Table of the stage rates, run times and overruns"""
+        lines = ['{:<24s} {:>8s} {:>8s} {:>10s} {:>9s} {:>8s}'.format(
+            'stage', 'rate', 'calls', 'max (us)', 'overruns', 'skipped')]
+        for stage in self.stages:
+            lines.append('{:<24s} {:8.1f} {:8d} {:10.1f} {:9d} {:8d}'.format(
+                stage.name, stage.rate, stage.calls, stage.max_duration * 1e6, stage.overruns, stage.skipped))
+        lines.append('{} ticks, {} overran, max lateness {:.1f} us'.format(
+            self.ticks, self.overruns, self.max_lateness * 1e6))
+        return '\n'.join(lines)
@@ -0,0 +1,245 @@
+"""
+Offline scoring of recorded flights
+
+components:
+    autograder metrics computed over whole error arrays
+    percentile and per-segment breakdowns
+    parallel scoring of a directory of flight logs
+"""
+import argparse
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from flight_log import open_flight_log
+from mission_metrics import (mission_success, DEFAULT_THRESHOLD_HORIZONTAL_ERROR, DEFAULT_THRESHOLD_VERTICAL_ERROR,
+                             DEFAULT_THRESHOLD_TIME)
+from trajectory import read_trajectory_file
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 95.0, 99.0)
+
+
+def load_position_samples(path):
+    """Read the position stream of a flight log
+
+    Args:
+        path: binary flight log directory, or a legacy pickled flight_log file
+
+    Returns: tuple of numpy arrays (times (N,), targets (N,3), actual positions (N,3))
+    """
+    if os.path.isdir(path):
+        position = open_flight_log(path)['position']
+        return position['t'], position['target'], position['actual']
+    with open(path, 'rb') as f:
+        traj_t, target_traj, actual_traj = pickle.load(f)[:3]
+    return (np.asarray(traj_t, dtype=np.float64).reshape(-1),
+            np.asarray(target_traj, dtype=np.float64).reshape(-1, 3),
+            np.asarray(actual_traj, dtype=np.float64).reshape(-1, 3))
+
+
+def load_error_samples(path):
+    """Read the scored error samples of a flight log
+
+    Logs written by ControlsFlyer hold the samples UnityDrone scores, taken at each
+    local_position_target update with the mission time since the first one, so the metrics
+    equal the live score. Older and legacy logs only have the position stream, logged in
+    local_position_callback; the errors are then computed from it and can differ slightly
+    from the live score (other sample times, mission time from the first logged sample).
+
+    Args:
+        path: as for load_position_samples
+
+    Returns: tuple (times (N,), horizontal errors (N,), vertical errors (N,), mission start
+        time), the arrays as numpy arrays
+    """
+    if os.path.isdir(path):
+        error = open_flight_log(path).get('error')
+        if error is not None and len(error):
+            # the times are already mission times
+            return error['t'], error['horizontal'], error['vertical'], 0.0
+    times, targets, actual = load_position_samples(path)
+    horizontal_errors, vertical_errors = position_errors(targets, actual)
+    return times, horizontal_errors, vertical_errors, float(times[0]) if len(times) else 0.0
+
+
+def position_errors(targets, actual):
+    """Horizontal and vertical errors as computed by UnityDrone, for arrays of samples
+
+    Returns: tuple of numpy arrays (horizontal errors (N,), vertical errors (N,))
+    """
+    difference = np.asarray(targets) - np.asarray(actual)
+    return np.hypot(difference[:, 0], difference[:, 1]), np.abs(difference[:, 2])
+
+
+def segment_breakdown(times, horizontal_errors, vertical_errors, edges):
+    """Error statistics between consecutive edge times
+
+    Samples before the first edge are left out, samples after the last one belong to the
+    last segment. Segments without samples are skipped.
+
+    Returns: list of dicts, one per segment
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    first = np.searchsorted(times, edges[0])
+    times = times[first:]
+    horizontal_errors = horizontal_errors[first:]
+    vertical_errors = vertical_errors[first:]
+    starts = np.searchsorted(times, edges)
+    occupied = np.flatnonzero(np.diff(np.append(starts, len(times))) > 0)
+    if not len(occupied):
+        return []
+    starts = starts[occupied]
+    counts = np.diff(np.append(starts, len(times)))
+    maximum_horizontal = np.maximum.reduceat(horizontal_errors, starts)
+    maximum_vertical = np.maximum.reduceat(vertical_errors, starts)
+    average_horizontal = np.add.reduceat(horizontal_errors, starts) / counts
+    average_vertical = np.add.reduceat(vertical_errors, starts) / counts
+    ends = np.append(edges[1:], times[-1])[occupied]
+    return [dict(start=float(edges[i]), end=float(end), count=int(count),
+                 maximum_horizontal_error=float(max_h), average_horizontal_error=float(avg_h),
+                 maximum_vertical_error=float(max_v), average_vertical_error=float(avg_v))
+            for i, end, count, max_h, avg_h, max_v, avg_v in zip(occupied, ends, counts, maximum_horizontal,
+                                                                 average_horizontal, maximum_vertical,
+                                                                 average_vertical)]
+
+
+def score_errors(times, horizontal_errors, vertical_errors,
+                 threshold_horizontal_error=DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+                 threshold_vertical_error=DEFAULT_THRESHOLD_VERTICAL_ERROR,
+                 threshold_time=DEFAULT_THRESHOLD_TIME, percentiles=DEFAULT_PERCENTILES, segment_edges=None,
+                 start_time=None):
+    """Autograder metrics of a whole flight at once
+
+    Mission time is measured from start_time, the first local_position_target update for
+    UnityDrone.
+
+    Args:
+        times, horizontal_errors, vertical_errors: (N,) arrays of samples
+        threshold_*: mission success thresholds
+        percentiles: error percentiles (0-100) to report
+        segment_edges: segment start times for segment_breakdown, None for no breakdown
+        start_time: mission start time, the first sample time when None
+
+    Returns: dict with the Simulation.mission_score metrics plus percentiles and segments
+    """
+    times = np.asarray(times, dtype=np.float64)
+    horizontal_errors = np.asarray(horizontal_errors, dtype=np.float64)
+    vertical_errors = np.asarray(vertical_errors, dtype=np.float64)
+    if not len(times):
+        raise ValueError('flight has no samples')
+    if start_time is None:
+        start_time = times[0]
+    result = dict(maximum_horizontal_error=float(horizontal_errors.max()),
+                  average_horizontal_error=float(horizontal_errors.mean()),
+                  maximum_vertical_error=float(vertical_errors.max()),
+                  average_vertical_error=float(vertical_errors.mean()),
+                  mission_time=float(times[-1] - start_time),
+                  samples=len(times))
+    result['mission_success'] = bool(mission_success(
+        result['maximum_horizontal_error'], result['maximum_vertical_error'], result['mission_time'],
+        threshold_horizontal_error, threshold_vertical_error, threshold_time))
+    if percentiles:
+        result['horizontal_error_percentiles'] = dict(zip(
+            (str(p) for p in percentiles), np.percentile(horizontal_errors, percentiles).tolist()))
+        result['vertical_error_percentiles'] = dict(zip(
+            (str(p) for p in percentiles), np.percentile(vertical_errors, percentiles).tolist()))
+    if segment_edges is not None:
+        result['segments'] = segment_breakdown(times, horizontal_errors, vertical_errors, segment_edges)
+    return result
+
+
+def score_log(path, segment_duration=None, trajectory_file=None, time_mult=0.5, **kwargs):
+    """Score one flight log
+
+    Segments are either the trajectory segments of trajectory_file (its times scaled by
+    time_mult, starting at the mission start) or windows of segment_duration seconds.
+
+    Args:
+        path: as for load_error_samples
+        segment_duration: length in seconds of the breakdown windows
+        trajectory_file: trajectory flown, for a per trajectory segment breakdown
+        time_mult: time multiplier the trajectory was flown with
+        kwargs: passed to score_errors
+
+    Returns: dict of score_errors plus the log path
+    """
+    times, horizontal_errors, vertical_errors, start_time = load_error_samples(path)
+    kwargs.setdefault('start_time', start_time)
+    if len(times) and trajectory_file is not None:
+        kwargs['segment_edges'] = read_trajectory_file(trajectory_file)[0] * time_mult + start_time
+    elif len(times) and segment_duration is not None:
+        kwargs['segment_edges'] = np.arange(times[0], times[-1], segment_duration)
+    result = score_errors(times, horizontal_errors, vertical_errors, **kwargs)
+    result['log'] = path
+    return result
+
+
+def find_logs(directory):
+    """Flight logs in directory: binary logs (directories holding a position stream) and
+    legacy pickled flight_log* files, including directory itself"""
+    if os.path.exists(os.path.join(directory, 'position.bin')):
+        return [directory]
+    logs = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            logs.extend(find_logs(path))
+        elif name.startswith('flight_log'):
+            logs.append(path)
+    return logs
+
+
+def score_logs(paths, workers=None, **kwargs):
+    """Score flight logs in parallel, one process per log at a time
+
+    Returns: list of score_log results in the order of paths
+    """
+    paths = list(paths)
+    if len(paths) <= 1 or workers == 1:
+        return [score_log(path, **kwargs) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(score_log, path, **kwargs) for path in paths]
+        return [future.result() for future in futures]
+
+
+def print_table(results):
+    print('{:>7s} {:>7s} {:>7s} {:>7s} {:>7s} {:>7s} {:>7s}  {}'.format(
+        'maxH', 'avgH', 'p99H', 'maxV', 'avgV', 'time', 'ok', 'log'))
+    for r in results:
+        p99 = r.get('horizontal_error_percentiles', {}).get('99.0', float('nan'))
+        print('{:7.3f} {:7.3f} {:7.3f} {:7.3f} {:7.3f} {:7.2f} {:>7s}  {}'.format(
+            r['maximum_horizontal_error'], r['average_horizontal_error'], p99, r['maximum_vertical_error'],
+            r['average_vertical_error'], r['mission_time'], str(r['mission_success']), r['log']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-score recorded flight logs against the mission thresholds')
+    parser.add_argument('paths', type=str, nargs='*', default=['flight_logs'],
+                        help='flight logs, or directories searched for flight logs')
+    parser.add_argument('--threshold-horizontal', type=float, default=DEFAULT_THRESHOLD_HORIZONTAL_ERROR)
+    parser.add_argument('--threshold-vertical', type=float, default=DEFAULT_THRESHOLD_VERTICAL_ERROR)
+    parser.add_argument('--threshold-time', type=float, default=DEFAULT_THRESHOLD_TIME)
+    parser.add_argument('--segment-duration', type=float, default=None, help='breakdown window in seconds')
+    parser.add_argument('--trajectory', type=str, default=None, help='break down per segment of this trajectory')
+    parser.add_argument('--time-mult', type=float, default=0.5)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='write every result as JSON lines')
+    args = parser.parse_args()
+
+    log_paths = []
+    for p in args.paths:
+        log_paths.extend(find_logs(p) if os.path.isdir(p) else [p])
+    all_results = score_logs(log_paths, workers=args.workers, segment_duration=args.segment_duration,
+                             trajectory_file=args.trajectory, time_mult=args.time_mult,
+                             threshold_horizontal_error=args.threshold_horizontal,
+                             threshold_vertical_error=args.threshold_vertical,
+                             threshold_time=args.threshold_time)
+    print_table(all_results)
+    print('{} of {} missions successful'.format(sum(r['mission_success'] for r in all_results), len(all_results)))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            for r in all_results:
+                f.write(json.dumps(r) + '\n')
@@ -0,0 +1,325 @@
+"""
+Offline closed-loop simulation of the control cascade
+
+components:
+    rigid-body quadrotor model
+    fixed-step runner for the position, attitude and body-rate loops
+    autograder metrics without the Unity simulator
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+from controller import NonlinearController, DRONE_MASS_KG, GRAVITY, MOI, MAX_THRUST, MAX_TORQUE
+from frame_utils import quaternion2euler, quaternion_z_column
+from mission_metrics import (ErrorRecorder, mission_success, DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+                             DEFAULT_THRESHOLD_VERTICAL_ERROR, DEFAULT_THRESHOLD_TIME)
+from trajectory import load_trajectory
+
+
+class QuadrotorModel(object):
+
+    def __init__(self, position=(0.0, 0.0, 0.0), mass=DRONE_MASS_KG, moi=MOI, quaternion=False):
+        """Rigid-body quadrotor driven by body moments and collective thrust
+
+        Args:
+            position: initial NED position
+            mass: vehicle mass in kg
+            moi: 3-element moments of inertia about the body axes in kg*m^2
+            quaternion: integrate the orientation as a unit quaternion (kept in
+                self.quaternion, self.attitude is converted from it when read) instead of as
+                Euler angles, which have a singularity at +-90 degrees of pitch
+        """
+        self.mass = mass
+        self.moi = np.array(moi, dtype=np.float64)
+        self.position = np.array(position, dtype=np.float64)
+        self.velocity = np.zeros(3)
+        self._attitude = np.zeros(3)
+        # quaternion model: _attitude is out of date until attitude is read
+        self._attitude_stale = False
+        self.body_rate = np.zeros(3)
+        self.quaternion = np.array([1.0, 0.0, 0.0, 0.0]) if quaternion else None
+
+    @property
+    def attitude(self):
+        """Euler angles (roll,pitch,yaw) of the orientation"""
+        if self._attitude_stale:
+            self._attitude[:] = quaternion2euler(self.quaternion.tolist())
+            self._attitude_stale = False
+        return self._attitude
+
+    def step(self, dt, moment, thrust, external_force=None):
+        """Advance the state by dt seconds (semi-implicit Euler)
+
+        Args:
+            dt: integration step in seconds
+            moment: 3-element numpy array, roll, pitch and yaw moments in Newtons*meters
+            thrust: upward force in Newtons
+            external_force: optional 3-element NED force in Newtons (e.g. wind)
+        """
+        # scalar math: numpy dispatch dominates for 3-element vectors
+        thrust = min(max(thrust, 0.0), MAX_THRUST)
+        tau_x, tau_y, tau_z = [min(max(m, -MAX_TORQUE), MAX_TORQUE) for m in moment]
+        p, q, r = self.body_rate.tolist()
+        i_x, i_y, i_z = self.moi.tolist()
+
+        if self.quaternion is None:
+            roll, pitch, yaw = self._attitude.tolist()
+            sr = math.sin(roll)
+            cr = math.cos(roll)
+            sp = math.sin(pitch)
+            cp = math.cos(pitch)
+            sy = math.sin(yaw)
+            cy = math.cos(yaw)
+            # third column of the body-to-local rotation matrix, see frame_utils.euler2RM
+            r02 = sr * sy + cr * sp * cy
+            r12 = -sr * cy + cr * sp * sy
+            r22 = cr * cp
+        else:
+            r02, r12, r22 = quaternion_z_column(self.quaternion.tolist())
+        c = -thrust / self.mass
+        acceleration = np.array([r02 * c, r12 * c, r22 * c - GRAVITY])
+        if external_force is not None:
+            acceleration += external_force / self.mass
+        self.velocity += acceleration * dt
+        self.position += self.velocity * dt
+
+        # Euler's equations for the body rates
+        p_dot = (tau_x - (i_z - i_y) * q * r) / i_x
+        q_dot = (tau_y - (i_x - i_z) * r * p) / i_y
+        r_dot = (tau_z - (i_y - i_x) * p * q) / i_z
+        p += p_dot * dt
+        q += q_dot * dt
+        r += r_dot * dt
+        self.body_rate[:] = (p, q, r)
+
+        if self.quaternion is not None:
+            # q_dot = q * (0, p, q, r) / 2, renormalized
+            w, x, y, z = self.quaternion.tolist()
+            half_dt = 0.5 * dt
+            w, x, y, z = (w - (x * p + y * q + z * r) * half_dt,
+                          x + (w * p + y * r - z * q) * half_dt,
+                          y + (w * q - x * r + z * p) * half_dt,
+                          z + (w * r + x * q - y * p) * half_dt)
+            norm = math.sqrt(w * w + x * x + y * y + z * z)
+            self.quaternion[:] = (w / norm, x / norm, y / norm, z / norm)
+            # two atan2 and an asin, only paid when the Euler angles are read
+            self._attitude_stale = True
+            return
+
+        roll += (p + (q * sr + r * cr) * math.tan(pitch)) * dt
+        pitch += (q * cr - r * sr) * dt
+        yaw += (q * sr + r * cr) / cp * dt
+        yaw = (yaw + math.pi) % (2 * math.pi) - math.pi
+        self._attitude[:] = (roll, pitch, yaw)
+
+
+class Simulation(object):
+
+    def __init__(self, trajectory, controller=None, model=None, physics_dt=0.002, position_rate=50.0,
+                 attitude_rate=100.0, body_rate_rate=500.0, max_overtime=10.0,
+                 threshold_horizontal_error=DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+                 threshold_vertical_error=DEFAULT_THRESHOLD_VERTICAL_ERROR,
+                 threshold_time=DEFAULT_THRESHOLD_TIME, quaternion_attitude=False):
+        """Fly a trajectory with the ControlsFlyer cascade against QuadrotorModel
+
+        The loops run at fixed rates on simulated time, mirroring the message driven
+        ControlsFlyer: position_controller on LOCAL_VELOCITY, attitude_controller on
+        ATTITUDE and bodyrate_controller on RAW_GYROSCOPE. Loop rates are rounded to
+        whole multiples of physics_dt.
+
+        Args:
+            trajectory: Trajectory to follow, times in simulated seconds
+            controller: NonlinearController instance, a default one when None
+            model: QuadrotorModel, one hovering at the start of the trajectory when None
+            physics_dt: integration step in seconds
+            position_rate, attitude_rate, body_rate_rate: loop rates in Hz
+            max_overtime: seconds after the end of the trajectory before the run is stopped
+            threshold_*: mission success thresholds, as in UnityDrone
+            quaternion_attitude: the attitude sensor reads the unit quaternion of a
+                quaternion model instead of Euler angles, and the controller works on it
+        """
+        self.trajectory = trajectory
+        self.controller = controller if controller is not None else NonlinearController()
+        self.model = model if model is not None else QuadrotorModel(trajectory.positions[0],
+                                                                    quaternion=quaternion_attitude)
+        if quaternion_attitude and self.model.quaternion is None:
+            raise ValueError('quaternion attitudes need a QuadrotorModel integrating quaternions')
+        self.quaternion_attitude = quaternion_attitude
+        self.physics_dt = physics_dt
+        self._position_divider = max(1, int(round(1.0 / (position_rate * physics_dt))))
+        self._attitude_divider = max(1, int(round(1.0 / (attitude_rate * physics_dt))))
+        self._body_rate_divider = max(1, int(round(1.0 / (body_rate_rate * physics_dt))))
+        self.max_overtime = max_overtime
+        self.threshold_horizontal_error = threshold_horizontal_error
+        self.threshold_vertical_error = threshold_vertical_error
+        self.threshold_time = threshold_time
+
+        self.recorder = ErrorRecorder()
+        self.time = trajectory.start_time
+        self.mission_success = True
+        self.completed = False
+
+        self.local_position_target = np.zeros(3)
+        self.local_velocity_target = np.zeros(3)
+        self.local_acceleration_target = np.zeros(3)
+        self.acceleration_ff = np.zeros(3)
+        self.attitude_target = np.zeros(3)
+        self.body_rate_target = np.zeros(3)
+        self.thrust_cmd = self.model.mass * -GRAVITY
+        self.moment_cmd = np.zeros(3)
+
+    # sensor readings, overridden to add noise
+    def local_position(self):
+        return self.model.position.copy()
+
+    def local_velocity(self):
+        return self.model.velocity.copy()
+
+    def attitude(self):
+        if self.quaternion_attitude:
+            return self.model.quaternion.copy()
+        return self.model.attitude.copy()
+
+    def gyro_raw(self):
+        return self.model.body_rate.copy()
+
+    def external_force(self, t):
+        """NED disturbance force in Newtons at time t, overridden to add wind"""
+        return None
+
+    def position_controller(self):
+        local_position = self.local_position()
+        (self.local_position_target,
+         self.local_velocity_target,
+         self.acceleration_ff,
+         yaw_cmd) = self.trajectory.evaluate(self.time)
+        self.attitude_target = np.array((0.0, 0.0, yaw_cmd))
+        acceleration_cmd = self.controller.lateral_position_control(
+                self.local_position_target[0:2],
+                self.local_velocity_target[0:2],
+                local_position[0:2],
+                self.local_velocity()[0:2],
+                self.acceleration_ff[0:2])
+        self.local_acceleration_target = np.array([acceleration_cmd[0], acceleration_cmd[1], 0.0])
+
+        # the autograder scores against the true vehicle position
+        position = self.model.position
+        horizontal_error = math.hypot(self.local_position_target[0] - position[0],
+                                      self.local_position_target[1] - position[1])
+        vertical_error = abs(self.local_position_target[2] - position[2])
+        self.recorder.append(self.time - self.trajectory.start_time, horizontal_error, vertical_error)
+
+    def attitude_controller(self):
+        local_position = self.local_position()
+        local_velocity = self.local_velocity()
+        attitude = self.attitude()
+        self.thrust_cmd = self.controller.altitude_control(
+                -self.local_position_target[2],
+                -self.local_velocity_target[2],
+                -local_position[2],
+                -local_velocity[2],
+                attitude,
+                9.81 - self.acceleration_ff[2])
+        roll_pitch_rate_cmd = self.controller.roll_pitch_controller(
+                self.local_acceleration_target[0:2],
+                attitude,
+                self.thrust_cmd)
+        yawrate_cmd = self.controller.yaw_control(
+                self.attitude_target[2],
+                self.controller.attitude_yaw(attitude))
+        self.body_rate_target = np.array([roll_pitch_rate_cmd[0], roll_pitch_rate_cmd[1], yawrate_cmd])
+
+    def bodyrate_controller(self):
+        self.moment_cmd = self.controller.body_rate_control(self.body_rate_target, self.gyro_raw())
+
+    def run(self):
+        """Fly until the trajectory is finished and the vehicle has slowed down
+
+        As in ControlsFlyer the mission ends once the last trajectory time has passed
+        and the horizontal speed is below 1 m/s, or max_overtime seconds later.
+
+        Returns: self
+        """
+        step = 0
+        while True:
+            if step % self._position_divider == 0:
+                # read on every check, a streamed trajectory only knows it once fully read
+                end_time = self.trajectory.end_time
+                if self.time > end_time and \
+                        (math.hypot(*self.model.velocity[0:2]) < 1.0 or self.time > end_time + self.max_overtime):
+                    self.completed = self.time <= end_time + self.max_overtime
+                    break
+                self.position_controller()
+            if step % self._attitude_divider == 0:
+                self.attitude_controller()
+            if step % self._body_rate_divider == 0:
+                self.bodyrate_controller()
+            self.model.step(self.physics_dt, self.moment_cmd, self.thrust_cmd, self.external_force(self.time))
+            self.time += self.physics_dt
+            step += 1
+
+        self.mission_success = self.completed and mission_success(
+            self.recorder.maximum_horizontal_error, self.recorder.maximum_vertical_error, self.recorder.mission_time,
+            self.threshold_horizontal_error, self.threshold_vertical_error, self.threshold_time)
+        return self
+
+    def mission_score(self):
+        """Autograder metrics of the run, as reported by UnityDrone.print_mission_score
+
+        Returns: dict of python floats and the mission_success bool
+        """
+        return dict(maximum_horizontal_error=float(self.recorder.maximum_horizontal_error),
+                    average_horizontal_error=float(self.recorder.average_horizontal_error),
+                    maximum_vertical_error=float(self.recorder.maximum_vertical_error),
+                    average_vertical_error=float(self.recorder.average_vertical_error),
+                    mission_time=float(self.recorder.mission_time),
+                    mission_success=bool(self.mission_success))
+
+    def print_mission_score(self):
+        print('Maximum Horizontal Error: ', self.recorder.maximum_horizontal_error)
+        print('Maximum Vertical Error: ', self.recorder.maximum_vertical_error)
+        print('Mission Time: ', self.recorder.mission_time)
+        print('Mission Success: ', self.mission_success)
+
+
+def simulate(filename='test_trajectory.txt', time_mult=0.5, controller=None, spline=False, stream=False, **kwargs):
+    """Load a trajectory file and fly it offline
+
+    Args:
+        spline: follow a SplineTrajectory with acceleration feedforward
+        stream: read the file in chunks during the run (StreamingTrajectory)
+
+    Returns: Simulation after the run
+    """
+    trajectory = load_trajectory(filename, time_mult=time_mult, spline=spline, stream=stream)
+    return Simulation(trajectory, controller=controller, **kwargs).run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trajectory', type=str, default='test_trajectory.txt')
+    parser.add_argument('--time-mult', type=float, default=0.5)
+    parser.add_argument('--physics-dt', type=float, default=0.002)
+    parser.add_argument('--spline', action='store_true', help='spline trajectory with acceleration feedforward')
+    parser.add_argument('--stream', action='store_true', help='read the trajectory file in chunks during the run')
+    parser.add_argument('--quaternion', action='store_true', help='quaternion attitudes from model to controller')
+    parser.add_argument('--fast', action='store_true', help='use the fused scalar FastNonlinearController')
+    args = parser.parse_args()
+    if args.fast:
+        # only imported when asked for: it compiles its kernels with numba if installed
+        from fast_controller import FastNonlinearController
+        main_controller = FastNonlinearController()
+    else:
+        main_controller = None
+
+    wall_start = time.perf_counter()
+    sim = simulate(args.trajectory, time_mult=args.time_mult, spline=args.spline, stream=args.stream,
+                   physics_dt=args.physics_dt, quaternion_attitude=args.quaternion,
+                   controller=main_controller)
+    wall_time = time.perf_counter() - wall_start
+    sim.print_mission_score()
+    print('Simulated {:.1f} s in {:.2f} s wall clock ({:.0f}x real time)'.format(
+        sim.recorder.mission_time, wall_time, sim.recorder.mission_time / wall_time))
@@ -0,0 +1,132 @@
+"""
+Live telemetry of the autograder errors
+
+components:
+    background publisher sending batched samples on a timer
+    visdom sink appending only the new samples to its plots
+    JSON lines file sink, used when visdom is not reachable
+"""
+import json
+import threading
+
+import numpy as np
+
+from flight_log import RecordQueue, DROP_OLDEST
+
+DEFAULT_TELEMETRY_FILE = 'telemetry.jsonl'
+
+
+class VisdomSink(object):
+
+    def __init__(self, viz):
+        """Horizontal and vertical error plots on a visdom server
+
+        The first batch creates the plots, later batches are appended to them.
+
+        Args:
+            viz: connected visdom.Visdom instance
+        """
+        self._v = viz
+        self.horizontal_plot = None
+        self.vertical_plot = None
+
+    def write(self, times, horizontal_errors, vertical_errors):
+        if self.horizontal_plot is None:
+            self.horizontal_plot = self._v.line(horizontal_errors, X=times, opts=dict(
+                title="Horizontal Error", xlabel="Time(s)", ylabel="Error (m)"))
+            self.vertical_plot = self._v.line(vertical_errors, X=times, opts=dict(
+                title="Vertical Error", xlabel="Time(s)", ylabel="Error (m)"))
+        else:
+            self._v.line(horizontal_errors, X=times, win=self.horizontal_plot, update='append')
+            self._v.line(vertical_errors, X=times, win=self.vertical_plot, update='append')
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+
+    def __init__(self, filename=DEFAULT_TELEMETRY_FILE):
+        """Append samples to a JSON lines file (e.g. to follow with tail -f), created on the first write"""
+        self.filename = filename
+        self._file = None
+
+    def write(self, times, horizontal_errors, vertical_errors):
+        if self._file is None:
+            self._file = open(self.filename, 'w')
+        self._file.write(''.join(
+            json.dumps(dict(t=t, horizontal_error=h, vertical_error=v)) + '\n'
+            for t, h, v in zip(times.tolist(), horizontal_errors.tolist(), vertical_errors.tolist())))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TelemetryPublisher(object):
+
+    def __init__(self, sink, fallback=None, interval=0.5, capacity=65536):
+        """Publish (time, horizontal error, vertical error) samples from a background thread
+
+        publish only queues the sample, so the caller never waits for the sink. Every
+        interval seconds the thread sends the samples queued since the previous batch. If
+        the sink fails, the batch and every later one go to the fallback sink.
+
+        Args:
+            sink: object with write(times, horizontal_errors, vertical_errors) and close()
+            fallback: sink used once sink raises, None to drop those batches
+            interval: seconds between batches
+            capacity: maximum number of queued samples, the oldest are dropped beyond it
+        """
+        self.sink = sink
+        self.fallback = fallback
+        self.interval = interval
+        self.queue = RecordQueue(capacity, DROP_OLDEST)
+        self.sent = 0
+        self.batches = 0
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='telemetry-publisher', daemon=True)
+            self._thread.start()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def publish(self, t, horizontal_error, vertical_error):
+        self.queue.push((t, horizontal_error, vertical_error))
+
+    def _send(self):
+        batch = self.queue.pop_batch(self.queue.capacity)
+        if not batch:
+            return
+        times, horizontal_errors, vertical_errors = np.array(batch, dtype=np.float64).T
+        while self.sink is not None:
+            try:
+                self.sink.write(times, horizontal_errors, vertical_errors)
+            except Exception:
+                self.failures += 1
+                self.sink, self.fallback = self.fallback, None
+                continue
+            self.sent += len(batch)
+            self.batches += 1
+            return
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._send()
+
+    def close(self):
+        """Send the queued samples and close the sink"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._send()
+        if self.sink is not None:
+            self.sink.close()
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from controller import BatchNonlinearController, NonlinearController
+
+N = 2000
+
+
+@pytest.fixture
+def states():
+    rng = np.random.default_rng(3)
+    return dict(attitude=rng.uniform([-0.5, -0.5, -np.pi], [0.5, 0.5, np.pi], (N, 3)),
+                position_cmd=rng.normal(size=(N, 2)) * 5, velocity_cmd=rng.normal(size=(N, 2)),
+                position=rng.normal(size=(N, 2)) * 5, velocity=rng.normal(size=(N, 2)),
+                acceleration_ff=rng.normal(size=(N, 2)), altitude=rng.normal(size=(4, N)),
+                body_rate_cmd=rng.normal(size=(N, 3)) * 3, body_rate=rng.normal(size=(N, 3)) * 3,
+                yaw_cmd=rng.uniform(-10, 10, N))
+
+
+@pytest.fixture(params=[{}, dict(k_p_x=3.3, k_d_y=2.5, k_p_z=4.0, k_p_roll=7.0, k_p_p=17, k_p_yaw=2.2)])
+def controllers(request):
+    scalar = NonlinearController()
+    batch = BatchNonlinearController()
+    scalar.set_gains(**request.param)
+    batch.set_gains(**request.param)
+    return scalar, batch
+
+
+def test_cascade_matches_scalar(controllers, states):
+    scalar, batch = controllers
+    s = states
+    attitude = s['attitude']
+    acceleration = batch.lateral_position_control(s['position_cmd'], s['velocity_cmd'], s['position'],
+                                                  s['velocity'], s['acceleration_ff'])
+    np.testing.assert_array_equal(acceleration, [scalar.lateral_position_control(
+        s['position_cmd'][i], s['velocity_cmd'][i], s['position'][i], s['velocity'][i], s['acceleration_ff'][i])
+        for i in range(N)])
+
+    z = s['altitude']
+    thrust = batch.altitude_control(z[0], z[1], z[2], z[3], attitude, 9.81)
+    np.testing.assert_array_equal(thrust, [scalar.altitude_control(z[0, i], z[1, i], z[2, i], z[3, i], attitude[i],
+                                                                   9.81) for i in range(N)])
+
+    rates = batch.roll_pitch_controller(acceleration, attitude, thrust)
+    np.testing.assert_array_equal(rates, [scalar.roll_pitch_controller(acceleration[i], attitude[i], thrust[i])
+                                          for i in range(N)])
+
+    yaw_rate = batch.yaw_control(s['yaw_cmd'], batch.attitude_yaw(attitude))
+    np.testing.assert_array_equal(yaw_rate, [scalar.yaw_control(s['yaw_cmd'][i], scalar.attitude_yaw(attitude[i]))
+                                             for i in range(N)])
+
+    moments = batch.body_rate_control(s['body_rate_cmd'], s['body_rate'])
+    np.testing.assert_array_equal(moments, [scalar.body_rate_control(s['body_rate_cmd'][i], s['body_rate'][i])
+                                            for i in range(N)])
+
+
+def test_rotation_matrices_follow_the_attitudes(states):
+    batch = BatchNonlinearController()
+    scalar = NonlinearController()
+    attitude = states['attitude'][:10].copy()
+    first = batch.rotation_matrix(attitude).copy()
+    attitude[3, 0] += 0.1
+    second = batch.rotation_matrix(attitude)
+    np.testing.assert_array_equal(second[3], scalar.rotation_matrix(attitude[3]))
+    np.testing.assert_array_equal(second[:3], first[:3])
+    # a different number of vehicles
+    assert batch.rotation_matrix(attitude[:4]).shape == (4, 3, 3)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import fast_controller
+from controller import NonlinearController
+from fast_controller import FastNonlinearController
+
+N = 20000
+
+
+@pytest.fixture(scope='module')
+def states():
+    rng = np.random.default_rng(3)
+    return dict(position_cmd=rng.normal(size=(N, 3)) * 5, velocity_cmd=rng.normal(size=(N, 3)) * 3,
+                acceleration_ff=rng.normal(size=(N, 3)) * 3, yaw_cmd=rng.uniform(-7, 7, N),
+                position=rng.normal(size=(N, 3)) * 5, velocity=rng.normal(size=(N, 3)) * 3,
+                attitude=rng.uniform(-1.2, 1.2, size=(N, 3)) * [1, 1, 3], body_rate=rng.normal(size=(N, 3)) * 3)
+
+
+@pytest.mark.parametrize('gains, count', [({}, N), (dict(k_p_x=3.3, k_p_p=17, k_p_yaw=2.2, k_d_z=1.7), N // 10)])
+def test_matches_nonlinear_controller(states, gains, count):
+    reference = NonlinearController()
+    fast = FastNonlinearController()
+    reference.set_gains(**gains)
+    fast.set_gains(**gains)
+    assert fast_controller.BACKEND in ('numba', 'python')
+    for i in range(count):
+        position_cmd, velocity_cmd = states['position_cmd'][i], states['velocity_cmd'][i]
+        acceleration_ff, yaw_cmd = states['acceleration_ff'][i], states['yaw_cmd'][i]
+        position, velocity = states['position'][i], states['velocity'][i]
+        attitude, body_rate = states['attitude'][i], states['body_rate'][i]
+
+        acceleration = reference.lateral_position_control(position_cmd[0:2], velocity_cmd[0:2], position[0:2],
+                                                          velocity[0:2], acceleration_ff[0:2])
+        thrust = reference.altitude_control(-position_cmd[2], -velocity_cmd[2], -position[2], -velocity[2],
+                                            attitude, 9.81 - acceleration_ff[2])
+        roll_pitch_rate = reference.roll_pitch_controller(acceleration, attitude, thrust)
+        yaw_rate = reference.yaw_control(yaw_cmd, attitude[2])
+        body_rate_cmd = np.array([roll_pitch_rate[0], roll_pitch_rate[1], yaw_rate])
+        moment = reference.body_rate_control(body_rate_cmd, body_rate)
+
+        fast_moment, fast_thrust, fast_acceleration, fast_body_rate_cmd = fast.cascade(
+            position_cmd, velocity_cmd, acceleration_ff, yaw_cmd, position, velocity, attitude, body_rate)
+        np.testing.assert_array_equal(fast_moment, moment)
+        assert fast_thrust == thrust
+        np.testing.assert_array_equal(fast_acceleration, acceleration)
+        np.testing.assert_array_equal(fast_body_rate_cmd, body_rate_cmd)
+
+        np.testing.assert_array_equal(fast.lateral_position_control(position_cmd[0:2], velocity_cmd[0:2],
+                                                                    position[0:2], velocity[0:2],
+                                                                    acceleration_ff[0:2]), acceleration)
+        assert fast.altitude_control(-position_cmd[2], -velocity_cmd[2], -position[2], -velocity[2], attitude,
+                                     9.81 - acceleration_ff[2]) == thrust
+        np.testing.assert_array_equal(fast.roll_pitch_controller(acceleration, attitude, thrust), roll_pitch_rate)
+        assert fast.yaw_control(yaw_cmd, attitude[2]) == yaw_rate
+        np.testing.assert_array_equal(fast.body_rate_control(body_rate_cmd, body_rate), moment)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from controller import NonlinearController
+from fast_controller import FastNonlinearController
+from frame_utils import euler2quaternion
+
+
+def random_attitudes(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    # roll and pitch well inside +-pi/2, yaw over the whole circle as the vehicle reports it
+    return rng.uniform([-1.2, -1.2, -np.pi], [1.2, 1.2, np.pi], size=(n, 3))
+
+
+@pytest.mark.parametrize('controller_class', [NonlinearController, FastNonlinearController])
+def test_quaternion_stages_match_euler(controller_class):
+    euler_controller = controller_class()
+    quaternion_controller = controller_class()
+    rng = np.random.default_rng(1)
+    for attitude in random_attitudes():
+        quaternion = euler2quaternion(*attitude.tolist())
+        acceleration_cmd = rng.normal(size=2) * 3
+        altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity = rng.normal(size=4)
+
+        thrust = euler_controller.altitude_control(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity,
+                                                   attitude, 9.81)
+        quaternion_thrust = quaternion_controller.altitude_control(altitude_cmd, vertical_velocity_cmd, altitude,
+                                                                   vertical_velocity, quaternion, 9.81)
+        assert quaternion_thrust == pytest.approx(thrust, rel=1e-12, abs=1e-12)
+
+        rates = euler_controller.roll_pitch_controller(acceleration_cmd, attitude, thrust)
+        quaternion_rates = quaternion_controller.roll_pitch_controller(acceleration_cmd, quaternion, thrust)
+        np.testing.assert_allclose(quaternion_rates, rates, rtol=1e-11, atol=1e-11)
+
+        yaw = quaternion_controller.attitude_yaw(quaternion)
+        assert yaw == pytest.approx(euler_controller.attitude_yaw(attitude), abs=1e-12)
+        assert quaternion_controller.yaw_control(0.7, yaw) == pytest.approx(
+            euler_controller.yaw_control(0.7, attitude[2]), abs=1e-12)
+
+
+def test_quaternion_rotation_matrix_matches_euler():
+    controller = NonlinearController()
+    for attitude in random_attitudes(100, seed=2):
+        matrix = controller.rotation_matrix(attitude).copy()
+        np.testing.assert_allclose(controller.rotation_matrix(euler2quaternion(*attitude.tolist())), matrix,
+                                   atol=1e-14)
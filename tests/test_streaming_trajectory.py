@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+from trajectory import StreamingTrajectory, load_trajectory
+
+TRAJECTORY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_trajectory.txt')
+
+
+@pytest.fixture(scope='module')
+def whole():
+    return load_trajectory(TRAJECTORY_FILE, time_mult=0.5, cache=False)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 4096])
+def test_matches_trajectory(whole, chunk_size):
+    streaming = StreamingTrajectory(TRAJECTORY_FILE, time_mult=0.5, chunk_size=chunk_size)
+    largest_window = 0
+    for current_time in np.arange(-1.0, whole.end_time + 2.0, 0.013):
+        expected = whole.evaluate(current_time)
+        actual = streaming.evaluate(current_time)
+        for expected_value, actual_value in zip(expected, actual):
+            np.testing.assert_array_equal(actual_value, expected_value)
+        assert streaming.segment_index(current_time) == whole.segment_index(current_time)
+        largest_window = max(largest_window, len(streaming.times))
+    assert streaming.end_time == whole.end_time
+    if chunk_size < 10:
+        assert largest_window < len(whole) // 10
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7])
+def test_shifted_continues_the_stream(whole, chunk_size):
+    expected = whole.shifted(100.0)
+    streaming = StreamingTrajectory(TRAJECTORY_FILE, time_mult=0.5, chunk_size=chunk_size).shifted(100.0)
+    for current_time in np.arange(99.0, expected.end_time + 1.0, 0.05):
+        for expected_value, actual_value in zip(expected.evaluate(current_time), streaming.evaluate(current_time)):
+            np.testing.assert_array_equal(actual_value, expected_value)
+
+
+def test_waypoints(whole):
+    streaming = StreamingTrajectory(TRAJECTORY_FILE, time_mult=0.5, chunk_size=3)
+    index = 0
+    while streaming.has_waypoint(index):
+        time, position = streaming.waypoint(index)
+        assert time == whole.waypoint(index)[0]
+        np.testing.assert_array_equal(position, whole.waypoint(index)[1])
+        index += 1
+    assert index == len(whole)
+
+
+def test_generator_source_and_dropped_samples():
+    def chunks():
+        for i in range(50):
+            t = np.arange(i * 100, (i + 1) * 100) * 0.05
+            yield t, np.stack((np.cos(t), np.sin(t), -3.0 + 0.0 * t), 1)
+
+    streaming = StreamingTrajectory(chunks)
+    for current_time in np.arange(0.0, 260.0, 0.7):
+        streaming.sample(current_time)
+    assert streaming.end_time == pytest.approx(4999 * 0.05)
+    assert len(streaming.times) <= 300
+    with pytest.raises(ValueError):
+        streaming.sample(1.0)
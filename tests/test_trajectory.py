@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+
+from controller import NonlinearController
+from trajectory import Trajectory, read_trajectory_file
+
+TRAJECTORY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_trajectory.txt')
+
+
+@pytest.fixture(scope='module')
+def flight_trajectory():
+    times, positions, yaws = read_trajectory_file(TRAJECTORY_FILE, cache=False)
+    # trajectory_control takes lists, as the original ControlsFlyer kept them
+    return [p for p in positions], list(yaws), list(times * 0.5 + 1000.0)
+
+
+def assert_same_commands(expected, actual):
+    position_cmd, velocity_cmd, yaw_cmd = expected
+    np.testing.assert_array_equal(actual[0], position_cmd)
+    np.testing.assert_array_equal(actual[1], velocity_cmd)
+    assert actual[2] == yaw_cmd
+
+
+def test_sample_matches_trajectory_control(flight_trajectory):
+    positions, yaws, times = flight_trajectory
+    controller = NonlinearController()
+    trajectory = Trajectory(positions, times, yaws)
+    rng = np.random.default_rng(0)
+    # increasing times (the cursor path), every sample time, then random jumps (the search path)
+    queries = np.concatenate((np.linspace(times[0], times[-1], 2000), times, rng.uniform(times[0], times[-1], 500)))
+    for current_time in queries:
+        assert_same_commands(controller.trajectory_control(positions, yaws, times, current_time),
+                             trajectory.sample(current_time))
+
+
+def test_sample_clamps_to_the_end(flight_trajectory):
+    positions, yaws, times = flight_trajectory
+    controller = NonlinearController()
+    trajectory = Trajectory(positions, times, yaws)
+    for current_time in (times[-1], times[-1] + 1e-9, times[-1] + 0.5, times[-1] + 100.0):
+        expected = controller.trajectory_control(positions, yaws, times, current_time)
+        assert_same_commands(expected, trajectory.sample(current_time))
+        np.testing.assert_array_equal(trajectory.sample(current_time)[0], positions[-1])
+        np.testing.assert_array_equal(trajectory.sample(current_time)[1], np.zeros(3))
+
+
+def test_segment_index_cursor():
+    trajectory = Trajectory(np.zeros((4, 3)), [0.0, 1.0, 2.0, 3.0], np.zeros(4))
+    assert trajectory.segment_index(-0.5) == -1
+    assert [trajectory.segment_index(t) for t in (0.0, 0.5, 1.0, 2.9, 3.0, 7.0)] == [0, 0, 1, 2, 3, 3]
+    # a jump backwards falls back to the binary search
+    assert trajectory.segment_index(1.5) == 1
+
+
+def test_sample_returns_copies():
+    trajectory = Trajectory([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]], [0.0, 1.0], [0.0, 0.0])
+    position_cmd, velocity_cmd, _ = trajectory.sample(2.0)
+    position_cmd += 1.0
+    velocity_cmd += 1.0
+    np.testing.assert_array_equal(trajectory.sample(2.0)[0], [1.0, 0.0, 0.0])
+    np.testing.assert_array_equal(trajectory.sample(2.0)[1], np.zeros(3))
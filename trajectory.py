@@ -0,0 +1,652 @@
+"""
+Trajectory containers used by the position loop
+
+components:
+    contiguous storage of a timed trajectory
+    amortized O(1) lookup of the active segment
+    C2 cubic spline trajectory with analytic velocity and acceleration
+    streaming trajectory holding a bounded window of samples around the current time
+    loading of test_trajectory.txt-style files, with a binary cache
+"""
+import copy
+import hashlib
+import itertools
+import os
+import threading
+import zipfile
+
+import numpy as np
+
+# default limit on the SplineTrajectory feedforward acceleration norm, in m/s^2
+DEFAULT_MAX_ACCELERATION_FF = 8.0
+# rows read at once by StreamingTrajectory
+DEFAULT_CHUNK_SIZE = 4096
+
+
+def trajectory_cache_filename(filename):
+    """Binary cache file used by read_trajectory_file for filename"""
+    directory, basename = os.path.split(filename)
+    return os.path.join(directory, '.' + basename + '.cache.npz')
+
+
+def _file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _segment_yaws(positions):
+    # yaw along each segment, the last point keeps the yaw of the last segment
+    yaws = np.empty(len(positions))
+    if len(positions) > 1:
+        delta = np.diff(positions, axis=0)
+        yaws[:-1] = np.arctan2(delta[:, 1], delta[:, 0])
+        yaws[-1] = yaws[-2]
+    else:
+        yaws[:] = 0.0
+    return yaws
+
+
+def _parse_trajectory_file(filename):
+    data = np.loadtxt(filename, delimiter=',', dtype=np.float64, ndmin=2)
+    times = np.ascontiguousarray(data[:, 0])
+    positions = np.ascontiguousarray(data[:, 1:4])
+    return times, positions, _segment_yaws(positions)
+
+
+def read_trajectory_chunks(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parse a trajectory file as read_trajectory_file does, chunk_size rows at a time
+
+    Yields: tuple of numpy arrays (times, positions) of at most chunk_size rows
+    """
+    with open(filename) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                return
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                data = np.loadtxt(lines, delimiter=',', dtype=np.float64, ndmin=2)
+                yield np.ascontiguousarray(data[:, 0]), np.ascontiguousarray(data[:, 1:4])
+
+
+def read_trajectory_file(filename='test_trajectory.txt', cache=True):
+    """Parse a timed trajectory file with rows of (time, north, east, down)
+
+    Yaw points along each segment, the last point keeps the yaw of the last segment.
+    With cache enabled the parsed arrays are stored next to the file (see
+    trajectory_cache_filename) and reused while the file size and modification time are
+    unchanged, or its content hash still matches.
+
+    Args:
+        filename: comma separated trajectory file
+        cache: use and refresh the binary cache
+
+    Returns: tuple of numpy arrays (times, positions, yaws), times as written in the file
+    """
+    if not cache:
+        return _parse_trajectory_file(filename)
+
+    stat = os.stat(filename)
+    cache_filename = trajectory_cache_filename(filename)
+    digest = None
+    try:
+        with np.load(cache_filename) as cached:
+            fresh = int(cached['mtime_ns']) == stat.st_mtime_ns and int(cached['size']) == stat.st_size
+            if not fresh:
+                digest = _file_digest(filename)
+                fresh = str(cached['sha1']) == digest
+            if fresh:
+                return cached['times'], cached['positions'], cached['yaws']
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+
+    times, positions, yaws = _parse_trajectory_file(filename)
+    if digest is None:
+        digest = _file_digest(filename)
+    # write then rename, so concurrent readers never see a partial cache
+    temporary_filename = '{}.{}.tmp.npz'.format(cache_filename[:-len('.npz')], os.getpid())
+    try:
+        np.savez(temporary_filename, times=times, positions=positions, yaws=yaws, mtime_ns=stat.st_mtime_ns,
+                 size=stat.st_size, sha1=digest)
+        os.replace(temporary_filename, cache_filename)
+    except OSError:
+        # e.g. a read-only directory, the cache is only an optimization
+        pass
+    return times, positions, yaws
+
+
+def load_trajectory(filename='test_trajectory.txt', time_mult=1.0, start_time=0.0, cache=True, spline=False,
+                    stream=False):
+    """Load a timed trajectory file with rows of (time, north, east, down)
+
+    Args:
+        filename: comma separated trajectory file
+        time_mult: a multiplier to decrease the total time of the trajectory
+        start_time: time (in seconds) added to every sample time
+        cache: use the binary cache of read_trajectory_file
+        spline: fit a SplineTrajectory instead of interpolating linearly
+        stream: read the file while flying into a StreamingTrajectory, the cache is not used
+
+    Returns: Trajectory, SplineTrajectory or StreamingTrajectory
+    """
+    if stream:
+        if spline:
+            raise ValueError('a spline is fitted through every sample, it cannot be streamed')
+        return StreamingTrajectory(filename, time_mult=time_mult, start_time=start_time)
+    times, positions, yaws = read_trajectory_file(filename, cache)
+    trajectory_class = SplineTrajectory if spline else Trajectory
+    return trajectory_class(positions, times * time_mult + start_time, yaws)
+
+
+class Trajectory(object):
+
+    def __init__(self, position_trajectory, time_trajectory, yaw_trajectory):
+        """Store a timed trajectory as contiguous arrays
+
+        Args:
+            position_trajectory: sequence of 3-element NED positions, or an (N, 3) array
+            time_trajectory: sequence of N increasing times (in seconds)
+            yaw_trajectory: sequence of N yaw commands in radians
+        """
+        self.positions = np.ascontiguousarray(position_trajectory, dtype=np.float64).reshape(-1, 3)
+        self.times = np.ascontiguousarray(time_trajectory, dtype=np.float64)
+        self.yaws = np.ascontiguousarray(yaw_trajectory, dtype=np.float64)
+        if not (len(self.positions) == len(self.times) == len(self.yaws)):
+            raise ValueError('position, time and yaw trajectories must have the same length')
+        if len(self.times) == 0:
+            raise ValueError('trajectory must contain at least one point')
+        # per-segment velocities, computed once instead of on every query
+        self.velocities = np.zeros_like(self.positions)
+        if len(self.times) > 1:
+            self.velocities[:-1] = (self.positions[1:] - self.positions[:-1]) / \
+                                   (self.times[1:] - self.times[:-1])[:, np.newaxis]
+        self._zero_velocity = np.zeros(3)
+        self._zero_acceleration = np.zeros(3)
+        # index of the segment start used by the last query
+        self._index = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def shifted(self, offset):
+        """Copy of the trajectory with every time shifted by offset seconds (arrays are shared)"""
+        return Trajectory(self.positions, self.times + offset, self.yaws)
+
+    @property
+    def start_time(self):
+        return self.times[0]
+
+    @property
+    def end_time(self):
+        return self.times[-1]
+
+    def waypoint(self, index):
+        """Time and position of sample index
+
+        Returns: tuple (time, 3-element position)
+        """
+        if not 0 <= index < len(self.times):
+            raise IndexError('trajectory has no waypoint {}'.format(index))
+        return self.times[index], self.positions[index]
+
+    def has_waypoint(self, index):
+        return 0 <= index < len(self.times)
+
+    def segment_index(self, current_time):
+        """Index i of the sample such that times[i] <= current_time < times[i + 1]
+
+        The last queried index is kept as a cursor, so a monotonically increasing
+        current_time costs O(1) per call. Any jump falls back to a binary search.
+
+        Returns: -1 before the start of the trajectory, len(self) - 1 at or after its end
+        """
+        times = self.times
+        last = len(times) - 1
+        i = self._index
+        if times[i] <= current_time:
+            if i >= last or current_time < times[i + 1]:
+                return i
+            i += 1
+            if i >= last or current_time < times[i + 1]:
+                self._index = i
+                return i
+        i = int(np.searchsorted(times, current_time, side='right')) - 1
+        self._index = max(i, 0)
+        return i
+
+    def sample(self, current_time):
+        """Generate a commanded position, velocity and yaw at the given time
+
+        Gives the same commands as NonlinearController.trajectory_control: linear
+        interpolation between samples, holding the final position with zero velocity
+        once the trajectory is over. Before the first sample the first position is held.
+
+        Args:
+            current_time: float corresponding to the current time in seconds
+
+        Returns: tuple (commanded position, commanded velocity, commanded yaw)
+        """
+        i = self.segment_index(current_time)
+        if i < 0:
+            return self.positions[0].copy(), self._zero_velocity.copy(), self.yaws[0]
+        if i >= len(self.times) - 1:
+            return self.positions[-1].copy(), self._zero_velocity.copy(), self.yaws[-1]
+
+        position0 = self.positions[i]
+        position1 = self.positions[i + 1]
+        time0 = self.times[i]
+        time1 = self.times[i + 1]
+        position_cmd = (position1 - position0) * (current_time - time0) / (time1 - time0) + position0
+        return (position_cmd, self.velocities[i].copy(), self.yaws[i])
+
+    def evaluate(self, current_time):
+        """Commanded position, velocity, feedforward acceleration and yaw at the given time
+
+        Linear interpolation has no acceleration feedforward, so it is always zero.
+
+        Returns: tuple (commanded position, commanded velocity, commanded acceleration, commanded yaw)
+        """
+        position_cmd, velocity_cmd, yaw_cmd = self.sample(current_time)
+        return (position_cmd, velocity_cmd, self._zero_acceleration.copy(), yaw_cmd)
+
+    def _segments(self, times):
+        # segment index clipped to a valid segment, plus masks for before start / after end
+        index = np.searchsorted(self.times, times, side='right') - 1
+        before = index < 0
+        after = index >= len(self.times) - 1
+        return np.clip(index, 0, max(len(self.times) - 2, 0)), before, after
+
+    def _hold_ends(self, times, before, after, positions, velocities, accelerations, yaws):
+        for mask, i in ((before, 0), (after, -1)):
+            positions[mask] = self.positions[i]
+            velocities[mask] = 0.0
+            accelerations[mask] = 0.0
+            yaws[mask] = self.yaws[i]
+        return positions, velocities, accelerations, yaws
+
+    def evaluate_many(self, times):
+        """Vectorized evaluate over an array of M times
+
+        Returns: tuple of numpy arrays (positions (M,3), velocities (M,3), accelerations (M,3), yaws (M,))
+        """
+        times = np.asarray(times, dtype=np.float64)
+        i, before, after = self._segments(times)
+        if len(self.times) > 1:
+            position0 = self.positions[i]
+            position1 = self.positions[i + 1]
+            time0 = self.times[i]
+            time1 = self.times[i + 1]
+            positions = (position1 - position0) * (times - time0)[:, np.newaxis] / (time1 - time0)[:, np.newaxis] + \
+                position0
+            velocities = self.velocities[i]
+        else:
+            positions = np.empty((len(times), 3))
+            velocities = np.empty((len(times), 3))
+        return self._hold_ends(times, before, after, positions, velocities, np.zeros((len(times), 3)),
+                               self.yaws[i])
+
+
+def _clamped_cubic_spline(times, positions):
+    """Second derivatives of the C2 cubic spline through positions with zero end velocities
+
+    Args:
+        times: (N,) increasing knot times, N >= 2
+        positions: (N,3) knot positions
+
+    Returns: (N,3) second derivatives at the knots
+    """
+    n = len(times)
+    h = np.diff(times)
+    slopes = np.diff(positions, axis=0) / h[:, np.newaxis]
+    # tridiagonal system: sub[i] * M[i-1] + diag[i] * M[i] + sup[i] * M[i+1] = rhs[i]
+    sub = np.zeros(n)
+    diag = np.empty(n)
+    sup = np.zeros(n)
+    rhs = np.empty((n, 3))
+    sub[1:-1] = h[:-1]
+    diag[1:-1] = 2 * (h[:-1] + h[1:])
+    sup[1:-1] = h[1:]
+    rhs[1:-1] = 6 * (slopes[1:] - slopes[:-1])
+    # clamped ends, zero velocity at the first and last knot
+    diag[0] = 2 * h[0]
+    sup[0] = h[0]
+    rhs[0] = 6 * slopes[0]
+    sub[-1] = h[-1]
+    diag[-1] = 2 * h[-1]
+    rhs[-1] = -6 * slopes[-1]
+
+    # scipy is optional and imported here, not at module load, to keep startup fast
+    try:
+        from scipy.linalg import solve_banded
+    except ImportError:
+        solve_banded = None
+    if solve_banded is not None:
+        banded = np.zeros((3, n))
+        banded[0, 1:] = sup[:-1]
+        banded[1] = diag
+        banded[2, :-1] = sub[1:]
+        return solve_banded((1, 1), banded, rhs)
+
+    # Thomas algorithm
+    for i in range(1, n):
+        w = sub[i] / diag[i - 1]
+        diag[i] -= w * sup[i - 1]
+        rhs[i] -= w * rhs[i - 1]
+    second_derivatives = np.empty((n, 3))
+    second_derivatives[-1] = rhs[-1] / diag[-1]
+    for i in range(n - 2, -1, -1):
+        second_derivatives[i] = (rhs[i] - sup[i] * second_derivatives[i + 1]) / diag[i]
+    return second_derivatives
+
+
+class SplineTrajectory(Trajectory):
+
+    def __init__(self, position_trajectory, time_trajectory, yaw_trajectory,
+                 max_acceleration=DEFAULT_MAX_ACCELERATION_FF):
+        """Timed trajectory through the samples along a C2 cubic spline
+
+        The spline is fitted once (zero velocity at both ends). Position, velocity and
+        acceleration then come from the cubic of the active segment, so velocity and
+        acceleration are continuous at the samples. Yaw is held per segment as in
+        Trajectory.
+
+        Sharp corners in the samples make the spline acceleration far larger than the
+        vehicle can follow, so the acceleration returned as feedforward is limited in norm.
+
+        Args:
+            position_trajectory, time_trajectory, yaw_trajectory: as for Trajectory
+            max_acceleration: limit on the feedforward acceleration norm in m/s^2, None for no limit
+        """
+        super().__init__(position_trajectory, time_trajectory, yaw_trajectory)
+        self.max_acceleration = max_acceleration
+        # per-segment cubic a + b*s + c*s^2 + d*s^3 with s the time into the segment
+        self.coefficients = np.zeros((max(len(self.times) - 1, 0), 4, 3))
+        if len(self.times) > 1:
+            h = np.diff(self.times)[:, np.newaxis]
+            m = _clamped_cubic_spline(self.times, self.positions)
+            self.coefficients[:, 0] = self.positions[:-1]
+            self.coefficients[:, 1] = (self.positions[1:] - self.positions[:-1]) / h - h * (2 * m[:-1] + m[1:]) / 6
+            self.coefficients[:, 2] = m[:-1] / 2
+            self.coefficients[:, 3] = (m[1:] - m[:-1]) / (6 * h)
+
+    def shifted(self, offset):
+        """Copy of the trajectory with every time shifted by offset seconds (the fit is shared)"""
+        trajectory = copy.copy(self)
+        trajectory.times = self.times + offset
+        trajectory._index = 0
+        return trajectory
+
+    def sample(self, current_time):
+        """Generate a commanded position, velocity and yaw at the given time
+
+        Returns: tuple (commanded position, commanded velocity, commanded yaw)
+        """
+        position_cmd, velocity_cmd, _, yaw_cmd = self.evaluate(current_time)
+        return (position_cmd, velocity_cmd, yaw_cmd)
+
+    def evaluate(self, current_time):
+        """Commanded position, velocity, feedforward acceleration and yaw at the given time
+
+        Before the first sample the first position is held, after the last one the final
+        position, both with zero velocity and acceleration.
+
+        Returns: tuple (commanded position, commanded velocity, commanded acceleration, commanded yaw)
+        """
+        i = self.segment_index(current_time)
+        if i < 0:
+            return self.positions[0].copy(), self._zero_velocity.copy(), self._zero_acceleration.copy(), self.yaws[0]
+        if i >= len(self.times) - 1:
+            return (self.positions[-1].copy(), self._zero_velocity.copy(), self._zero_acceleration.copy(),
+                    self.yaws[-1])
+
+        a, b, c, d = self.coefficients[i]
+        s = current_time - self.times[i]
+        position_cmd = a + s * (b + s * (c + s * d))
+        velocity_cmd = b + s * (2 * c + 3 * s * d)
+        acceleration_cmd = 2 * c + 6 * s * d
+        if self.max_acceleration is not None:
+            norm = np.sqrt(np.dot(acceleration_cmd, acceleration_cmd))
+            if norm > self.max_acceleration:
+                acceleration_cmd *= self.max_acceleration / norm
+        return (position_cmd, velocity_cmd, acceleration_cmd, self.yaws[i])
+
+    def evaluate_many(self, times):
+        """Vectorized evaluate over an array of M times
+
+        Returns: tuple of numpy arrays (positions (M,3), velocities (M,3), accelerations (M,3), yaws (M,))
+        """
+        times = np.asarray(times, dtype=np.float64)
+        i, before, after = self._segments(times)
+        if len(self.times) > 1:
+            a, b, c, d = np.moveaxis(self.coefficients[i], 1, 0)
+            s = (times - self.times[i])[:, np.newaxis]
+            positions = a + s * (b + s * (c + s * d))
+            velocities = b + s * (2 * c + 3 * s * d)
+            accelerations = 2 * c + 6 * s * d
+            if self.max_acceleration is not None:
+                norm = np.linalg.norm(accelerations, axis=1, keepdims=True)
+                accelerations *= np.minimum(1.0, self.max_acceleration / np.maximum(norm, 1e-12))
+        else:
+            positions = np.empty((len(times), 3))
+            velocities = np.empty((len(times), 3))
+            accelerations = np.empty((len(times), 3))
+        return self._hold_ends(times, before, after, positions, velocities, accelerations, self.yaws[i])
+
+
+class StreamingTrajectory(object):
+
+    def __init__(self, source, time_mult=1.0, start_time=0.0, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Timed trajectory read in chunks while it is flown
+
+        Only a window of samples is held: the chunks are read as the queries reach the end
+        of the window, and the samples behind the active segment (and behind the last
+        waypoint read) are dropped whenever a chunk is appended. With the monotonically
+        increasing times of a flight the memory used is bounded by about two chunks,
+        whatever the length of the mission. Queries before the window raise ValueError.
+
+        The window and both cursors are guarded by a lock, so the waypoint queries of the
+        telemetry callbacks and the evaluate calls of a scheduled position stage can come
+        from different threads.
+
+        Commands are the same as those of a Trajectory of the whole file. end_time is
+        infinite until the last chunk has been read.
+
+        Args:
+            source: trajectory file name, or a callable returning an iterable of
+                (times, positions) chunks, e.g. a generator function
+            time_mult: a multiplier to decrease the total time of the trajectory
+            start_time: time (in seconds) added to every sample time
+            chunk_size: rows read from a file at once
+        """
+        self.source = source
+        self.time_mult = time_mult
+        self.time_offset = start_time
+        self.chunk_size = chunk_size
+        if isinstance(source, str):
+            self._chunks = read_trajectory_chunks(source, chunk_size)
+        else:
+            self._chunks = iter(source())
+        self._exhausted = False
+        # global index of the first sample of the window
+        self._first = 0
+        self.times = np.empty(0)
+        self.positions = np.empty((0, 3))
+        self.yaws = np.empty(0)
+        self.velocities = np.empty((0, 3))
+        self._zero_velocity = np.zeros(3)
+        self._zero_acceleration = np.zeros(3)
+        # window index of the segment used by the last query, global index of the last waypoint read
+        self._index = 0
+        self._queried = False
+        self._waypoint = None
+        self._lock = threading.RLock()
+        # two samples give the yaw of the first one
+        while len(self.times) < 2 and self._extend():
+            pass
+        if len(self.times) == 0:
+            raise ValueError('trajectory must contain at least one point')
+        self._start_time = self.times[0]
+
+    def shifted(self, offset):
+        """Trajectory continuing this one, every time shifted by offset seconds
+
+        Nothing is read: the window already read (at least the first chunk) is shifted and
+        the open source is handed over to the new trajectory, so this one can no longer read
+        further chunks.
+        """
+        with self._lock:
+            trajectory = copy.copy(self)
+            trajectory._lock = threading.RLock()
+            trajectory.time_offset = self.time_offset + offset
+            trajectory.times = self.times + offset
+            trajectory._start_time = self._start_time + offset
+            trajectory.velocities = trajectory._window_velocities()
+            self._chunks = None
+        return trajectory
+
+    @property
+    def start_time(self):
+        return self._start_time
+
+    @property
+    def end_time(self):
+        with self._lock:
+            return self.times[-1] if self._exhausted else float('inf')
+
+    def _extend(self):
+        """Append the next chunk to the window, dropping the samples behind both cursors
+
+        Returns: False once the source is exhausted
+        """
+        if self._chunks is None:
+            raise ValueError('the source was handed over to a shifted trajectory')
+        try:
+            chunk_times, chunk_positions = next(self._chunks)
+        except StopIteration:
+            self._exhausted = True
+            return False
+        cursors = []
+        if self._queried:
+            cursors.append(self._index)
+        if self._waypoint is not None:
+            cursors.append(self._waypoint - self._first)
+        drop = max(min(cursors), 0) if cursors else 0
+        chunk_times = np.asarray(chunk_times, dtype=np.float64) * self.time_mult + self.time_offset
+        self.times = np.concatenate((self.times[drop:], chunk_times))
+        self.positions = np.concatenate((self.positions[drop:],
+                                         np.asarray(chunk_positions, dtype=np.float64).reshape(-1, 3)))
+        self._first += drop
+        self._index -= drop
+        # the last sample of the window gets its yaw and velocity once the next chunk is read
+        self.yaws = _segment_yaws(self.positions)
+        self.velocities = self._window_velocities()
+        return True
+
+    def _window_velocities(self):
+        # per-segment velocities of the window, from the shifted times as Trajectory.shifted does
+        velocities = np.zeros_like(self.positions)
+        if len(self.times) > 1:
+            velocities[:-1] = (self.positions[1:] - self.positions[:-1]) / \
+                              (self.times[1:] - self.times[:-1])[:, np.newaxis]
+        return velocities
+
+    def _read_to(self, index):
+        """Read chunks until the global sample index is in the window
+
+        Returns: False if the trajectory has fewer samples
+        """
+        while index - self._first >= len(self.times):
+            if self._exhausted or not self._extend():
+                return False
+        return True
+
+    def waypoint(self, index):
+        """Time and position of sample index, reading ahead as needed
+
+        The samples before index may be dropped afterwards, so waypoints must be read in
+        increasing order.
+
+        Returns: tuple (time, 3-element position)
+        """
+        with self._lock:
+            if index < self._first:
+                raise IndexError('waypoint {} was dropped from the streaming window'.format(index))
+            self._waypoint = index
+            if not self._read_to(index):
+                raise IndexError('trajectory has no waypoint {}'.format(index))
+            return self.times[index - self._first], self.positions[index - self._first]
+
+    def has_waypoint(self, index):
+        with self._lock:
+            return index >= 0 and self._read_to(index)
+
+    def _window_segment(self, current_time):
+        # window index of the active segment, as Trajectory.segment_index
+        self._queried = True
+        while not self._exhausted and current_time >= self.times[-1]:
+            # at least the last sample of the window is active, the ones before can go
+            self._index = len(self.times) - 1
+            self._extend()
+        times = self.times
+        if current_time < times[0]:
+            if self._first > 0:
+                raise ValueError('time {} is before the streaming window'.format(current_time))
+            self._index = 0
+            return -1
+        last = len(times) - 1
+        i = self._index
+        if times[i] <= current_time:
+            if i >= last or current_time < times[i + 1]:
+                return i
+            i += 1
+            if i >= last or current_time < times[i + 1]:
+                self._index = i
+                return i
+        i = int(np.searchsorted(times, current_time, side='right')) - 1
+        self._index = i
+        return i
+
+    def segment_index(self, current_time):
+        """Global index i of the sample such that times[i] <= current_time < times[i + 1]
+
+        Returns: -1 before the start of the trajectory, the index of the last sample at or
+            after its end
+        """
+        with self._lock:
+            i = self._window_segment(current_time)
+            return i if i < 0 else self._first + i
+
+    def sample(self, current_time):
+        """Commanded position, velocity and yaw at the given time, as Trajectory.sample
+
+        Returns: tuple (commanded position, commanded velocity, commanded yaw)
+        """
+        with self._lock:
+            i = self._window_segment(current_time)
+            # the arrays of this window, _extend replaces them instead of writing into them
+            times = self.times
+            positions = self.positions
+            velocities = self.velocities
+            yaws = self.yaws
+        if i < 0:
+            return positions[0].copy(), self._zero_velocity.copy(), yaws[0]
+        if i >= len(times) - 1:
+            return positions[-1].copy(), self._zero_velocity.copy(), yaws[-1]
+
+        position0 = positions[i]
+        position1 = positions[i + 1]
+        time0 = times[i]
+        time1 = times[i + 1]
+        position_cmd = (position1 - position0) * (current_time - time0) / (time1 - time0) + position0
+        return (position_cmd, velocities[i].copy(), yaws[i])
+
+    def evaluate(self, current_time):
+        """Commanded position, velocity, zero feedforward acceleration and yaw, as Trajectory.evaluate
+
+        Returns: tuple (commanded position, commanded velocity, commanded acceleration, commanded yaw)
+        """
+        position_cmd, velocity_cmd, yaw_cmd = self.sample(current_time)
+        return (position_cmd, velocity_cmd, self._zero_acceleration.copy(), yaw_cmd)
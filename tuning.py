@@ -0,0 +1,246 @@
+"""
+Gain tuning for NonlinearController
+
+components:
+    grid, random and cross-entropy (CMA-style) gain searches
+    scoring of candidates with the offline simulator
+    parallel evaluation with a resumable result cache
+"""
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from controller import NonlinearController
+from mission_metrics import (DEFAULT_THRESHOLD_HORIZONTAL_ERROR, DEFAULT_THRESHOLD_VERTICAL_ERROR,
+                             DEFAULT_THRESHOLD_TIME)
+from simulator import Simulation
+from trajectory import load_trajectory
+
+# (low, high) bounds of each tuned gain
+DEFAULT_SEARCH_SPACE = {
+    'k_p_z': (1.0, 10.0),
+    'k_d_z': (0.5, 6.0),
+    'k_p_x': (1.0, 10.0),
+    'k_d_x': (0.5, 6.0),
+    'k_p_y': (1.0, 10.0),
+    'k_d_y': (0.5, 6.0),
+    'k_p_pitch': (2.0, 15.0),
+    'k_p_roll': (2.0, 15.0),
+    'k_p_yaw': (0.5, 5.0),
+    'k_p_p': (5.0, 40.0),
+    'k_p_q': (5.0, 40.0),
+    'k_p_r': (1.0, 10.0),
+}
+
+# added to the score of a failed mission so every successful candidate ranks first
+FAILURE_PENALTY = 10.0
+
+
+def grid_candidates(space, points_per_gain=3):
+    """Every combination of points_per_gain evenly spaced values of each gain"""
+    names = sorted(space)
+    axes = [np.linspace(space[name][0], space[name][1], points_per_gain) for name in names]
+    for values in np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(names)):
+        yield dict(zip(names, values.tolist()))
+
+
+def random_candidates(space, samples, seed=0):
+    """samples gain sets drawn uniformly from the search space"""
+    rng = np.random.default_rng(seed)
+    names = sorted(space)
+    low = np.array([space[name][0] for name in names])
+    high = np.array([space[name][1] for name in names])
+    for values in rng.uniform(low, high, size=(samples, len(names))):
+        yield dict(zip(names, values.tolist()))
+
+
+def score(metrics, threshold_horizontal_error=DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+          threshold_vertical_error=DEFAULT_THRESHOLD_VERTICAL_ERROR, threshold_time=DEFAULT_THRESHOLD_TIME):
+    """Cost of a simulated mission, lower is better
+
+    Maximum and mean errors are normalized by their thresholds, mission time by the time
+    threshold. Failed missions get FAILURE_PENALTY added.
+    """
+    cost = (metrics['maximum_horizontal_error'] / threshold_horizontal_error +
+            metrics['maximum_vertical_error'] / threshold_vertical_error +
+            0.5 * metrics['average_horizontal_error'] / threshold_horizontal_error +
+            0.5 * metrics['average_vertical_error'] / threshold_vertical_error +
+            0.1 * metrics['mission_time'] / threshold_time)
+    if not metrics['mission_success']:
+        cost += FAILURE_PENALTY
+    return cost if math.isfinite(cost) else float('inf')
+
+
+_worker_trajectories = {}
+
+
+def evaluate(gains, trajectory_file='test_trajectory.txt', time_mult=0.5):
+    """Fly the trajectory offline with the given gains
+
+    Returns: dict of the Simulation.mission_score metrics
+    """
+    key = (trajectory_file, time_mult)
+    if key not in _worker_trajectories:
+        _worker_trajectories[key] = load_trajectory(trajectory_file, time_mult=time_mult)
+    trajectory = _worker_trajectories[key]
+
+    controller = NonlinearController()
+    controller.set_gains(**gains)
+    with np.errstate(all='ignore'):
+        sim = Simulation(trajectory, controller=controller).run()
+    return sim.mission_score()
+
+
+class ResultCache(object):
+
+    def __init__(self, filename=None):
+        """Evaluated candidates keyed by gain vector, appended to a JSON lines file
+
+        Args:
+            filename: cache file, results already in it are loaded. None keeps results in memory only.
+        """
+        self.filename = filename
+        self._results = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        result = json.loads(line)
+                        self._results[self.key(result['config'], result['gains'])] = result
+
+    @staticmethod
+    def key(config, gains):
+        return json.dumps([config, sorted((name, round(value, 9)) for name, value in gains.items())])
+
+    def get(self, config, gains):
+        return self._results.get(self.key(config, gains))
+
+    def add(self, result):
+        self._results[self.key(result['config'], result['gains'])] = result
+        if self.filename is not None:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+    def results(self, config):
+        return [r for r in self._results.values() if r['config'] == config]
+
+
+def _evaluate_candidate(gains, config):
+    metrics = evaluate(gains, config['trajectory'], config['time_mult'])
+    return dict(config=config, gains=gains, metrics=metrics, score=score(metrics))
+
+
+def evaluate_candidates(candidates, config, cache, workers=None):
+    """Score every candidate not already in the cache, in parallel
+
+    Returns: list of results (dicts with config, gains, metrics and score) for all candidates
+    """
+    results = []
+    pending = []
+    for gains in candidates:
+        cached = cache.get(config, gains)
+        if cached is not None:
+            results.append(cached)
+        else:
+            pending.append(gains)
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_evaluate_candidate, gains, config) for gains in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                cache.add(result)
+                results.append(result)
+    return results
+
+
+def cross_entropy_search(space, config, cache, population=32, elite_fraction=0.25, iterations=10, seed=0,
+                         workers=None):
+    """Adaptive Gaussian search (cross-entropy method, a simplified CMA-ES)
+
+    Each iteration samples a population around the current mean, then moves the mean and
+    per-gain standard deviation to the elite candidates.
+
+    Returns: list of every evaluated result
+    """
+    rng = np.random.default_rng(seed)
+    names = sorted(space)
+    low = np.array([space[name][0] for name in names])
+    high = np.array([space[name][1] for name in names])
+    mean = (low + high) / 2
+    std = (high - low) / 4
+    n_elite = max(1, int(population * elite_fraction))
+    all_results = []
+    for _ in range(iterations):
+        samples = np.clip(rng.normal(mean, std, size=(population, len(names))), low, high)
+        candidates = [dict(zip(names, values.tolist())) for values in samples]
+        results = evaluate_candidates(candidates, config, cache, workers)
+        all_results.extend(results)
+        elite = sorted(results, key=lambda r: r['score'])[:n_elite]
+        elite_values = np.array([[r['gains'][name] for name in names] for r in elite])
+        mean = elite_values.mean(axis=0)
+        std = np.maximum(elite_values.std(axis=0), (high - low) * 1e-3)
+    return all_results
+
+
+def ranked(results):
+    """Unique results, best score first"""
+    unique = {ResultCache.key(r['config'], r['gains']): r for r in results}
+    return sorted(unique.values(), key=lambda r: r['score'])
+
+
+def print_table(results, top=10):
+    names = sorted(results[0]['gains']) if results else []
+    header = '{:>4s} {:>8s} {:>7s} {:>7s} {:>7s} {:>7s} '.format('rank', 'score', 'maxH', 'maxV', 'time', 'ok')
+    print(header + ' '.join('{:>9s}'.format(name) for name in names))
+    for rank, r in enumerate(results[:top], 1):
+        m = r['metrics']
+        line = '{:4d} {:8.3f} {:7.3f} {:7.3f} {:7.2f} {:>7s} '.format(
+            rank, r['score'], m['maximum_horizontal_error'], m['maximum_vertical_error'], m['mission_time'],
+            str(m['mission_success']))
+        print(line + ' '.join('{:9.3f}'.format(r['gains'][name]) for name in names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--strategy', choices=['grid', 'random', 'cem'], default='random')
+    parser.add_argument('--samples', type=int, default=64, help='random: number of candidates')
+    parser.add_argument('--points', type=int, default=2, help='grid: values per gain')
+    parser.add_argument('--population', type=int, default=32, help='cem: candidates per iteration')
+    parser.add_argument('--iterations', type=int, default=10, help='cem: number of iterations')
+    parser.add_argument('--gains', type=str, nargs='+', default=sorted(DEFAULT_SEARCH_SPACE),
+                        help='gains to tune, the rest keep their NonlinearController defaults')
+    parser.add_argument('--trajectory', type=str, default='test_trajectory.txt')
+    parser.add_argument('--time-mult', type=float, default=0.5)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', type=str, default='tuning_cache.jsonl')
+    parser.add_argument('--output', type=str, default='best_gains.json')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    search_space = {name: DEFAULT_SEARCH_SPACE[name] for name in args.gains}
+    run_config = dict(trajectory=args.trajectory, time_mult=args.time_mult)
+    result_cache = ResultCache(args.cache)
+
+    if args.strategy == 'grid':
+        all_results = evaluate_candidates(grid_candidates(search_space, args.points), run_config, result_cache,
+                                          args.workers)
+    elif args.strategy == 'random':
+        all_results = evaluate_candidates(random_candidates(search_space, args.samples, args.seed), run_config,
+                                          result_cache, args.workers)
+    else:
+        all_results = cross_entropy_search(search_space, run_config, result_cache, args.population,
+                                           iterations=args.iterations, seed=args.seed, workers=args.workers)
+
+    table = ranked(all_results)
+    print_table(table, args.top)
+    if table:
+        best = dict(NonlinearController().gains(), **table[0]['gains'])
+        with open(args.output, 'w') as f:
+            json.dump(dict(gains=best, metrics=table[0]['metrics'], score=table[0]['score']), f, indent=2)
+        print('Best gains written to', args.output)
@@ -1,14 +1,41 @@
-import traceback
+import math
+import socket
 
 import numpy as np
 
 from udacidrone import Drone
 import time
-visdom_available= True
-try:
-    import visdom
-except:
-    visdom_available = False
+from command_pipeline import CommandPipeline
+from mission_metrics import (ErrorRecorder, mission_success, DEFAULT_THRESHOLD_HORIZONTAL_ERROR,
+                             DEFAULT_THRESHOLD_VERTICAL_ERROR, DEFAULT_THRESHOLD_TIME)
+from telemetry import DEFAULT_TELEMETRY_FILE, FileSink, TelemetryPublisher, VisdomSink
+from trajectory import load_trajectory
+from vehicle_state import TARGET_FIELDS, VehicleState
+
+VISDOM_SERVER = 'localhost'
+VISDOM_PORT = 8097
+
+
+def probe_visdom(server=VISDOM_SERVER, port=VISDOM_PORT, timeout=1.0):
+    """Connect to a visdom server, giving up after timeout seconds
+
+    visdom is only imported once its server accepts connections, so neither a missing
+    server nor a missing library delays startup by more than timeout.
+
+    Returns: connected visdom.Visdom instance, or None
+    """
+    try:
+        socket.create_connection((server, port), timeout).close()
+    except OSError:
+        print('For visual autograder start visdom server: python -m visdom.server')
+        return None
+    try:
+        import visdom
+    except ImportError:
+        print('Visdom library not installed...')
+        return None
+    viz = visdom.Visdom(server='http://' + server, port=port)
+    return viz if viz.check_connection() else None
 
 
 class UnityDrone(Drone):
@@ -17,42 +44,57 @@ class UnityDrone(Drone):
     Unity simulation version of the drone
     """
     
-    def __init__(self, connection, tlog_name="TLog.txt"):
+    def __init__(self, connection, tlog_name="TLog.txt", max_error_samples=None,
+                 telemetry_file=None, use_visdom=False, visdom_timeout=1.0,
+                 async_commands=True, command_writer=None):
+        """
+        Args:
+            connection: udacidrone connection to the simulator
+            tlog_name: name of the telemetry log file
+            max_error_samples: cap on the number of autograder error samples kept in memory
+                (None keeps the whole mission). Mission statistics cover all samples either way.
+            telemetry_file: write the live error samples there, also the fallback when
+                visdom is not reachable (DEFAULT_TELEMETRY_FILE when use_visdom is set and
+                this is None). Without a file and without visdom no telemetry thread is
+                started.
+            use_visdom: plot the errors live on a local visdom server (see probe_visdom)
+            visdom_timeout: seconds to wait for the visdom server
+            async_commands: send commands and targets from a CommandPipeline writer thread
+                (latest wins) instead of on the calling thread
+            command_writer: SharedCommandWriter sending the commands (asynchronously) instead
+                of a writer thread of this vehicle's own
+        """
         
         super().__init__(connection, tlog_name)
+
+        # time base of the mission score; subclasses flying on another clock replace it
+        self.clock = time.monotonic
+
+        # outbound commands; failures are counted in self.commands instead of raised
+        if command_writer is not None:
+            self.commands = command_writer.pipeline(connection)
+            self._async_commands = True
+        else:
+            self.commands = CommandPipeline(connection)
+            self._async_commands = async_commands
+            if async_commands:
+                self.commands.start()
         
-        self._target_north = 0.0
-        self._target_east = 0.0
-        self._target_down = 0.0
+        # targets (and the state captured by the control stages) live in one preallocated buffer;
+        # the target properties return read-only views of it, not new arrays
+        self.state = VehicleState()
+        self._target_views = {name: self.state.read_only(name) for name, _ in TARGET_FIELDS}
         self._target_position_time = 0.0
-        
-        self._target_velocity_north = 0.0
-        self._target_velocity_east = 0.0
-        self._target_velocity_down = 0.0
         self._target_velocity_time = 0.0
-        
-        self._target_acceleration_north = 0.0
-        self._target_acceleration_east = 0.0
-        self._target_acceleration_down = 0.0
         self._target_acceleration_time = 0.0
-        
-        self._target_roll = 0.0
-        self._target_pitch = 0.0
-        self._target_yaw = 0.0
         self._target_attitude_time = 0.0
-        
-        self._target_roll_rate = 0.0
-        self._target_pitch_rate = 0.0
-        self._target_yaw_rate = 0.0
         self._target_body_rate_time = 0.0
         
         #Used for the autograder
-        self.all_horizontal_errors = np.empty((0),float)
-        self._threshold_horizontal_error = 2.0
-        self.all_vertical_errors = np.empty((0),float)
-        self._threshold_vertical_error = 1.0
-        self.all_times = np.empty((0),float)
-        self._threshold_time = 20.0
+        self._error_recorder = ErrorRecorder(max_samples=max_error_samples)
+        self._threshold_horizontal_error = DEFAULT_THRESHOLD_HORIZONTAL_ERROR
+        self._threshold_vertical_error = DEFAULT_THRESHOLD_VERTICAL_ERROR
+        self._threshold_time = DEFAULT_THRESHOLD_TIME
         self._average_horizontal_error = 0.0
         self._maximum_horizontal_error = 0.0
         self._average_vertical_error = 0.0
@@ -60,19 +102,17 @@ class UnityDrone(Drone):
         self._mission_time = 0.0
         self._time0 = None
         self._mission_success = True
+        # optional stream (e.g. a flight log stream) receiving every scored sample
+        self.error_log = None
         
         #Visdom visualizer
-        self._visdom_connected = False
-        if visdom_available:
-            self._v = visdom.Visdom()
-            if self._v.check_connection():
-                self._visdom_connected = True
-                self._initialize_plots()
-            else:
-                self._visdom_connected = False
-                print('For visual autograder start visdom server: python -m visdom.server')
-        else:
-            print('Visdom library not installed...')
+        self._v = probe_visdom(timeout=visdom_timeout) if use_visdom else None
+        self._visdom_connected = self._v is not None
+        if telemetry_file is None and use_visdom:
+            telemetry_file = DEFAULT_TELEMETRY_FILE
+        self._telemetry_file = telemetry_file
+        self._telemetry = None
+        self._initialize_plots()
 
 
     def cmd_moment(self, roll_moment, pitch_moment, yaw_moment, thrust):
@@ -84,111 +124,114 @@ class UnityDrone(Drone):
             yaw_moment: in Newton*meter
             thrust: upward force in Newtons
         """
-        try:
-            self.connection.cmd_moment(roll_moment, pitch_moment, yaw_moment, thrust)
-        except Exception as e:
-            # traceback.print_exc()
-            pass
+        self._send('cmd_moment', roll_moment, pitch_moment, yaw_moment, thrust)
+
+    def _send(self, name, *args):
+        """Call connection.<name>(*args) through the command pipeline, never raises"""
+        if self._async_commands:
+            self.commands.submit(name, *args)
+        else:
+            self.commands.send(name, *args)
+
+    def stop(self):
+        # send what is still pending before the connection goes away, later commands are sent directly
+        if self._async_commands:
+            self._async_commands = False
+            self.commands.close()
+        super().stop()
         
     @property
     def local_position_target(self):
-        return np.array([self._target_north,self._target_east,self._target_down])
+        """Read-only view of the target, it follows later updates (copy it to keep a value)"""
+        return self._target_views['local_position_target']
     
     @local_position_target.setter    
     def local_position_target(self, target):
         """Pass the local position target to the drone (not a command)"""
-        self._target_north = target[0]
-        self._target_east = target[1]
-        self._target_down = target[2]
+        view = self.state.local_position_target
+        view[:] = target[0:3]
         t = 0 #TODO: pass along the target time
-        try:
-            self.connection.local_position_target(target[0], target[1], target[2], t)
-        except:
-            # traceback.print_exec()
-            pass
+        self._send('local_position_target', *view.tolist(), t)
         
         #Check for current xtrack error
         if self._time0 is None:
-            self._time0 = time.clock()
+            self._time0 = self.clock()
         
         self._horizontal_error = self.calculate_horizontal_error()
-        self.all_horizontal_errors = np.append(self.all_horizontal_errors,self._horizontal_error)
         #print(self._horizontal_error)
         self._vertical_error = self.calculate_vertical_error()
-        self.all_vertical_errors = np.append(self.all_vertical_errors,self._vertical_error)
-        self._mission_time = time.clock() - self._time0
-        self.all_times = np.append(self.all_times,self._mission_time)
+        self._mission_time = self.clock() - self._time0
+        self._error_recorder.append(self._mission_time, self._horizontal_error, self._vertical_error)
+        error_log = self.error_log
+        if error_log is not None:
+            error_log.append(self._mission_time, self._horizontal_error, self._vertical_error)
         self.check_mission_success()
-        if self._visdom_connected:
-            self._add_visual_data()
+        # _show_plots may clear _telemetry from another thread, read it once
+        telemetry = self._telemetry
+        if telemetry is not None:
+            self._add_visual_data(telemetry)
             
     @property
     def local_velocity_target(self):
-        return np.array([self._target_velocity_north,self._target_velocity_east,self._target_velocity_down])
+        return self._target_views['local_velocity_target']
     
     @local_velocity_target.setter
     def local_velocity_target(self, target):
         """Pass the local velocity target to the drone (not a command)"""
-        
-        self._target_velocity_north = target[0]
-        self._target_velocity_east = target[1]
-        self._target_velocity_down = target[2]
+        view = self.state.local_velocity_target
+        view[:] = target[0:3]
         t = 0 #TODO: pass along the target time
-        try:
-            self.connection.local_velocity_target(target[0], target[1], target[2], t)
-        except:
-            # traceback.print_exec()
-            pass
+        self._send('local_velocity_target', *view.tolist(), t)
             
     @property
     def local_acceleration_target(self):
-        return np.array([self._target_acceleration_north,self._target_acceleration_east,self._target_acceleration_down])
+        return self._target_views['local_acceleration_target']
     
     @local_acceleration_target.setter
     def local_acceleration_target(self,target):
-        self._target_acceleration_north = target[0]
-        self._target_acceleration_east = target[1]
-        self._target_acceleration_down = target[2]
+        view = self.state.local_acceleration_target
+        view[:] = target[0:3]
         t = 0 #TODO: pass along the target time
-        try:
-            self.connection.local_acceleration_target(target[0],target[1],target[2], t)
-        except:
-            # traceback.print_exec()
-            pass
+        self._send('local_acceleration_target', *view.tolist(), t)
     @property
     def attitude_target(self):
-        return np.array([self._target_roll,self._target_pitch,self._target_yaw])
+        return self._target_views['attitude_target']
     
     @attitude_target.setter
     def attitude_target(self, target):
         """Pass the attitude target to the drone (not a command)"""
-        self._target_roll = target[0]
-        self._target_pitch = target[1]
-        self._target_yaw = target[2]
+        view = self.state.attitude_target
+        view[:] = target[0:3]
         t = 0 #TODO: pass along the target time        
-        try:
-            self.connection.attitude_target(target[0], target[1], target[2], t)
-        except:
-            # traceback.print_exec()
-            pass
+        self._send('attitude_target', *view.tolist(), t)
             
     @property
     def body_rate_target(self):
-        return np.array([self._target_roll_rate,self._target_pitch_rate,self._target_yaw_rate])
+        return self._target_views['body_rate_target']
     
     @body_rate_target.setter
     def body_rate_target(self, target):
         """Pass the local position target to the drone (not a command)"""
-        self._target_roll_rate = target[0]
-        self._target_pitch_rate = target[1]
-        self._target_yaw_rate = target[2]
+        view = self.state.body_rate_target
+        view[:] = target[0:3]
         t = 0 #TODO: pass along the target time
-        try:
-            self.connection.body_rate_target(target[0],target[1],target[2], t)
-        except:
-            # traceback.print_exec()
-            pass
+        self._send('body_rate_target', *view.tolist(), t)
     
+    @property
+    def all_horizontal_errors(self):
+        """Recorded horizontal errors, oldest first"""
+        return self._error_recorder.horizontal_errors
+
+    @property
+    def all_vertical_errors(self):
+        """Recorded vertical errors, oldest first"""
+        return self._error_recorder.vertical_errors
+
+    @property
+    def all_times(self):
+        """Mission times of the recorded errors, oldest first"""
+        return self._error_recorder.times
+
     @property
     def threshold_horizontal_error(self):
         """Maximum allowed xtrack error on the mission"""
@@ -233,71 +276,69 @@ class UnityDrone(Drone):
         Args:
             time_mult: a multiplier to decrease the total time of the trajectory
         
+        Returns: tuple (list of positions, list of times, list of yaws), times start now
         """
-        data  = np.loadtxt('test_trajectory.txt', delimiter=',', dtype='Float64')
-        position_trajectory = []
-        time_trajectory = []
-        yaw_trajectory = []
-        current_time = time.time()
-        for i in range(len(data[:,0])):
-            position_trajectory.append(data[i,1:4])
-            time_trajectory.append(data[i,0]*time_mult+current_time)
-        for i in range(0,len(position_trajectory)-1):
-            yaw_trajectory.append(np.arctan2(position_trajectory[i+1][1]-position_trajectory[i][1],position_trajectory[i+1][0]-position_trajectory[i][0]))
-        yaw_trajectory.append(yaw_trajectory[-1])
-        return(position_trajectory,time_trajectory,yaw_trajectory)
+        trajectory = load_trajectory('test_trajectory.txt', time_mult=time_mult, start_time=time.time())
+        return(list(trajectory.positions),trajectory.times.tolist(),trajectory.yaws.tolist())
     
     def calculate_horizontal_error(self):
         """Calcuate the error beteween the local position and target local position
         
         """
-        target_position = np.array([self._target_north,self._target_east])
-        return np.linalg.norm(target_position-self.local_position[0:2])
+        local_position = self.local_position
+        target = self.state.local_position_target
+        return math.hypot(target[0] - local_position[0], target[1] - local_position[1])
     
     def calculate_vertical_error(self):
         """Calculate the error in the vertical direction"""
-        return np.abs(self._target_down-self.local_position[2])
+        return np.abs(self.state.local_position_target[2]-self.local_position[2])
     
     def print_mission_score(self):
         """Prints the maximum xtrack error, total time, and mission success
 
         """
-        print('Maximum Horizontal Error: ', self._maximum_horizontal_error)
-        print('Maximum Vertical Error: ', self._maximum_vertical_error)
-        print('Mission Time: ', self._mission_time)
+        print('Maximum Horizontal Error: ', self._error_recorder.maximum_horizontal_error)
+        print('Maximum Vertical Error: ', self._error_recorder.maximum_vertical_error)
+        print('Mission Time: ', self._error_recorder.mission_time)
         print('Mission Success: ', self._mission_success)
-        if self._visdom_connected:
+        if self._telemetry is not None:
             self._show_plots()
         
     def check_mission_success(self):
         """Check the mission success criterion (xtrack and time)
         
         """
-        if self._horizontal_error > self._maximum_horizontal_error:
-            self._maximum_horizontal_error = self._horizontal_error
-            if self._maximum_horizontal_error > self._threshold_horizontal_error:
-                self._mission_success = False
-        if self._vertical_error > self._maximum_vertical_error:
-            self._maximum_vertical_error = self._vertical_error
-            if self._maximum_vertical_error > self._threshold_vertical_error:
-                self._mission_success = False
-        if self._mission_time > self._threshold_time:
+        recorder = self._error_recorder
+        self._maximum_horizontal_error = recorder.maximum_horizontal_error
+        self._average_horizontal_error = recorder.average_horizontal_error
+        self._maximum_vertical_error = recorder.maximum_vertical_error
+        self._average_vertical_error = recorder.average_vertical_error
+        if not mission_success(self._maximum_horizontal_error, self._maximum_vertical_error, recorder.mission_time,
+                               self._threshold_horizontal_error, self._threshold_vertical_error,
+                               self._threshold_time):
             self._mission_success = False
         
         
      
 
     def _show_plots(self):
-        self._horizontal_plot = self._v.line(self.all_horizontal_errors, X=self.all_times, opts=dict(title="Horizontal Error",xlabel="Time(s)",ylabel="Error (m)"))
-        self._vertical_plot = self._v.line(self.all_vertical_errors, X=self.all_times, opts=dict(title="Vertical Error", xlabel="Time(s)", ylabel="Error (m)"))
-        
+        """Send the samples not yet published and stop the live telemetry"""
+        telemetry = self._telemetry
+        self._telemetry = None
+        if telemetry is not None:
+            telemetry.close()
+
     def _initialize_plots(self):
-        #self._horizontal_plot = self._v.line(np.array([0.0]),X=np.array([0.0]),opts=dict(title="Horizontal Error",xlabel="Time(s)",ylabel="Error (m)"))
-        pass
+        """Start publishing the errors live, to visdom or else to the telemetry file"""
+        fallback = FileSink(self._telemetry_file) if self._telemetry_file is not None else None
+        sink = VisdomSink(self._v) if self._visdom_connected else fallback
+        if sink is not None:
+            self._telemetry = TelemetryPublisher(sink, fallback=fallback if sink is not fallback else None)
+            self._telemetry.start()
 
-    def _add_visual_data(self):
-        #self._v.line(np.array([self._horizontal_error]),X=np.array([self._mission_time]),win=self._horizontal_plot,update='append')
-        pass
+    def _add_visual_data(self, telemetry):
+        # only queues the sample, the publisher thread sends it with the next batch
+        telemetry.publish(self._mission_time, self._horizontal_error, self._vertical_error)
     
     def cmd_position(self, target_north, target_east, target_down, yaw):
         pass
\ No newline at end of file
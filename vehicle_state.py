@@ -0,0 +1,67 @@
+"""
+Preallocated vehicle state and cascade targets
+
+components:
+    one float64 buffer holding the sensed state and every target of the control cascade
+    named views into that buffer, fixed for the lifetime of the object
+    read-only views and consistent copies for readers outside the control stages
+"""
+import numpy as np
+
+# sensed state, captured once per stage
+# (attitude_quaternion is only filled by a flyer controlling with quaternions)
+STATE_FIELDS = (('local_position', 3), ('local_velocity', 3), ('attitude', 3), ('attitude_quaternion', 4),
+                ('body_rate', 3))
+# written by the cascade stages
+TARGET_FIELDS = (('local_position_target', 3), ('local_velocity_target', 3), ('local_acceleration_target', 3),
+                 ('attitude_target', 3), ('body_rate_target', 3), ('acceleration_ff', 3))
+FIELDS = STATE_FIELDS + TARGET_FIELDS
+
+
+class VehicleState(object):
+    __slots__ = ('buffer',) + tuple(name for name, _ in FIELDS)
+
+    def __init__(self, buffer=None):
+        """State and targets as views of a single float64 buffer
+
+        Every field (see FIELDS) is a numpy view created once, so the stages read and write
+        the values in place, e.g. state.attitude[:] = drone.attitude, without allocating
+        an array per tick. A stage capturing its inputs once and reading only the views
+        sees one consistent state, even if the sensor values change while it runs.
+
+        Args:
+            buffer: optional float64 array of FIELDS size the views are made into,
+                zeros when None
+        """
+        size = sum(length for _, length in FIELDS)
+        if buffer is None:
+            buffer = np.zeros(size)
+        elif buffer.shape != (size,) or buffer.dtype != np.float64:
+            raise ValueError('buffer must be a float64 array of {} elements'.format(size))
+        self.buffer = buffer
+        offset = 0
+        for name, length in FIELDS:
+            setattr(self, name, buffer[offset:offset + length])
+            offset += length
+
+    def read_only(self, name):
+        """Non-writeable view of a field, following its later updates"""
+        view = getattr(self, name).view()
+        view.flags.writeable = False
+        return view
+
+    def capture(self, local_position, local_velocity, attitude, body_rate):
+        """Copy the sensed state into the buffer"""
+        self.local_position[:] = local_position
+        self.local_velocity[:] = local_velocity
+        self.attitude[:] = attitude
+        self.body_rate[:] = body_rate
+
+    def copy(self):
+        """Independent VehicleState with the current values
+
+        The whole buffer is copied in one numpy call, which holds the GIL, so a copy taken
+        on another thread never mixes values from before and after a stage's update of
+        a field.
+        """
+        return VehicleState(self.buffer.copy())
@@ -1,15 +1,115 @@
-import matplotlib.pyplot as plt
 import numpy as np
-# noinspection PyUnresolvedReferences
-from mpl_toolkits.mplot3d import Axes3D
-import pickle
+import argparse
+import os
 
+from flight_log import DEFAULT_FLIGHT_LOG_DIR, convert_legacy_log, open_flight_log
 
-def visualize_planned_trajectory(traj, executed=None):
+# pixel columns of a decimated plot, at most two points are drawn per column
+DEFAULT_PLOT_WIDTH = 2000
+# samples read from the log at once while decimating
+DECIMATION_CHUNK_SIZE = 1 << 20
+
+
+def decimate_minmax(t, values, width=DEFAULT_PLOT_WIDTH, reference=None, chunk_size=DECIMATION_CHUNK_SIZE):
+    """Reduce a long time series to its minimum and maximum sample in each pixel column
+
+    The samples are read chunk_size at a time, so t and values may be memory maps of any
+    length. Every column keeps its extreme samples, so spikes survive the decimation.
+
+    Args:
+        t: (N,) increasing sample times
+        values: (N,) sample values
+        width: number of pixel columns
+        reference: optional (N,) values subtracted from values, chunk by chunk
+        chunk_size: number of samples read at once
+
+    Returns: tuple of numpy arrays (times, values) of at most 2 * width points, in time order
+    """
+    n = len(t)
+    if n <= 2 * width:
+        values = np.asarray(values, dtype=np.float64)
+        if reference is not None:
+            values = values - np.asarray(reference, dtype=np.float64)
+        return np.asarray(t, dtype=np.float64), values
+
+    t0 = float(t[0])
+    span = float(t[n - 1]) - t0
+    scale = width / span if span > 0 else 0.0
+    min_value = np.full(width, np.inf)
+    max_value = np.full(width, -np.inf)
+    min_time = np.zeros(width)
+    max_time = np.zeros(width)
+    for start in range(0, n, chunk_size):
+        chunk_t = np.asarray(t[start:start + chunk_size], dtype=np.float64)
+        chunk_v = np.asarray(values[start:start + chunk_size], dtype=np.float64)
+        if reference is not None:
+            chunk_v = chunk_v - np.asarray(reference[start:start + chunk_size], dtype=np.float64)
+        valid = ~np.isnan(chunk_v)
+        if not valid.all():
+            chunk_t = chunk_t[valid]
+            chunk_v = chunk_v[valid]
+        if not len(chunk_t):
+            continue
+        column = np.minimum(((chunk_t - t0) * scale).astype(np.intp), width - 1)
+        # times are increasing, so each column is a contiguous run of the chunk
+        starts = np.flatnonzero(np.diff(column, prepend=-1))
+        columns = column[starts]
+        lengths = np.diff(np.append(starts, len(column)))
+        run = np.repeat(np.arange(len(starts)), lengths)
+        for reduce, best, best_time, better in ((np.minimum, min_value, min_time, np.less),
+                                                (np.maximum, max_value, max_time, np.greater)):
+            extreme = reduce.reduceat(chunk_v, starts)
+            # first sample of each run equal to the run's extreme
+            hits = np.flatnonzero(chunk_v == np.repeat(extreme, lengths))
+            hits = hits[np.flatnonzero(np.diff(run[hits], prepend=-1))]
+            update = better(extreme, best[columns])
+            best[columns[update]] = extreme[update]
+            best_time[columns[update]] = chunk_t[hits[update]]
+
+    occupied = np.isfinite(min_value)
+    min_first = min_time[occupied] <= max_time[occupied]
+    times = np.where(min_first, [min_time[occupied], max_time[occupied]],
+                     [max_time[occupied], min_time[occupied]])
+    values = np.where(min_first, [min_value[occupied], max_value[occupied]],
+                      [max_value[occupied], min_value[occupied]])
+    return times.ravel(order='F'), values.ravel(order='F')
+
+
+def _pyplot():
+    # matplotlib is slow to import and flight never plots, so it is loaded on the first plot
+    import matplotlib.pyplot as plt
+    # noinspection PyUnresolvedReferences
+    from mpl_toolkits.mplot3d import Axes3D
+    return plt
+
+
+def _figure(filename):
+    # an off-screen figure needs no display, it is rendered by the Agg canvas on savefig
+    if filename is None:
+        return _pyplot().figure()
+    from matplotlib.figure import Figure
+    return Figure(figsize=(12, 6))
+
+
+def _finish(fig, filename):
+    if filename is None:
+        _pyplot().show()
+    else:
+        fig.savefig(filename, dpi=100)
+
+
+def visualize_planned_trajectory(traj, executed=None, filename=None):
+    """Plot the planned (and executed) path in 3D
+
+    Args:
+        traj: (N,3) planned NED positions
+        executed: optional (M,3) flown NED positions
+        filename: save a PNG there without a display instead of showing the plot
+    """
     traj = np.array(traj)
-    fig = plt.figure()
-    ax = fig.gca(projection='3d')
-    plt.title('Flight path').set_fontsize(20)
+    fig = _figure(filename)
+    ax = fig.add_subplot(projection='3d')
+    ax.set_title('Flight path').set_fontsize(20)
     ax.set_xlabel('NORTH')
     ax.set_ylabel('EAST')
     ax.set_zlabel('-DOWN')
@@ -24,48 +124,73 @@ def visualize_planned_trajectory(traj, executed=None):
         ax.plot(executed[:, 0], executed[:, 1], -executed[:, 2], c='r')
         legend.append('Executed')
 
-    plt.legend(legend, fontsize=14)
-    plt.show()
+    ax.legend(legend, fontsize=14)
+    _finish(fig, filename)
+
 
+def visualize_axial_trajectory(t, target, actual, axis=2, width=DEFAULT_PLOT_WIDTH, filename=None):
+    """Plot the target and actual value of one axis over time
 
-def visualize_axial_trajectory(t, target, actual, axis=2):
-    fig = plt.figure()
+    Args:
+        t: (N,) increasing sample times
+        target, actual: (N,3) arrays, memory maps are read in chunks
+        axis: column plotted
+        width: pixel columns the series are decimated to (see decimate_minmax)
+        filename: save a PNG there without a display instead of showing the plot
+    """
+    fig = _figure(filename)
     ax = fig.gca()
-    plt.title('Flight path').set_fontsize(20)
+    ax.set_title('Flight path').set_fontsize(20)
     ax.set_xlabel('Time')
     ax.set_ylabel('Value')
 
     legend = ['Target', 'Actual']
-    t_start = np.min(t)
-    ax.plot(np.array(t) - t_start, target[:, axis], c='r')
-    ax.plot(np.array(t) - t_start, actual[:, axis], c='g')
+    t_start = float(t[0])
+    for values, color in ((target[:, axis], 'r'), (actual[:, axis], 'g')):
+        plot_t, plot_values = decimate_minmax(t, values, width)
+        ax.plot(plot_t - t_start, plot_values, c=color)
+
+    ax.legend(legend, fontsize=14)
+    _finish(fig, filename)
 
-    plt.legend(legend, fontsize=14)
-    plt.show()
 
+def visualize_axial_error(t, target, actual, axis=2, width=DEFAULT_PLOT_WIDTH, filename=None):
+    """Plot actual - target of one axis over time
 
-def visualize_axial_error(target, actual, axis=2):
-    fig = plt.figure()
+    Args: as for visualize_axial_trajectory
+    """
+    fig = _figure(filename)
     ax = fig.gca()
-    plt.title('Error').set_fontsize(20)
+    ax.set_title('Error').set_fontsize(20)
     ax.set_xlabel('Time')
     ax.set_ylabel('Error')
 
-    legend = ['Target', 'Actual']
-    t_start = np.min(target[:, -1])
-    ax.plot(target[:, -1] - t_start, actual[:, axis] - target[:, axis], c='r')
+    legend = ['Actual - target']
+    t_start = float(t[0])
+    plot_t, plot_values = decimate_minmax(t, actual[:, axis], width, reference=target[:, axis])
+    ax.plot(plot_t - t_start, plot_values, c='r')
 
-    plt.legend(legend, fontsize=14)
-    plt.show()
+    ax.legend(legend, fontsize=14)
+    _finish(fig, filename)
 
 
 if __name__ == '__main__':
-    with open('flight_log', 'rb') as f:
-        all_logs = pickle.load(f)
-    traj_t, target_traj, actual_traj, v_t, target_v, actual_v = all_logs
-    visualize_axial_trajectory(
-        traj_t,
-        np.array(target_traj), np.array(actual_traj), axis=1)
-    visualize_axial_trajectory(
-        v_t,
-        np.array(target_v), np.array(actual_v), axis=1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log', type=str, nargs='?', default=DEFAULT_FLIGHT_LOG_DIR)
+    parser.add_argument('--axis', type=int, default=1)
+    parser.add_argument('--width', type=int, default=DEFAULT_PLOT_WIDTH, help='pixel columns per plot')
+    parser.add_argument('--output-dir', type=str, default=None, help='write PNG files instead of showing plots')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.log) and os.path.exists('flight_log'):
+        convert_legacy_log('flight_log', args.log)
+    log = open_flight_log(args.log)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for stream_name in ('position', 'velocity'):
+        stream = log[stream_name]
+        output = None
+        if args.output_dir is not None:
+            output = os.path.join(args.output_dir, '{}_axis{}.png'.format(stream_name, args.axis))
+        visualize_axial_trajectory(stream['t'], stream['target'], stream['actual'], axis=args.axis,
+                                   width=args.width, filename=output)